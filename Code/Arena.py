@@ -0,0 +1,591 @@
+# Arena.py
+#
+# the game loop of one arena (pitch) as an instance, so one process can run
+# several arenas (see ArenaHost.py) as well as the single arena ArenaManager
+#
+# an arena owns its frame source (detector), settings view, lookup tables,
+# fleet table, pixelbots, command scheduler and stage machine. tick() runs
+# one pass of the loop, the caller decides where and how often it runs
+#
+# cfg is config.settings or a config.arenaSettings (the ARENA_SCOPED values
+# of one pitch over the shared settings), idTables the matching lookups
+
+import time
+
+import numpy as np
+
+from config import settings,lookups
+import MiscLib
+import pixelbotClass
+import FlowField
+import BaseAssignment
+import WorldBroadcast
+import ProgramDeployer
+import Metrics
+import Log
+import FleetState
+import CommandScheduler
+import ProximityGrid
+import MotionPredictor
+from CommandScheduler import PRIORITY_URGENT,PRIORITY_NORMAL
+from mqttSecrets import MQTT_WORLD_TOPIC
+
+# game loop stages
+FINDING_BASES=1
+FINDING_BOTS=2
+HOMING_BOTS=3
+WAITING_FOR_BALL=4
+PLAYING_GAME=5
+STOPPED=6
+FACE_OPPONENTS=7
+
+STAGE_NAMES={FINDING_BASES:"FINDING_BASES",FINDING_BOTS:"FINDING_BOTS",HOMING_BOTS:"HOMING_BOTS",
+	WAITING_FOR_BALL:"WAITING_FOR_BALL",PLAYING_GAME:"PLAYING_GAME",STOPPED:"STOPPED",FACE_OPPONENTS:"FACE_OPPONENTS"}
+
+
+class arena:
+
+	def __init__(self,detector,name:str="",cfg=settings,idTables=lookups,broker=None):
+		"""
+		detector is an arucoDetector built with the same idTables
+
+		broker is a pixelbotClass.sharedClient used by every bot of the
+		arena, None gives each bot its own broker connection
+		"""
+		self.name=name # added to log records when several arenas share the console
+		self.settings=cfg
+		self.lookups=idTables
+		self.detector=detector
+		self.broker=broker
+
+		self.stage=FINDING_BASES
+		self.lastArenaScale=detector.getScale() # used to detect camera movement
+
+		self.pixelbots={} # id-> pixelbot class instances, views onto fleet for messaging
+		self.fleet=FleetState.fleetState(idTables=idTables) # positions and status of every bot as arrays
+		self.team0HomeBases={} # id-> cx,cy
+		self.team1HomeBases={}
+		self.arenaBoundaries=[0,0,cfg.VIDEO_WIDTH,cfg.VIDEO_HEIGHT] # re-calculated in game loop
+
+		self.ballPos=(None,None) # tuple of cx,cy positions
+		self.ballTrack=MotionPredictor.pointTrack() # ball velocity for latency compensation
+		self.ballAppeared=None # capture time of the frame the ball came into play, till a bot reaches it
+
+		self.navigator=FlowField.flowFieldNavigator() # shared flow fields, used if settings.USE_FLOW_FIELD
+
+		self.broadcaster=None
+		if cfg.WORLD_BROADCAST:
+			self.broadcaster=WorldBroadcast.worldPublisher(mqttc=broker,
+				topic=cfg.TOPIC_NAMESPACE+MQTT_WORLD_TOPIC)
+
+		self.deployer=ProgramDeployer.programDeployer()
+
+		self.proximity=ProximityGrid.proximityEngine() # spatial hash of bots, ball and move destinations
+		self.scheduler=CommandScheduler.commandScheduler(self.sendToBot,self.checkMove) # every move goes through this
+
+		self.homingStarted=None # time HOMING_BOTS began
+		self.homingEstimate=0 # seconds, slowest bot
+
+	def botBusy(self,botId,setBusy=False):
+		"""
+		busy=None means just read the status otherwise set it
+
+		busy flags older than settings.BUSY_TIMEOUT_S are cleared for the
+		whole fleet by expireBusy() in case the bot callback is missing
+
+		"""
+		if setBusy:
+			# set the bot status to busy and start the timeout
+			self.fleet.setBusy(botId,time.time())
+			return True
+		return bool(self.fleet.busy[self.fleet.slotOf[botId]])
+
+	def sendToBot(self,botId,Vars:dict)->None:
+		"""
+		called by the scheduler when a move is actually sent
+		"""
+		self.botBusy(botId,True)
+		self.pixelbots[botId].updateVariables(Vars)
+
+	def checkMove(self,botId,Vars:dict):
+		"""
+		scheduler hook, shortens, detours or holds (returns None) a move
+		which would run into another bot or where another bot has been sent
+		"""
+		if not self.settings.AVOID_COLLISIONS:
+			return Vars
+		fleet=self.fleet
+		slot=fleet.slotOf[botId]
+		scale=self.detector.getScale()
+		x,y,heading=fleet.cx[slot]/scale,fleet.cy[slot]/scale,fleet.heading[slot]
+		if np.isnan(x):
+			return Vars
+		# only homing bots steer clear of the ball
+		move=self.proximity.checkMove(botId,x,y,heading,Vars["angle"],Vars["dist"],avoidBall=self.stage==HOMING_BOTS)
+		if move is None:
+			return None
+		angle,dist=move
+		if (angle,dist)!=(Vars["angle"],Vars["dist"]):
+			Vars=dict(Vars,angle=angle,dist=dist)
+		self.proximity.reserve(botId,*ProximityGrid.moveEnd(x,y,heading,angle,dist))
+		return Vars
+
+	def updateProximity(self)->None:
+		"""
+		refresh the spatial hash from the fleet table, once per tick
+		"""
+		fleet=self.fleet
+		scale=self.detector.getScale()
+		seen=fleet.slots(fleet.activeMask()&~np.isnan(fleet.cx))
+		ballX,ballY=self.ballPos
+		ball=None if ballX is None else (ballX/scale,ballY/scale)
+		self.proximity.update(fleet.botId[seen].tolist(),fleet.cx[seen]/scale,fleet.cy[seen]/scale,ball)
+		# a bot which has finished its move no longer needs its destination kept clear
+		for botId in fleet.ids(fleet.idleMask()):
+			self.proximity.release(botId)
+
+	def expireBusy(self)->None:
+		"""
+		once per tick, clear the busy flag of bots which never replied
+		"""
+		for botId in self.fleet.expireBusy(time.time(),self.settings.BUSY_TIMEOUT_S):
+			Log.warning("Busy timeout",bot=botId)
+
+	def updatePixelbots(self)->None:
+		"""updatePixelbots
+
+		updates the coordinates of every bot in the fleet table in one go
+		This does not send anything to the pixelbot itself therefore
+		doesn't care if the hardware is busy.
+
+		This info is used to calculate motion distances and angles
+		"""
+		self.fleet.updateFromDetections(self.detector.getPixelbots(),self.detector.getCaptureTime())
+
+	def updateNavigator(self,toBall:bool)->None:
+		"""
+		refresh the shared flow fields from the current bot and ball positions
+
+		toBall=True keeps one field for the ball otherwise one per home base
+		(the ball is then just another obstacle)
+		"""
+		fleet=self.fleet
+		obstacles={}
+		targets={}
+		active=fleet.slots(fleet.activeMask())
+		for botId,cx,cy,homeX,homeY in zip(fleet.botId[active].tolist(),fleet.cx[active].tolist(),fleet.cy[active].tolist(),
+				fleet.homeX[active].tolist(),fleet.homeY[active].tolist()):
+			obstacles[botId]=(cx,cy,self.settings.BOT_RADIUS_MM)
+			if not toBall:
+				homePos=(int(homeX),int(homeY))
+				targets[homePos]=homePos
+
+		ballX,ballY=self.ballPos
+		if ballX is not None:
+			obstacles["ball"]=(ballX,ballY,self.settings.BALL_DIA_MM/2)
+			if toBall:
+				targets["ball"]=self.ballPos
+
+		self.navigator.update(self.arenaBoundaries,self.detector.getScale(),obstacles)
+		self.navigator.refresh(targets)
+
+	def steerTowards(self,targetKey,cx,cy,targetX,targetY)->tuple:
+		"""
+		returns the point to head for, the next flow field waypoint when
+		settings.USE_FLOW_FIELD is set otherwise the target itself
+		"""
+		if self.settings.USE_FLOW_FIELD:
+			waypoint=self.navigator.nextWaypoint(targetKey,cx,cy)
+			if waypoint is not None:
+				return waypoint
+		return targetX,targetY
+
+	def faceTheOpponents(self):
+		"""
+		turn the idle bots to face the other team
+		"""
+		fleet=self.fleet
+		slots=fleet.slots(fleet.idleMask()&fleet.present)
+
+		# bots on the left must turn to face east (90)
+		# bots on the right must face west (180)
+		halfWay=self.settings.VIDEO_WIDTH/2
+		newCourses=np.where(fleet.homeX[slots]<halfWay,180,90)
+		# we only want a turn, from the heading the bot will have by then
+		_,_,heading=fleet.predictPoses(slots,self._lead())
+		angles=MiscLib.getCourseChanges(newCourses,heading).astype(int)
+
+		for botId,newCourse,angle in zip(fleet.botId[slots].tolist(),newCourses.tolist(),angles.tolist()):
+			Log.info("Turn to face opponents",bot=botId,course=newCourse,heading=self.pixelbots[botId].heading)
+			Vars={
+				"angle":angle,
+				"dist":0
+			}
+			self.scheduler.submit(botId,Vars,PRIORITY_URGENT)
+
+	def createPixelbots(self)->None:
+		"""
+		create new pixelbot instances and send them home
+		"""
+		cfg=self.settings
+		foundBots=self.detector.getPixelbots() # a dict id=>(cx,cy,angle)
+		homeBases=self.detector.getHomeBases()
+
+		for botId in list(foundBots.keys()):
+			# is this a new pixelbot?
+			if not botId in self.pixelbots:
+				try:
+					cx,cy,heading=foundBots[botId]
+					if cx is not None:
+						if cfg.ASSIGNMENT_MODE=="optimal":
+							# provisional, any base on the right side will do till assignHomeBases()
+							team=self.lookups.teamByBot.get(botId)
+							if team is None:
+								Log.warning("Bot is in neither team",bot=botId)
+								continue
+							pairedWith=(cfg.TEAM0_BASES if team==0 else cfg.TEAM1_BASES)[0]
+						else:
+							pairedWith=cfg.PAIRINGS[botId]
+						# all home bases must be found first
+						homeX,homeY=homeBases[pairedWith]
+
+						self.pixelbots[botId]=pixelbotClass.pixelbot(botId,cx,cy,heading,homeX,homeY,
+							fleet=self.fleet,broker=self.broker,namespace=cfg.TOPIC_NAMESPACE)
+					else:
+						Log.warning("Cannot create bot",bot=botId)
+				except:
+					# another bot may be covering its base
+					Log.warning("Cannot locate homeBase",bot=botId)
+
+	def assignHomeBases(self)->None:
+		"""
+		pair each bot with a home base and report the estimated homing time
+
+		settings.ASSIGNMENT_MODE "optimal" re-pairs the bots to minimise the total
+		homing time otherwise the static settings.PAIRINGS are kept
+		"""
+		fleet=self.fleet
+		active=fleet.slots(fleet.activeMask())
+		bots={botId:pose for botId,*pose in zip(fleet.botId[active].tolist(),fleet.cx[active].tolist(),fleet.cy[active].tolist(),fleet.heading[active].tolist())}
+		homeBases=self.detector.getHomeBases()
+
+		if self.settings.ASSIGNMENT_MODE=="optimal":
+			pairings,estimates=BaseAssignment.optimalAssignment(bots,homeBases,self.detector.getScale(),self.settings)
+			for botId,baseId in pairings.items():
+				homeX,homeY=homeBases[baseId]
+				self.pixelbots[botId].setHomePos(homeX,homeY)
+		else:
+			pairings,estimates=BaseAssignment.staticAssignment(bots,homeBases,self.detector.getScale(),self.settings)
+
+		for botId,baseId in pairings.items():
+			Log.info("Home base",bot=botId,base=baseId,estimate=estimates[botId])
+
+		self.homingEstimate=max(estimates.values()) if estimates else 0
+		self.homingStarted=time.time()
+		Log.info("Estimated time to home",seconds=self.homingEstimate,total=sum(estimates.values()))
+
+	def chaseTheBall(self):
+		"""
+		calculate angles and distances to move to get to the ball
+
+		only the idle bots seen in this frame are moved, their turns
+		and distances are worked out together, from where the bots and
+		the ball will be when the moves arrive
+		"""
+		if self.ballPos[0] is None:
+			return
+
+		fleet=self.fleet
+		slots=fleet.slots(fleet.idleMask()&fleet.present)
+		if len(slots)==0:
+			return
+		lead=self._lead()
+		cx,cy,heading=fleet.predictPoses(slots,lead)
+		ballX,ballY=self.ballTrack.predict(lead)
+		if ballX is None:
+			ballX,ballY=self.ballPos
+
+		if self.settings.USE_FLOW_FIELD:
+			targets=np.array([self.steerTowards("ball",x,y,ballX,ballY) for x,y in zip(cx.tolist(),cy.tolist())],dtype=float)
+			targetX,targetY=targets[:,0],targets[:,1]
+		else:
+			targetX,targetY=ballX,ballY
+
+		scale=self.detector.getScale()
+		courses,distPX=MiscLib.getHeadingsAndRanges(cx,cy,targetX,targetY)
+		angles=MiscLib.getCourseChanges(courses,heading).astype(int)
+		dists=np.rint(distPX/scale).astype(int)
+
+		ballMM=(ballX/scale,ballY/scale)
+		for botId,angle,dist in zip(fleet.botId[slots].tolist(),angles.tolist(),dists.tolist()):
+			Vars={
+				"angle":angle,
+				"dist":dist
+			}
+
+			# the bot program should turn and move, tiny corrections are dropped
+			self.scheduler.submit(botId,Vars,PRIORITY_URGENT,target=ballMM)
+
+	def sendHome(self,botId):
+		"""
+		calculate angle and distance to move
+		"""
+
+		if not self.botBusy(botId):
+
+			Vars={
+				"angle":0,
+				"dist":0
+			}
+
+			# updated by the loop
+			bot=self.pixelbots[botId]
+			if bot.cx is None: # might happen if bot has left the arena
+				return
+
+			# where the bot will be when the move arrives
+			cx,cy,heading=(float(v[0]) for v in self.fleet.predictPoses(np.array([bot.slot]),self._lead()))
+			homeX=bot.homeX
+			homeY=bot.homeY
+			targetX,targetY=self.steerTowards((homeX,homeY),cx,cy,homeX,homeY)
+			course,distPX=MiscLib.getHeadingAndRange(cx,cy,targetX,targetY)
+			scale=self.detector.getScale()
+			Vars["angle"]=MiscLib.getCourseChange(course,heading)
+			Vars["dist"]=int(distPX/scale)
+
+			# the bot program should turn and move
+			if self.scheduler.submit(botId,Vars,PRIORITY_NORMAL,target=(homeX/scale,homeY/scale)):
+				Log.info("Send home",bot=botId,angle=Vars["angle"],dist=Vars["dist"])
+
+	def allBotsHomed(self):
+		"""
+		Check if all bots are homed. Required before game can commence
+		"""
+		fleet=self.fleet
+		baseSideLenPX=self.settings.HOMEBASE_SIDELEN_MM*self.detector.getScale()
+
+		home=fleet.homeMask(baseSideLenPX)
+		notHome=fleet.activeMask()&~home
+		for botId in fleet.ids(notHome&fleet.idleMask()):
+			self.sendHome(botId)
+		return not notHome.any()
+
+	def spotTheBall(self)->bool:
+		"""
+		try to locate a ball
+		"""
+		ballX,ballY=self.detector.getBall()
+		if ballX is not None:
+			self.ballPos=(ballX,ballY)
+			self.ballTrack.update(self.ballPos,self.detector.getCaptureTime())
+
+	def _lead(self)->float:
+		"""
+		seconds to extrapolate poses by for moves made now
+		"""
+		lead=MotionPredictor.leadTime(self.detector.getCaptureTime())
+		Metrics.controlLead.observe(lead,self.name)
+		return lead
+
+	def checkBallContact(self)->None:
+		"""
+		times the ball appearing to the first bot reaching it
+		"""
+		if self.ballAppeared is None or self.ballPos[0] is None:
+			return
+		fleet=self.fleet
+		slots=fleet.slots(fleet.present)
+		if len(slots)==0:
+			return
+		reach=(self.settings.BOT_RADIUS_MM+self.settings.BALL_DIA_MM/2)*self.detector.getScale()
+		ballX,ballY=self.ballPos
+		if np.hypot(fleet.cx[slots]-ballX,fleet.cy[slots]-ballY).min()<=reach:
+			seconds=(self.detector.getCaptureTime() or time.monotonic())-self.ballAppeared
+			Metrics.ballContactSeconds.observe(seconds,self.name)
+			Log.info("Ball reached",seconds=seconds)
+			self.ballAppeared=None
+
+	def broadcastWorld(self)->None:
+		"""
+		publish bot and ball positions for the bot programs
+		the publisher limits this to settings.WORLD_RATE_HZ
+		"""
+		detector=self.detector
+		self.broadcaster.publish(detector.getFrameNumber(),detector.getPixelbots(),self.ballPos,detector.getScale())
+
+	def snapshot(self)->dict:
+		"""
+		a small snapshot for the Flask /state feed for client side overlays
+		all positions are in frame pixels
+		"""
+		fleet=self.fleet
+		detector=self.detector
+		bots={}
+		seen=fleet.slots(fleet.activeMask()&~np.isnan(fleet.cx))
+		for botId,cx,cy,heading,busy in zip(fleet.botId[seen].tolist(),fleet.cx[seen].tolist(),fleet.cy[seen].tolist(),
+				fleet.heading[seen].tolist(),fleet.busy[seen].tolist()):
+			bots[botId]={"x":int(cx),"y":int(cy),"heading":int(heading),"team":self.pixelbots[botId].teamColour,"busy":busy}
+
+		bases={int(baseId):[int(cx),int(cy)] for baseId,(cx,cy) in detector.getHomeBases().items()}
+
+		ballX,ballY=self.ballPos
+		return {
+			"frame":detector.getFrameNumber(),
+			"stage":STAGE_NAMES[self.stage],
+			"width":self.settings.VIDEO_WIDTH,
+			"height":self.settings.VIDEO_HEIGHT,
+			"scale":detector.getScale(),
+			"arena":[int(v) for v in self.arenaBoundaries],
+			"bots":bots,
+			"bases":bases,
+			"ball":None if ballX is None else [int(ballX),int(ballY)],
+			"workload":detector.getWorkload()
+		}
+
+	def collectMetrics(self)->None:
+		"""
+		refreshes the game and fleet gauges, only called when /metrics is scraped
+		"""
+		fleet=self.fleet
+		for stage,name in STAGE_NAMES.items():
+			Metrics.gameStage.set(1 if stage==self.stage else 0,self.name,name)
+		Metrics.scale.set(self.detector.getScale(),self.name)
+		for botId,busy in zip(fleet.ids(fleet.activeMask()),fleet.busy[:len(fleet)].tolist()):
+			Metrics.botBusy.set(1 if busy else 0,str(botId))
+
+	def calcArenaBoundaries(self,homeBases):
+		"""
+		return a rectangle defining the height and width of
+		the arena using position of bases in pixels
+		using TEAM0_BOTS[0] and TEAM1_BOTS[0] markers
+
+		settings.BOUNDARY_MARGIN us used to expand the area
+		encompassed by the home markers
+
+		"""
+		# all team0 bases are almost on same X and max Y pos
+		# likewise for team1
+
+		try:
+			# find the minX,minY,maxX,maxY for the bases
+			minX,minY,maxX,maxY=self.settings.VIDEO_WIDTH,self.settings.VIDEO_HEIGHT,0,0
+			for baseId in list(homeBases.keys()):
+				cx,cy=homeBases[baseId]
+
+				minX=cx if cx<minX else minX
+				minY=cy if cy<minY else minY
+				maxX=cx if cx>maxX else maxX
+				maxY=cy if cy>maxY else maxY
+
+			self.arenaBoundaries=MiscLib.expandRect(minX,minY,maxX,maxY,self.settings.BOUNDARY_MARGIN)
+
+		except Exception as e:
+			Log.warning("CalcBoundaries exception",error=repr(e))
+
+	def getTeamBases(self):
+		"""
+		splits homeBases into team  bases
+		required to calculate arenaBoundaries because the arena image
+		might not fill the video frame
+		"""
+		# do this in every looop incase camera position changes
+
+		homeBases=self.detector.getHomeBases()
+
+		for baseId in list(homeBases.keys()):
+			if baseId in self.settings.TEAM0_BASES:
+				self.team0HomeBases[baseId]=homeBases[baseId]
+			else:
+				self.team1HomeBases[baseId]=homeBases[baseId]
+
+		self.calcArenaBoundaries(homeBases) # gets arena rect
+
+		return len(homeBases.keys())
+
+	def stop(self)->None:
+		self.stage=STOPPED
+
+	def tick(self)->bool:
+		"""
+		one pass of the game loop, returns False once the arena has stopped
+		"""
+		if self.stage==STOPPED:
+			return False
+
+		cfg=self.settings
+		detector=self.detector
+		loopStart=time.perf_counter()
+		loopStage=STAGE_NAMES[self.stage]
+
+		detector.setWorkload(loopStage) # only run the detectors this stage needs
+		detector.update()
+		# every record from this tick carries them
+		Log.bind(arena=self.name,stage=loopStage,frame=detector.getFrameNumber())
+		self.spotTheBall() # updates ball pos
+		self.expireBusy()
+
+		if self.broadcaster is not None:
+			self.broadcastWorld()
+
+		if self.stage==FINDING_BASES:
+			numBases=self.getTeamBases()
+			if numBases==len(cfg.TEAM0_BASES+cfg.TEAM1_BASES):
+				Log.info("Finding bots")
+				self.stage=FINDING_BOTS
+
+		elif self.stage==FINDING_BOTS:
+			self.createPixelbots() # only creates new bots
+			if len(self.pixelbots)==cfg.NUM_BOTS:
+				if cfg.DEPLOY_ON_START:
+					self.deployer.deploy(self.pixelbots)
+				Log.info("Homing bots")
+				self.assignHomeBases()
+				self.stage=HOMING_BOTS
+
+		elif self.stage==HOMING_BOTS:
+			self.updatePixelbots()
+			self.updateProximity()
+			if cfg.USE_FLOW_FIELD:
+				self.updateNavigator(toBall=False)
+			# allBotsHomed() sends the bots which aren't home yet
+			if self.allBotsHomed():
+				Log.info("All bots home",seconds=time.time()-self.homingStarted,estimate=self.homingEstimate)
+				# as soon as the ball appears it's game on
+				Log.info("Facing opponents")
+				self.stage=FACE_OPPONENTS
+
+		elif self.stage==FACE_OPPONENTS:
+			self.updatePixelbots()
+			self.updateProximity()
+			self.faceTheOpponents()
+			self.stage=WAITING_FOR_BALL
+
+		elif self.stage==WAITING_FOR_BALL:
+			ballX,ballY=self.ballPos
+			if ballX is not None:
+				Log.info("Got a ball. Playing game")
+				self.ballAppeared=self.detector.getCaptureTime() or time.monotonic()
+				self.stage=PLAYING_GAME
+
+		elif self.stage==PLAYING_GAME:
+			self.updatePixelbots()
+			self.updateProximity()
+			if cfg.USE_FLOW_FIELD:
+				self.updateNavigator(toBall=True)
+			self.chaseTheBall()
+			self.checkBallContact()
+
+			ballX,ballY=self.ballPos
+			if ballX is None:
+				# ball has left the arena
+				Log.info("Waiting for new ball")
+				self.stage=WAITING_FOR_BALL
+
+		self.scheduler.dispatch() # sends what the rate limits allow
+
+		Metrics.loopSeconds.observe(time.perf_counter()-loopStart,self.name,loopStage)
+		return True
+
+	def report(self)->None:
+		Log.info("Arena stopped")
+		self.scheduler.report()
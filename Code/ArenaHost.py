@@ -0,0 +1,220 @@
+# ArenaHost.py
+#
+# runs several arenas (pitches) in one process
+#
+# python ArenaHost.py pitch1.json pitch2.json [--synthetic] [--seconds N]
+#
+# each arena file holds the config.ARENA_SCOPED settings of one pitch (teams,
+# bases, pairings, CAMERA_NUM, TOPIC_NAMESPACE). Every other setting is shared
+# and comes from ARENA_CONFIG as for ArenaManager. --synthetic gives each arena
+# a SyntheticArena camera instead of a pi camera
+#
+# the arenas share
+#   a worker pool    ARENA_WORKERS threads run the arena ticks. OpenCV releases
+#                    the GIL so the detection of several arenas runs on all cores
+#   one broker link  pixelbotClass.sharedClient, each bot's data topic is routed
+#                    to the bot with message_callback_add
+#
+# fairness: an arena has at most one tick in flight. When more arenas are ready
+# than there are free workers the arena which has used the least CPU time
+# recently goes first, so a busy pitch can't starve a quiet one
+#
+# CPU accounting: thread_time() around each tick, waiting for the camera is not
+# counted. Exported per arena in /metrics and printed when the host stops
+
+import Startup
+from Startup import timeline
+import os
+import config
+from config import settings
+
+# file overrides must be applied before the other modules read their defaults
+CONFIG_FILE=os.environ.get("ARENA_CONFIG","arena.json")
+if os.path.exists(CONFIG_FILE):
+	config.loadSettings(CONFIG_FILE)
+	config.watchSettings(CONFIG_FILE) # tuning values are hot reloaded
+timeline.mark("config loaded")
+
+import argparse
+import importlib
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+
+from VideoDetectorLib import arucoDetector
+import pixelbotClass
+import SyntheticArena
+import Metrics
+import Log
+from Arena import arena,STAGE_NAMES
+
+CPU_DECAY=0.9 # applied to every arena's recent CPU time after each tick
+
+
+class arenaHost:
+
+	def __init__(self,arenas:list,workers:int=None):
+		self.arenas=arenas
+		self.workers=workers or settings.ARENA_WORKERS or os.cpu_count()
+		self.pool=ThreadPoolExecutor(max_workers=self.workers,thread_name_prefix="arena")
+		self.stopping=False
+		self.onTick=None # onTick(arena) is called in the host thread after each tick
+
+		self.cpuRecent={game.name:0.0 for game in arenas} # decayed CPU seconds, used to pick who goes next
+		self.cpuTotal={game.name:0.0 for game in arenas}
+		self.ticks={game.name:0 for game in arenas}
+		self.started=None
+
+		for game in arenas:
+			Metrics.addCollector(game.collectMetrics) # stage, scale and bot busy gauges
+
+	def _tick(self,game)->tuple:
+		"""
+		runs in a worker, returns running,CPU seconds
+		"""
+		cpuStart=time.thread_time()
+		running=game.tick()
+		return running,time.thread_time()-cpuStart
+
+	def _account(self,game,cpu:float)->None:
+		name=game.name
+		# every arena's history fades at the same pace, whoever ran
+		for other in self.cpuRecent:
+			self.cpuRecent[other]*=CPU_DECAY
+		self.cpuRecent[name]+=cpu
+		self.cpuTotal[name]+=cpu
+		self.ticks[name]+=1
+		Metrics.arenaCpuSeconds.add(cpu,name)
+		Metrics.arenaTicks.inc(name)
+
+	def run(self,seconds:float=None)->None:
+		"""
+		tick the arenas till they have all stopped, stop() is called or
+		seconds have passed
+		"""
+		self.started=time.monotonic()
+		ready={game:self.started for game in self.arenas} # arena->time it became ready
+		inflight={} # future->arena
+
+		while ready or inflight:
+			if seconds is not None and time.monotonic()-self.started>=seconds:
+				self.stop()
+			if self.stopping:
+				ready.clear()
+
+			# fill the free workers, least recent CPU first
+			now=time.monotonic()
+			for game in sorted(ready,key=lambda game: self.cpuRecent[game.name]):
+				if len(inflight)>=self.workers:
+					break
+				Metrics.arenaWaitSeconds.observe(now-ready.pop(game),game.name)
+				inflight[self.pool.submit(self._tick,game)]=game
+
+			if not inflight:
+				continue
+			done,_=wait(inflight,timeout=1,return_when=FIRST_COMPLETED)
+			for future in done:
+				game=inflight.pop(future)
+				try:
+					running,cpu=future.result()
+				except Exception:
+					# the other arenas carry on
+					Log.exception("Arena stopped by exception",arena=game.name)
+					game.stop()
+					continue
+				self._account(game,cpu)
+				if self.onTick is not None:
+					self.onTick(game)
+				if running and not self.stopping:
+					ready[game]=time.monotonic()
+
+		self.pool.shutdown()
+
+	def stop(self)->None:
+		"""
+		the arenas finish their current tick then stop
+		"""
+		self.stopping=True
+
+	def report(self)->None:
+		elapsed=time.monotonic()-self.started if self.started is not None else 0
+		Log.info("Arena host",arenas=len(self.arenas),workers=self.workers,seconds=elapsed)
+		for game in self.arenas:
+			name=game.name
+			ticks=self.ticks[name]
+			cpu=self.cpuTotal[name]
+			rate=ticks/elapsed if elapsed else 0
+			perTick=cpu/ticks*1000 if ticks else 0
+			Log.bind(arena=name) # game.report() logs under it too
+			Log.info("Arena usage",stage=STAGE_NAMES[game.stage],ticks=ticks,ticksPerS=rate,cpuS=cpu,msPerTick=perTick)
+			game.report()
+
+
+def checkArenas(arenaSettings:dict,synthetic:bool)->None:
+	"""
+	raises ValueError if two arenas share a bot, a topic namespace or a camera
+	"""
+	seen={"bot":{},"namespace":{},"camera":{}}
+	for name,(cfg,idTables) in arenaSettings.items():
+		claims=[("bot",botId) for botId in idTables.allBots]
+		claims.append(("namespace",cfg.TOPIC_NAMESPACE))
+		if not synthetic:
+			claims.append(("camera",cfg.CAMERA_NUM))
+		for kind,value in claims:
+			other=seen[kind].setdefault(value,name)
+			if other!=name:
+				raise ValueError(f"arenas {other} and {name} both use {kind} {value!r}")
+
+
+def _makeDetector(name:str,cfg,idTables,synthetic:bool):
+	width,height=settings.VIDEO_WIDTH,settings.VIDEO_HEIGHT
+	if synthetic:
+		# INITIAL_SCALE_FACTOR was measured at 1920 wide
+		camera=SyntheticArena.syntheticCamera(width,height,settings.INITIAL_SCALE_FACTOR*width/1920,cfg=cfg)
+		return arucoDetector(width,height,camera=camera,idTables=idTables,name=name)
+	return arucoDetector(width,height,cameraNum=cfg.CAMERA_NUM,idTables=idTables,name=name)
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="run several arenas in one process")
+	parser.add_argument("arenas",nargs="+",help="arena settings files, one per pitch")
+	parser.add_argument("--synthetic",action="store_true",help="use synthetic cameras")
+	parser.add_argument("--seconds",type=float,help="stop after this long")
+	parser.add_argument("--workers",type=int,help="worker threads, defaults to settings.ARENA_WORKERS")
+	args=parser.parse_args()
+	Log.dumpOnCrash()
+
+	arenaSettings={os.path.splitext(os.path.basename(path))[0]:config.loadArenaSettings(path) for path in args.arenas}
+	checkArenas(arenaSettings,args.synthetic)
+
+	# the cameras warm up while the broker connects
+	startupTasks={f"camera {name}":(lambda name=name,cfg=cfg,idTables=idTables: _makeDetector(name,cfg,idTables,args.synthetic))
+		for name,(cfg,idTables) in arenaSettings.items()}
+	startupTasks["mqtt"]=pixelbotClass.sharedClient
+	if settings.STREAMING:
+		startupTasks["flask"]=lambda: importlib.import_module("FlaskVideo")
+	startupResults=Startup.runParallel(startupTasks)
+
+	broker=startupResults["mqtt"]
+	arenas=[arena(startupResults[f"camera {name}"],name,cfg,idTables,broker) for name,(cfg,idTables) in arenaSettings.items()]
+	host=arenaHost(arenas,args.workers)
+
+	if settings.STREAMING:
+		# the video and /state feeds show the first arena
+		FlaskVideo=startupResults["flask"]
+		FlaskVideo.videoDetector=arenas[0].detector
+		def _publishFirst(game):
+			if game is arenas[0] and FlaskVideo.stateListeners:
+				state=game.snapshot()
+				FlaskVideo.publishState(state["frame"],state)
+		host.onTick=_publishFirst
+		FlaskVideo.serve()
+
+	Log.info("Hosting",arenas=",".join(game.name for game in arenas),workers=host.workers)
+	# ctrl-c lets every arena finish its tick
+	signal.signal(signal.SIGINT,lambda signum,frame: host.stop())
+	host.run(args.seconds)
+	host.report()
+	broker.stop()
+	Log.stop()
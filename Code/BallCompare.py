@@ -0,0 +1,157 @@
+# BallCompare.py
+#
+# precision, recall and per frame cost of the ball detection engines
+#
+# python BallCompare.py                              synthetic frames at every VIDEO_RES
+# python BallCompare.py --clip game.mp4 --labels game.json
+# python BallCompare.py --frames some/dir --labels labels.json
+#
+# synthetic frames have a textured floor with coloured clutter, a ball whose
+# hue, saturation, brightness, shading and blur vary, overall lighting changes
+# and no ball in some frames so false detections show up. They are still no
+# substitute for footage of the real arena, choose BALL_ENGINE from a recorded
+# clip or frames. Recorded clips need a labels JSON file of
+# frame (index or filename) -> [cx,cy] or null when there is no ball;
+# without labels only the found rate and cost are reported
+#
+# a detection counts if it is within half a ball radius of the label
+
+import argparse
+import json
+import os
+import random
+import time
+
+import cv2
+import numpy as np
+
+from config import settings
+import BallDetectors
+import SyntheticArena
+
+
+def syntheticFrames(width:int,height:int,scale_px_per_mm:float,count:int)->list:
+	"""
+	returns a list of (bgr,ball) where ball is (cx,cy) or None
+	"""
+	rnd=random.Random(0)
+	frames=[]
+	for seed in range(count):
+		markers,ball=SyntheticArena.randomLayout(width,height,scale_px_per_mm,seed=seed,withBall=seed%4!=3)
+		frame,_=SyntheticArena.renderArena(width,height,scale_px_per_mm,markers,ball,seed=seed,varied=True)
+		# lighting changes between frames
+		gain=rnd.uniform(0.6,1.2)
+		frame=cv2.convertScaleAbs(frame,alpha=gain)
+		frames.append((frame,ball))
+	return frames
+
+
+def clipFrames(path:str,labels:dict=None)->list:
+	"""
+	frames of a video file, labels keyed by frame index
+	"""
+	frames=[]
+	cap=cv2.VideoCapture(path)
+	index=0
+	while True:
+		ok,frame=cap.read()
+		if not ok:
+			break
+		frames.append((frame,_label(labels,str(index))))
+		index+=1
+	cap.release()
+	return frames
+
+
+def folderFrames(folder:str,labels:dict=None)->list:
+	frames=[]
+	for name in sorted(os.listdir(folder)):
+		frame=cv2.imread(os.path.join(folder,name))
+		if frame is not None:
+			frames.append((frame,_label(labels,name)))
+	return frames
+
+
+def _label(labels:dict,key:str):
+	"""
+	returns (cx,cy), None for no ball or False if the frame isn't labelled
+	"""
+	if labels is None or key not in labels:
+		return False
+	return None if labels[key] is None else tuple(labels[key])
+
+
+def _run(frames:list,scale_px_per_mm:float)->dict:
+	"""
+	returns engine->(median ms,precision,recall,found rate)
+	precision and recall are None without labels
+	"""
+	hitDistance=settings.BALL_DIA_MM*scale_px_per_mm/4 # half the radius
+	summary={}
+	for name,engine in BallDetectors.ENGINES.items():
+		times=[]
+		truePos=falsePos=falseNeg=found=0
+		for frame,ball in frames:
+			gray=cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY)
+			start=time.perf_counter()
+			res=engine(frame,gray,scale_px_per_mm,settings.BALL_TOLERANCE)
+			times.append((time.perf_counter()-start)*1000)
+
+			if res is not None:
+				found+=1
+			if ball is False:
+				continue
+			if res is None:
+				falseNeg+=ball is not None
+			elif ball is not None and np.hypot(res[0]-ball[0],res[1]-ball[1])<=hitDistance:
+				truePos+=1
+			else:
+				falsePos+=1
+				falseNeg+=ball is not None
+
+		labelled=any(ball is not False for _,ball in frames)
+		precision=truePos/(truePos+falsePos) if labelled and truePos+falsePos else None
+		recall=truePos/(truePos+falseNeg) if labelled and truePos+falseNeg else None
+		summary[name]=(float(np.median(times)),precision,recall,found/len(frames))
+	return summary
+
+
+def _pct(value)->str:
+	return "    -" if value is None else f"{value*100:5.1f}%"
+
+
+def _report(title:str,summary:dict)->None:
+	print(title,flush=True)
+	for name,(ms,precision,recall,foundRate) in summary.items():
+		print(f"  {name:8s} {ms:8.2f} ms  precision {_pct(precision)}  recall {_pct(recall)}  found {foundRate*100:5.1f}%",flush=True)
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="compare the ball detection engines")
+	parser.add_argument("--clip",help="recorded video file")
+	parser.add_argument("--frames",help="folder of recorded frames")
+	parser.add_argument("--labels",help="JSON of frame index or filename -> [cx,cy] or null")
+	parser.add_argument("--scale",type=float,help="pixels per mm, defaults to a value matching the frame width")
+	parser.add_argument("--count",type=int,default=20,help="synthetic frames per resolution")
+	args=parser.parse_args()
+
+	labels=None
+	if args.labels:
+		with open(args.labels,"r") as f:
+			labels=json.load(f)
+
+	if args.clip or args.frames:
+		frames=clipFrames(args.clip,labels) if args.clip else folderFrames(args.frames,labels)
+		if not frames:
+			print(f"No frames found in {args.clip or args.frames}",flush=True)
+		else:
+			scale=args.scale or settings.INITIAL_SCALE_FACTOR*frames[0][0].shape[1]/1920
+			_report(f"{args.clip or args.frames} ({len(frames)} frames)",_run(frames,scale))
+	else:
+		for width,height in settings.VIDEO_RES:
+			# INITIAL_SCALE_FACTOR was measured at 1920 wide
+			scale=args.scale or settings.INITIAL_SCALE_FACTOR*width/1920
+			frames=syntheticFrames(width,height,scale,args.count)
+			_report(f"synthetic {width}x{height} scale {scale:.2f} px/mm",_run(frames,scale))
+		print("Synthetic frames only, use --clip or --frames of the real arena to choose BALL_ENGINE",flush=True)
@@ -0,0 +1,159 @@
+# BallDetectors.py
+#
+# ball detection engines for arucoDetector, chosen with settings.BALL_ENGINE
+#
+# an engine is a function
+#
+#   engine(frame,gray,scale_px_per_mm,radiusTolerance) -> (cx,cy,radius) or None
+#
+# frame is BGR, gray its grey scale copy. Positions and radius are in frame
+# pixels. The expected radius is BALL_DIA_MM/2 scaled by scale_px_per_mm,
+# radiusTolerance is the fraction either side of it which is accepted
+#
+# with the YUV420 capture format grey engines get frame None and the
+# COLOUR_ENGINES get the display sized colour frame (and a matching scale)
+# with gray None
+#
+# "hough"   medianBlur + HoughCircles (the original detector)
+# "contour" Canny edges + contours checked by vertex count, aspect and radius
+# "hsv"     colour threshold + connected components on a downscaled frame,
+#           blobs checked by area, aspect and fill (circularity)
+
+import math
+
+import cv2
+import numpy as np
+
+from config import settings
+import MiscLib
+
+
+def _radiusBand(scale_px_per_mm:float,radiusTolerance:float)->tuple:
+	"""
+	returns expected,min,max ball radius in pixels
+	"""
+	expected=settings.BALL_DIA_MM*scale_px_per_mm/2 # scale may change if camera moves
+	minRadius,maxRadius=MiscLib.min_max(expected,radiusTolerance)
+	return expected,minRadius,maxRadius
+
+
+def houghEngine(frame,gray,scale_px_per_mm:float,radiusTolerance:float):
+	"""
+	strongest HoughCircles circle in the radius band
+	"""
+	_,minRadius,maxRadius=_radiusBand(scale_px_per_mm,radiusTolerance)
+	blurred=cv2.medianBlur(gray,5)
+	rows=blurred.shape[0]
+	circles=cv2.HoughCircles(blurred,cv2.HOUGH_GRADIENT,1,rows/8,param1=100,param2=30,minRadius=int(minRadius),maxRadius=int(maxRadius))
+	if circles is None:
+		return None
+	x,y,radius=circles[0][0]
+	return float(x),float(y),float(radius)
+
+
+def contourEngine(frame,gray,scale_px_per_mm:float,radiusTolerance:float):
+	"""
+	outer contours of the edge image which look like a circle of the right size
+	"""
+	_,minRadius,maxRadius=_radiusBand(scale_px_per_mm,radiusTolerance)
+	edges=cv2.Canny(cv2.GaussianBlur(gray,(5,5),0),50,150)
+	edges=cv2.dilate(edges,None)
+	contours,_=cv2.findContours(edges,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+
+	for contour in contours:
+		# more approx vertices means more likely to be a circle
+		# hexagon has 6
+		approx=cv2.approxPolyDP(contour,0.01*cv2.arcLength(contour,True),True)
+		if len(approx)<=10: # bigger than a nonogon
+			continue
+
+		# the aspect ratio of a circle is 1.0 exactly viewed square on
+		_,_,w,h=cv2.boundingRect(contour)
+		if not 0.9<=w/h<=1.1:
+			continue
+
+		# the dilated edge sits a pixel outside the ball
+		(x,y),radius=cv2.minEnclosingCircle(contour)
+		radius-=1
+		if minRadius<radius<maxRadius:
+			return float(x),float(y),float(radius)
+	return None
+
+
+def pickBallDownscale(expectedRadius:float)->int:
+	"""
+	largest power of two (up to BALL_MAX_DOWNSCALE) which keeps the
+	ball radius at least BALL_MIN_PX pixels
+	"""
+	factor=1
+	while factor*2<=settings.BALL_MAX_DOWNSCALE and expectedRadius/(factor*2)>=settings.BALL_MIN_PX:
+		factor*=2
+	return factor
+
+
+def hsvEngine(frame,gray,scale_px_per_mm:float,radiusTolerance:float):
+	"""
+	pixels in the BALL_HSV_LOW..BALL_HSV_HIGH range are grouped with
+	connectedComponentsWithStats on a downscaled frame. The blob whose
+	area, aspect and fill best match a circle in the radius band wins
+	"""
+	expected,minRadius,maxRadius=_radiusBand(scale_px_per_mm,radiusTolerance)
+	factor=pickBallDownscale(expected)
+	small=frame
+	if factor>1:
+		small=cv2.resize(frame,(frame.shape[1]//factor,frame.shape[0]//factor),interpolation=cv2.INTER_AREA)
+
+	hsv=cv2.cvtColor(small,cv2.COLOR_BGR2HSV)
+	mask=cv2.inRange(hsv,np.array(settings.BALL_HSV_LOW,dtype=np.uint8),np.array(settings.BALL_HSV_HIGH,dtype=np.uint8))
+	count,_,stats,centroids=cv2.connectedComponentsWithStats(mask,connectivity=8)
+
+	# a pixel at the coarse level is factor full res pixels, allow for that
+	slack=factor/expected
+	minRadius=min(minRadius,expected*(1-slack))
+	maxRadius=max(maxRadius,expected*(1+slack))
+	minArea=math.pi*(minRadius/factor)**2
+	maxArea=math.pi*(maxRadius/factor)**2
+
+	best=None
+	for label in range(1,count): # 0 is the background
+		x,y,w,h,area=stats[label]
+		if not minArea<=area<=maxArea:
+			continue
+		if not 0.8<=w/h<=1.25:
+			continue
+		# a filled circle covers pi/4 of its bounding box
+		fill=area/(w*h)
+		if fill<settings.BALL_MIN_FILL:
+			continue
+		error=abs(fill-math.pi/4)
+		if best is None or error<best[0]:
+			best=(error,label,area)
+
+	if best is None:
+		return None
+	_,label,area=best
+	cx,cy=centroids[label]
+	radius=math.sqrt(area/math.pi)*factor
+	# centroids are in coarse pixel centres
+	return float((cx+0.5)*factor-0.5),float((cy+0.5)*factor-0.5),float(radius)
+
+
+# engines which need the colour frame
+COLOUR_ENGINES={"hsv"}
+
+ENGINES={
+	"hough":houghEngine,
+	"contour":contourEngine,
+	"hsv":hsvEngine
+}
+
+
+def getEngine(name:str=None):
+	"""
+	name None follows settings.BALL_ENGINE
+	"""
+	name=name or settings.BALL_ENGINE
+	try:
+		return ENGINES[name]
+	except KeyError:
+		raise ValueError(f"unknown ball engine {name}, choose from {sorted(ENGINES)}")
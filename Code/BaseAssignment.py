@@ -0,0 +1,79 @@
+# BaseAssignment.py
+#
+# pairs bots with home bases so the fleet gets home as quickly as possible
+#
+# each team is solved separately with the Hungarian algorithm
+# (scipy linear_sum_assignment) over a cost matrix of estimated homing times
+
+import numpy as np
+
+from config import settings
+import MiscLib
+
+
+def homingTime(cx:int,cy:int,heading:int,baseX:int,baseY:int,scale_px_per_mm:float)->float:
+	"""
+	estimated seconds for a bot at cx,cy,heading to turn towards and
+	drive to a base at baseX,baseY (all in pixels)
+	"""
+	distPX=MiscLib.getHypotenuse(cx,cy,baseX,baseY)
+	if round(distPX)==0:
+		return 0.0 # already there
+	course,_=MiscLib.getHeadingAndRange(cx,cy,baseX,baseY)
+	turn=abs(MiscLib.getCourseChange(course,heading))
+	distMM=distPX/scale_px_per_mm
+	return distMM/settings.BOT_SPEED_MM_S+turn/settings.BOT_TURN_DEG_S
+
+
+def staticAssignment(bots:dict,bases:dict,scale_px_per_mm:float,cfg=settings)->tuple:
+	"""
+	the fixed settings.PAIRINGS with their estimated homing times
+	cfg is the arena's settings
+
+	returns pairings (botId->baseId), estimates (botId->seconds)
+	"""
+	pairings={}
+	estimates={}
+	for botId,(cx,cy,heading) in bots.items():
+		baseId=cfg.PAIRINGS.get(botId)
+		if baseId is None or baseId not in bases:
+			continue
+		baseX,baseY=bases[baseId]
+		pairings[botId]=baseId
+		estimates[botId]=homingTime(cx,cy,heading,baseX,baseY,scale_px_per_mm)
+	return pairings,estimates
+
+
+def optimalAssignment(bots:dict,bases:dict,scale_px_per_mm:float,cfg=settings)->tuple:
+	"""
+	bots: botId->(cx,cy,heading)
+	bases: baseId->(cx,cy) the free bases
+
+	bots only go to bases belonging to their own team, cfg is the arena's settings
+
+	returns pairings (botId->baseId), estimates (botId->seconds)
+	"""
+	from scipy.optimize import linear_sum_assignment # slow to import, only needed here
+	
+	pairings={}
+	estimates={}
+	for teamBots,teamBases in ((cfg.TEAM0_BOTS,cfg.TEAM0_BASES),(cfg.TEAM1_BOTS,cfg.TEAM1_BASES)):
+		botIds=[botId for botId in teamBots if botId in bots]
+		baseIds=[baseId for baseId in teamBases if baseId in bases]
+		if not botIds or not baseIds:
+			continue
+
+		cost=np.empty((len(botIds),len(baseIds)))
+		for r,botId in enumerate(botIds):
+			cx,cy,heading=bots[botId]
+			for c,baseId in enumerate(baseIds):
+				baseX,baseY=bases[baseId]
+				cost[r,c]=homingTime(cx,cy,heading,baseX,baseY,scale_px_per_mm)
+
+		# rectangular is fine, surplus bots or bases are left out
+		rows,cols=linear_sum_assignment(cost)
+		for r,c in zip(rows,cols):
+			pairings[botIds[r]]=baseIds[c]
+			estimates[botIds[r]]=float(cost[r,c])
+
+	return pairings,estimates
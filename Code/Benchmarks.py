@@ -0,0 +1,212 @@
+# Benchmarks.py
+#
+# times the hot paths without a camera or broker
+#
+# python Benchmarks.py --out results.json
+# python Benchmarks.py --out new.json --baseline results.json --threshold 0.25
+#
+# frames are rendered by SyntheticArena at each settings.VIDEO_RES (or read from
+# --frames). With --baseline the run fails (exit code 1) if any benchmark's
+# median is more than threshold slower than the baseline. Per benchmark
+# thresholds can be given in a JSON file with --thresholds {"name":0.5}
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import settings,lookups
+import MiscLib
+import SyntheticArena
+from VideoDetectorLib import arucoDetector
+
+DEFAULT_THRESHOLD=0.25 # 25% slower than the baseline fails
+
+
+def timeIt(fn,iterations:int,warmup:int=2)->dict:
+	"""
+	returns median and 90th percentile milliseconds of fn()
+	"""
+	for _ in range(warmup):
+		fn()
+	times=[]
+	for _ in range(iterations):
+		start=time.perf_counter()
+		fn()
+		times.append((time.perf_counter()-start)*1000)
+	times.sort()
+	return {
+		"median_ms":round(statistics.median(times),4),
+		"p90_ms":round(times[int(len(times)*0.9)-1 if len(times)>1 else 0],4),
+		"iterations":iterations
+	}
+
+
+class _fakeInfo:
+	def wait_for_publish(self,timeout=None):
+		pass
+	def is_published(self):
+		return True
+
+
+class _fakeClient:
+	"""
+	paho client stand in, publishes go nowhere
+	"""
+	def __init__(self):
+		self.connected_flag=True
+		self.published=0
+	def subscribe(self,topic,qos=0):
+		pass
+	def publish(self,topic,payload,qos=0,retain=False):
+		self.published+=1
+		return _fakeInfo()
+	def loop_stop(self):
+		pass
+
+
+def _detectorFor(width:int,height:int,frames:list=None,format:str=None)->arucoDetector:
+	scale=settings.INITIAL_SCALE_FACTOR*width/1920 # INITIAL_SCALE_FACTOR was measured at 1920 wide
+	camera=SyntheticArena.syntheticCamera(width,height,scale,format=format)
+	if frames:
+		camera.setFrames([cv2.resize(f,(width,height)) for f in frames])
+	detector=arucoDetector(width,height,camera=camera)
+	detector.scale_px_per_mm=scale
+	return detector
+
+
+def benchDetection(iterations:int,frames:list=None)->dict:
+	results={}
+	for width,height in settings.VIDEO_RES:
+		detector=_detectorFor(width,height,frames)
+		res=f"{width}x{height}"
+
+		results[f"grabFrame_{res}"]=timeIt(detector._grabFrame,iterations)
+		# detection straight off the Y plane, no copy or grey conversion
+		results[f"grabFrameLuma_{res}"]=timeIt(_detectorFor(width,height,frames,"YUV420")._grabFrame,iterations)
+
+		# the rest work on the markers of the last grabbed frame
+		detector._grabFrame()
+		results[f"findTheBall_{res}"]=timeIt(detector._findTheBall,iterations)
+
+		markerIds=list(detector.markers.keys())
+		def markerInfo():
+			for markerId in markerIds:
+				detector._getMarkerInfo(markerId)
+		results[f"getMarkerInfo_{res}"]=timeIt(markerInfo,iterations*10)
+
+		import FlaskVideo
+		frame=detector.getFrame()
+		results[f"streamResize_{res}"]=timeIt(lambda: FlaskVideo._resizeFrame(frame),iterations)
+		small=FlaskVideo._resizeFrame(frame)
+		results[f"streamEncode_{res}"]=timeIt(lambda: FlaskVideo._encodeFrame(small),iterations)
+
+		detector.cam.stop()
+	return results
+
+
+def benchGeometry(iterations:int)->dict:
+	results={}
+	rng=np.random.default_rng(0)
+	for bots in (8,64):
+		cx,cy,tx,ty=(rng.integers(0,1920,bots) for _ in range(4))
+		heading=rng.integers(0,360,bots)
+		points=list(zip(cx.tolist(),cy.tolist(),tx.tolist(),ty.tolist(),heading.tolist()))
+
+		def scalar():
+			for x,y,X,Y,h in points:
+				course,dist=MiscLib.getHeadingAndRange(x,y,X,Y)
+				MiscLib.getCourseChange(course,h)
+
+		def vectorised():
+			courses,dists=MiscLib.getHeadingsAndRanges(cx,cy,tx,ty)
+			MiscLib.getCourseChanges(courses,heading)
+
+		results[f"geometryScalar_{bots}"]=timeIt(scalar,iterations*10)
+		results[f"geometryVector_{bots}"]=timeIt(vectorised,iterations*10)
+	return results
+
+
+def benchMessaging(iterations:int)->dict:
+	import pixelbotClass
+
+	botId=lookups.allBots[0]
+	name,addr=lookups.addrByBot[botId]
+	pixelbotClass.preconnected[addr]=_fakeClient()
+	bot=pixelbotClass.pixelbot(botId,0,0,0,100,100)
+	Vars={"angle":45,"dist":100}
+	return {"updateVariables":timeIt(lambda: bot.updateVariables(Vars),iterations*10)}
+
+
+def compare(results:dict,baseline:dict,threshold:float,thresholds:dict)->list:
+	"""
+	returns a list of (name,baseline ms,new ms,allowed ratio) that regressed
+	"""
+	regressions=[]
+	for name,res in results.items():
+		old=baseline.get(name)
+		if old is None:
+			continue
+		allowed=1+thresholds.get(name,threshold)
+		if res["median_ms"]>old["median_ms"]*allowed:
+			regressions.append((name,old["median_ms"],res["median_ms"],allowed))
+	return regressions
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="arena hot path benchmarks")
+	parser.add_argument("--out",default="bench_results.json",help="save results here")
+	parser.add_argument("--baseline",help="results of an earlier run to compare against")
+	parser.add_argument("--threshold",type=float,default=DEFAULT_THRESHOLD,help="allowed slow down e.g. 0.25 for 25%%")
+	parser.add_argument("--thresholds",help="JSON file of per benchmark thresholds")
+	parser.add_argument("--frames",help="folder of recorded frames to use instead of synthetic ones")
+	parser.add_argument("--iterations",type=int,default=20)
+	args=parser.parse_args()
+
+	frames=None
+	if args.frames:
+		from DetectionCompare import recordedFrames
+		frames=[cv2.cvtColor(gray,cv2.COLOR_GRAY2BGR) for gray,_ in recordedFrames(args.frames)]
+
+	results={}
+	results.update(benchDetection(args.iterations,frames))
+	results.update(benchGeometry(args.iterations))
+	results.update(benchMessaging(args.iterations))
+
+	for name,res in results.items():
+		print(f"{name:32s} median {res['median_ms']:9.3f} ms  p90 {res['p90_ms']:9.3f} ms",flush=True)
+
+	report={
+		"meta":{
+			"time":time.strftime("%Y-%m-%d %H:%M:%S"),
+			"python":platform.python_version(),
+			"opencv":cv2.__version__,
+			"numpy":np.__version__,
+			"machine":platform.machine(),
+			"frames":args.frames or "synthetic"
+		},
+		"results":results
+	}
+	with open(args.out,"w") as f:
+		json.dump(report,f,indent=1)
+	print(f"Results saved to {args.out}",flush=True)
+
+	if args.baseline:
+		with open(args.baseline,"r") as f:
+			baseline=json.load(f)["results"]
+		thresholds={}
+		if args.thresholds:
+			with open(args.thresholds,"r") as f:
+				thresholds=json.load(f)
+		regressions=compare(results,baseline,args.threshold,thresholds)
+		for name,old,new,allowed in regressions:
+			print(f"REGRESSION {name} {old:.3f} ms -> {new:.3f} ms (allowed x{allowed:.2f})",flush=True)
+		if regressions:
+			sys.exit(1)
+		print(f"No regressions against {args.baseline}",flush=True)
@@ -0,0 +1,147 @@
+# CommandScheduler.py
+#
+# sits between the game logic and MQTT so bot traffic follows useful motion
+# rather than the loop rate
+#
+# game logic submit()s a move for a bot as often as it likes, dispatch() is
+# called once per loop and decides what is actually sent
+#
+#   deadband   moves smaller than CMD_DEADBAND_MM/CMD_DEADBAND_DEG are dropped,
+#              so is a repeat of the last move to the same target within CMD_REPEAT_S
+#   coalesce   only the latest pending move per bot is kept
+#   priority   urgent moves (chasing the ball) go before homing moves
+#   rate       a token bucket per bot (CMD_RATE_HZ, CMD_BURST) and at most
+#              CMD_MAX_PER_TICK sends per loop, the rest wait for later loops
+#   check      an optional hook can hold a move or change it just before it's
+#              sent, e.g. shorten it to avoid a collision
+
+import itertools
+import time
+
+from config import settings
+import Metrics
+import Log
+
+PRIORITY_URGENT=0
+PRIORITY_NORMAL=1
+PRIORITY_LOW=2
+
+
+class commandScheduler:
+
+	def __init__(self,send,check=None):
+		"""
+		send(botId,Vars) actually sends a move, e.g. marks the bot busy and
+		calls pixelbot.updateVariables()
+		
+		check(botId,Vars) returns the Vars to send (possibly changed) or
+		None to hold the move
+		"""
+		self.send=send
+		self.check=check
+		self.pending={} # botId->(priority,order,Vars,target)
+		self.buckets={} # botId->[tokens,last refill]
+		self.lastSent={} # botId->(target,Vars,time)
+		self.order=itertools.count()
+		self.stats={"submitted":0,"sent":0,"suppressed":0,"coalesced":0,"deferred":0,"held":0,"changed":0}
+
+	def _count(self,result:str)->None:
+		self.stats[result]+=1
+		Metrics.commands.inc(result)
+
+	def _inDeadband(self,botId,Vars:dict,target,now:float)->bool:
+		"""
+		True for a move too small to bother with, or a repeat of the
+		last move sent (same target, nearly the same turn and distance)
+		"""
+		angle,dist=Vars.get("angle",0),Vars.get("dist",0)
+		if abs(angle)<=settings.CMD_DEADBAND_DEG and abs(dist)<=settings.CMD_DEADBAND_MM:
+			return True
+		last=self.lastSent.get(botId)
+		if last is None:
+			return False
+		lastTarget,lastVars,sentAt=last
+		if now-sentAt>=settings.CMD_REPEAT_S:
+			return False
+		if (target is None)!=(lastTarget is None):
+			return False
+		if target is not None and abs(target[0]-lastTarget[0])+abs(target[1]-lastTarget[1])>settings.CMD_DEADBAND_MM:
+			return False
+		return abs(angle-lastVars.get("angle",0))<=settings.CMD_DEADBAND_DEG and abs(dist-lastVars.get("dist",0))<=settings.CMD_DEADBAND_MM
+
+	def submit(self,botId,Vars:dict,priority:int=PRIORITY_NORMAL,target=None)->bool:
+		"""
+		queue a move, replacing any move still pending for the bot
+
+		target (x,y) mm is what the move heads for, used to drop repeats
+		returns False if the move was dropped by the deadband
+		"""
+		now=time.monotonic()
+		self._count("submitted")
+		if self._inDeadband(botId,Vars,target,now):
+			self._count("suppressed")
+			return False
+		queued=self.pending.get(botId)
+		if queued is not None:
+			# keeps its place in the queue
+			self._count("coalesced")
+			order=queued[1]
+		else:
+			order=next(self.order)
+		self.pending[botId]=(priority,order,Vars,target)
+		return True
+
+	def _takeToken(self,botId,now:float)->bool:
+		bucket=self.buckets.get(botId)
+		if bucket is None:
+			bucket=self.buckets[botId]=[settings.CMD_BURST,now]
+		tokens,last=bucket
+		bucket[0]=min(settings.CMD_BURST,tokens+(now-last)*settings.CMD_RATE_HZ)
+		bucket[1]=now
+		if bucket[0]<1:
+			return False
+		bucket[0]-=1
+		return True
+
+	def cancel(self,botId)->None:
+		self.pending.pop(botId,None)
+
+	def dispatch(self)->int:
+		"""
+		send what the rate limits allow, most urgent and oldest first
+		returns the number sent
+		"""
+		if not self.pending:
+			return 0
+		now=time.monotonic()
+		sent=0
+		for botId,(priority,order,Vars,target) in sorted(self.pending.items(),key=lambda item: item[1][:2]):
+			if sent>=settings.CMD_MAX_PER_TICK:
+				self._count("deferred")
+				continue
+			# take the token first, check() reserves the move's destination
+			# so it must only see moves which are about to be sent
+			if not self._takeToken(botId,now):
+				self._count("deferred")
+				continue
+			if self.check is not None:
+				checked=self.check(botId,Vars)
+				if checked is None:
+					# the game logic resubmits once the way is clear
+					del self.pending[botId]
+					self.buckets[botId][0]+=1 # nothing was sent
+					self._count("held")
+					continue
+				if checked!=Vars:
+					self._count("changed")
+					Vars=checked
+			del self.pending[botId]
+			self.send(botId,Vars)
+			self.lastSent[botId]=(target,Vars,now)
+			self._count("sent")
+			sent+=1
+		return sent
+
+	def report(self)->None:
+		stats=self.stats
+		Log.info("Commands",**stats)
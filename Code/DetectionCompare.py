@@ -0,0 +1,122 @@
+# DetectionCompare.py
+#
+# accuracy and speed comparison of full resolution marker detection against
+# coarse-to-fine (pyramid) detection
+#
+# python DetectionCompare.py                    synthetic frames at every VIDEO_RES
+# python DetectionCompare.py --frames some/dir  recorded frames, full res is the reference
+
+import argparse
+import glob
+import os
+import time
+import cv2
+import numpy as np
+
+from config import settings
+import SyntheticArena
+from VideoDetectorLib import detectMarkersFull,detectMarkersCoarseToFine,pickDownscale
+
+
+def _asDict(corners,ids)->dict:
+	if ids is None:
+		return {}
+	return {int(i[0]):c.reshape(4,2) for i,c in zip(ids,corners)}
+
+
+def _timeIt(fn,*args,repeat:int=3)->tuple:
+	"""
+	returns the result and the best time in ms
+	"""
+	best=None
+	for _ in range(repeat):
+		start=time.perf_counter()
+		res=fn(*args)
+		elapsed=(time.perf_counter()-start)*1000
+		best=elapsed if best is None or elapsed<best else best
+	return res,best
+
+
+def _compare(found:dict,reference:dict)->tuple:
+	"""
+	returns recall and the RMS corner error (pixels) of found against reference
+	"""
+	if not reference:
+		return 1.0,0.0
+	hits=[markerId for markerId in reference if markerId in found]
+	if not hits:
+		return 0.0,float("nan")
+	errors=np.concatenate([found[m]-reference[m] for m in hits])
+	rms=float(np.sqrt(np.mean(np.sum(errors**2,axis=1))))
+	return len(hits)/len(reference),rms
+
+
+def _run(frames,scale_px_per_mm:float)->dict:
+	"""
+	frames is a list of (gray,truth) - truth None means use full res as the reference
+	"""
+	factor=pickDownscale(scale_px_per_mm)
+	stats={"full":[],"pyramid":[]}
+	for gray,truth in frames:
+		full,fullMs=_timeIt(detectMarkersFull,gray)
+		pyramid,pyrMs=_timeIt(detectMarkersCoarseToFine,gray,factor)
+		full=_asDict(*full)
+		pyramid=_asDict(*pyramid)
+		reference=truth if truth is not None else full
+		stats["full"].append((fullMs,)+_compare(full,reference))
+		stats["pyramid"].append((pyrMs,)+_compare(pyramid,reference))
+
+	summary={"factor":factor}
+	for mode,rows in stats.items():
+		ms,recall,rms=zip(*rows)
+		summary[mode]=(float(np.median(ms)),float(np.mean(recall)),float(np.nanmean(rms)))
+	return summary
+
+
+def _report(title:str,summary:dict)->None:
+	full=summary["full"]
+	pyr=summary["pyramid"]
+	print(f"{title}  downscale x{summary['factor']}",flush=True)
+	print(f"  full     {full[0]:8.2f} ms  recall {full[1]*100:5.1f}%  rms {full[2]:.3f} px",flush=True)
+	print(f"  pyramid  {pyr[0]:8.2f} ms  recall {pyr[1]*100:5.1f}%  rms {pyr[2]:.3f} px  speedup {full[0]/pyr[0]:.2f}x",flush=True)
+
+
+def syntheticFrames(width:int,height:int,scale_px_per_mm:float,count:int)->list:
+	frames=[]
+	for seed in range(count):
+		markers,ball=SyntheticArena.randomLayout(width,height,scale_px_per_mm,seed=seed)
+		frame,truth=SyntheticArena.renderArena(width,height,scale_px_per_mm,markers,ball,seed=seed)
+		frames.append((cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY),truth))
+	return frames
+
+
+def recordedFrames(folder:str)->list:
+	frames=[]
+	for path in sorted(glob.glob(os.path.join(folder,"*"))):
+		img=cv2.imread(path,cv2.IMREAD_GRAYSCALE)
+		if img is not None:
+			frames.append((img,None))
+	return frames
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="compare full res and coarse-to-fine marker detection")
+	parser.add_argument("--frames",help="folder of recorded frames (full res detection is the reference)")
+	parser.add_argument("--scale",type=float,help="pixels per mm, defaults to a value matching the frame width")
+	parser.add_argument("--count",type=int,default=10,help="synthetic frames per resolution")
+	args=parser.parse_args()
+
+	if args.frames:
+		frames=recordedFrames(args.frames)
+		if not frames:
+			print(f"No frames found in {args.frames}",flush=True)
+		else:
+			scale=args.scale or settings.INITIAL_SCALE_FACTOR
+			_report(f"{args.frames} ({len(frames)} frames)",_run(frames,scale))
+	else:
+		for width,height in settings.VIDEO_RES:
+			# INITIAL_SCALE_FACTOR was measured at 1920 wide
+			scale=args.scale or settings.INITIAL_SCALE_FACTOR*width/1920
+			frames=syntheticFrames(width,height,scale,args.count)
+			_report(f"synthetic {width}x{height} scale {scale:.2f} px/mm",_run(frames,scale))
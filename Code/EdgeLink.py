@@ -0,0 +1,370 @@
+# EdgeLink.py
+#
+# detection results from an edge node (the pi running EdgeNode.py) to the game
+# logic host (ArenaManager with settings.REMOTE_DETECTOR) over UDP, so the pi's
+# CPU goes to capture and detection only
+#
+# one datagram per message, packed with struct (little endian)
+#
+# DETECTION  edge->host, one per frame
+#   header   magic "AE", version, type, seq, frame number, capture time (edge
+#            monotonic seconds), scale px/mm, processing ms, ball x,y (px),
+#            flags, backoff level, entry count
+#   entry    marker id, role (bot or base), x,y (px), heading (tenths of a degree)
+# PING       host->edge  host send time
+# PONG       edge->host  host send time, edge receive time, edge send time
+# STAGE      host->edge  game stage name, the edge runs its WORKLOADS profile
+#
+# clock offset: NTP style from ping/pong. Of the last LINK_OFFSET_SAMPLES the
+# sample with the shortest round trip is used as it was least delayed by
+# queueing. Capture times are converted to the host clock with it
+#
+# loss: nothing is resent. The host counts gaps in seq, ignores datagrams older
+# than the last frame used and treats the bots and ball as gone when nothing
+# has arrived for LINK_TIMEOUT_S. STAGE goes with every PING so a lost one is
+# put right within LINK_PING_S
+
+import collections
+import socket
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from config import settings
+from FrameExchange import frameExchange
+import Metrics
+import Log
+
+MAGIC=b"AE"
+VERSION=1
+
+DETECTION=1
+PING=2
+PONG=3
+STAGE=4
+
+FLAG_BALL=0x01
+
+ROLE_BOT=0
+ROLE_BASE=1
+
+PREFIX=struct.Struct("<2sBB") # magic, version, type
+DETECTION_HEADER=struct.Struct("<2sBBIIdffhhBBH")
+ENTRY=struct.Struct("<HBhhh")
+PING_MSG=struct.Struct("<2sBBd")
+PONG_MSG=struct.Struct("<2sBBddd")
+
+MAX_DATAGRAM=65507
+
+
+def encodeDetection(seq:int,frameNumber:int,captureTime:float,scale:float,processMs:float,ball,backoff:int,bots:dict,bases:dict)->bytes:
+	"""
+	bots: botId->(cx,cy,heading), bases: baseId->(cx,cy), ball (cx,cy) or (None,None)
+	"""
+	flags=0
+	ballX=ballY=0
+	if ball[0] is not None:
+		flags|=FLAG_BALL
+		ballX,ballY=ball
+	parts=[DETECTION_HEADER.pack(MAGIC,VERSION,DETECTION,seq&0xFFFFFFFF,frameNumber&0xFFFFFFFF,captureTime,
+		scale,processMs,int(ballX),int(ballY),flags,backoff,len(bots)+len(bases))]
+	for botId,(cx,cy,heading) in bots.items():
+		parts.append(ENTRY.pack(botId,ROLE_BOT,int(cx),int(cy),int(round(heading*10))%3600))
+	for baseId,(cx,cy) in bases.items():
+		parts.append(ENTRY.pack(baseId,ROLE_BASE,int(cx),int(cy),0))
+	return b"".join(parts)
+
+
+def decodeDetection(payload:bytes)->dict:
+	magic,version,kind,seq,frameNumber,captureTime,scale,processMs,ballX,ballY,flags,backoff,count=DETECTION_HEADER.unpack_from(payload,0)
+	bots={}
+	bases={}
+	offset=DETECTION_HEADER.size
+	for _ in range(count):
+		markerId,role,cx,cy,heading=ENTRY.unpack_from(payload,offset)
+		offset+=ENTRY.size
+		if role==ROLE_BOT:
+			bots[markerId]=(cx,cy,heading/10)
+		else:
+			bases[markerId]=(cx,cy)
+	return {
+		"seq":seq,
+		"frame":frameNumber,
+		"captureTime":captureTime,
+		"scale":scale,
+		"processMs":processMs,
+		"ball":(ballX,ballY) if flags&FLAG_BALL else (None,None),
+		"backoff":backoff,
+		"bots":bots,
+		"bases":bases
+	}
+
+
+def _kind(payload:bytes):
+	"""
+	message type, None if it isn't one of ours
+	"""
+	if len(payload)<PREFIX.size:
+		return None
+	magic,version,kind=PREFIX.unpack_from(payload,0)
+	if magic!=MAGIC or version!=VERSION:
+		return None
+	return kind
+
+
+class clockOffset:
+	"""
+	edge clock minus host clock from ping/pong exchanges
+	"""
+	def __init__(self,samples:int=None):
+		self.samples=collections.deque(maxlen=samples or settings.LINK_OFFSET_SAMPLES) # (rtt,offset)
+		self.offset=None
+		self.rtt=None
+
+	def add(self,t0:float,t1:float,t2:float,t3:float)->None:
+		"""
+		t0 host send, t1 edge receive, t2 edge send, t3 host receive
+		"""
+		rtt=(t3-t0)-(t2-t1)
+		self.samples.append((rtt,((t1-t0)+(t2-t3))/2))
+		self.rtt,self.offset=min(self.samples)
+
+	def toHost(self,edgeTime:float)->float:
+		"""
+		None till the first pong, the two clocks have nothing in common
+		"""
+		return None if self.offset is None else edgeTime-self.offset
+
+
+class edgeSender:
+	"""
+	edge side: send() after every detector.update()
+
+	stage is the game stage the host last asked for, dropRate throws away
+	that fraction of the detections to try out the loss handling
+	"""
+	def __init__(self,host:str=None,port:int=None,dropRate:float=0):
+		self.addr=(host or settings.LOGIC_HOST,port or settings.LINK_PORT)
+		self.sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+		self.sock.settimeout(0.5)
+		self.seq=0
+		self.stage="default"
+		self.dropRate=dropRate
+		self.dropped=0
+		self.bytesSent=0
+		self.running=True
+		self.receiver=threading.Thread(target=self._receive,name="edgeLink",daemon=True)
+		self.receiver.start()
+
+	def send(self,detector)->None:
+		workload=detector.getWorkload()
+		payload=encodeDetection(self.seq,detector.getFrameNumber(),detector.captureTime,detector.getScale(),
+			workload["processMs"],detector.getBall(),workload["backoff"],detector.getPixelbots(),detector.getHomeBases())
+		self.seq+=1
+		if self.dropRate and np.random.random()<self.dropRate:
+			self.dropped+=1
+			return
+		self.sock.sendto(payload,self.addr)
+		self.bytesSent+=len(payload)
+
+	def _receive(self)->None:
+		while self.running:
+			try:
+				payload,addr=self.sock.recvfrom(MAX_DATAGRAM)
+			except socket.timeout:
+				continue
+			except OSError:
+				return
+			received=time.monotonic()
+			kind=_kind(payload)
+			if kind==PING:
+				_,_,_,t0=PING_MSG.unpack_from(payload,0)
+				self.sock.sendto(PONG_MSG.pack(MAGIC,VERSION,PONG,t0,received,time.monotonic()),addr)
+			elif kind==STAGE:
+				self.stage=payload[PREFIX.size:].decode("utf-8")
+
+	def stop(self)->None:
+		self.running=False
+		self.sock.close()
+
+
+class remoteDetector:
+	"""
+	host side stand in for arucoDetector, fed by an edgeSender
+
+	update() waits for the next detection (up to LINK_TIMEOUT_S). Frames for
+	the video feed are drawn from the detections as there's no video on the link
+	"""
+	def __init__(self,port:int=None,width:int=settings.VIDEO_WIDTH,height:int=settings.VIDEO_HEIGHT):
+		self.sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+		self.sock.bind(("",port or settings.LINK_PORT))
+		self.sock.settimeout(0.5)
+		self.edgeAddr=None # learnt from the first datagram
+		self.clock=clockOffset()
+		self.condition=threading.Condition()
+		self.received=None # latest decoded detection, swapped in by update()
+		self.lastSeq=None
+		self.lastArrival=None
+
+		self.stage="default"
+		self.scale_px_per_mm=settings.INITIAL_SCALE_FACTOR
+		self.frameNumber=0
+		self.captureTime=None # host monotonic clock
+		self.bots={}
+		self.bases={}
+		self.ballPos=(None,None)
+		self.markers={}
+		self.workload={"stage":"default","backoff":0,"processMs":0}
+		self.linked=False
+
+		self.frames=frameExchange((height,width,3))
+
+		self.running=True
+		self.receiver=threading.Thread(target=self._receive,name="edgeLinkReceive",daemon=True)
+		self.receiver.start()
+		self.pinger=threading.Thread(target=self._ping,name="edgeLinkPing",daemon=True)
+		self.pinger.start()
+
+	def _receive(self)->None:
+		while self.running:
+			try:
+				payload,addr=self.sock.recvfrom(MAX_DATAGRAM)
+			except socket.timeout:
+				continue
+			except OSError:
+				return
+			received=time.monotonic()
+			kind=_kind(payload)
+			if kind==DETECTION:
+				self.edgeAddr=addr
+				self._detection(decodeDetection(payload),received)
+			elif kind==PONG:
+				_,_,_,t0,t1,t2=PONG_MSG.unpack_from(payload,0)
+				self.clock.add(t0,t1,t2,received)
+				Metrics.edgeRtt.set(self.clock.rtt)
+				Metrics.edgeClockOffset.set(self.clock.offset)
+
+	def _detection(self,detection:dict,received:float)->None:
+		seq=detection["seq"]
+		with self.condition:
+			if self.lastSeq is not None:
+				gap=(seq-self.lastSeq)&0xFFFFFFFF
+				if gap==0 or gap>=0x80000000:
+					# duplicate or overtaken by a later datagram
+					Metrics.edgeStale.inc()
+					return
+				Metrics.edgeLost.add(gap-1)
+			self.lastSeq=seq
+			self.lastArrival=received
+			detection["arrived"]=received
+			self.received=detection
+			self.condition.notify_all()
+		Metrics.edgeFrames.inc()
+
+	def _ping(self)->None:
+		while self.running:
+			if self.edgeAddr is not None:
+				try:
+					self.sock.sendto(PING_MSG.pack(MAGIC,VERSION,PING,time.monotonic()),self.edgeAddr)
+					self._sendStage()
+				except OSError:
+					pass
+			time.sleep(settings.LINK_PING_S)
+
+	def _sendStage(self)->None:
+		if self.edgeAddr is not None:
+			self.sock.sendto(PREFIX.pack(MAGIC,VERSION,STAGE)+self.stage.encode("utf-8"),self.edgeAddr)
+
+	def update(self)->None:
+		"""
+		take the next detection, the bots and ball are dropped if the
+		edge has gone quiet
+		"""
+		with self.condition:
+			if self.received is None:
+				self.condition.wait(settings.LINK_TIMEOUT_S)
+			detection,self.received=self.received,None
+
+		if detection is None:
+			if self.linked:
+				Log.warning("Edge link lost",seconds=settings.LINK_TIMEOUT_S)
+				self.linked=False
+			self.bots={}
+			self.ballPos=(None,None)
+			self.markers={}
+		else:
+			if not self.linked:
+				Log.info("Edge link up",edge=self.edgeAddr[0])
+				self.linked=True
+			self.frameNumber=detection["frame"]
+			self.captureTime=self.clock.toHost(detection["captureTime"])
+			if self.clock.offset is not None:
+				Metrics.edgeLatency.observe(detection["arrived"]-self.captureTime)
+			self.scale_px_per_mm=detection["scale"]
+			self.bots=detection["bots"]
+			self.bases.update(detection["bases"]) # bases don't move, keep any hidden this frame
+			self.ballPos=detection["ball"]
+			self.markers={**detection["bases"],**detection["bots"]}
+			self.workload={"stage":self.stage,"backoff":detection["backoff"],"processMs":round(detection["processMs"],2)}
+		self._draw()
+
+	def _draw(self)->None:
+		"""
+		a plain frame of what the edge detected for the video feed
+		"""
+		frame=self.frames.acquire()
+		frame.fill(0)
+		for baseId,(cx,cy) in self.bases.items():
+			cv2.rectangle(frame,(cx-10,cy-10),(cx+10,cy+10),(0,255,0),2)
+			cv2.putText(frame,str(baseId),(cx+12,cy),cv2.FONT_HERSHEY_SIMPLEX,0.6,(0,255,0),1)
+		for botId,(cx,cy,heading) in self.bots.items():
+			cv2.circle(frame,(cx,cy),12,(255,255,0),2)
+			cv2.putText(frame,str(botId),(cx+14,cy),cv2.FONT_HERSHEY_SIMPLEX,0.6,(255,255,0),1)
+		if self.ballPos[0] is not None:
+			cv2.circle(frame,self.ballPos,10,(255,0,255),-1)
+		self.frames.publish(self.frameNumber)
+
+	def setWorkload(self,stage:str)->None:
+		"""
+		passed on to the edge, which does the detecting
+		"""
+		if stage!=self.stage:
+			self.stage=stage
+			self._sendStage()
+
+	def getWorkload(self)->dict:
+		return dict(self.workload,linked=self.linked)
+
+	def getPixelbots(self)->dict:
+		return self.bots
+
+	def getHomeBases(self)->dict:
+		return self.bases
+
+	def getBall(self)->tuple:
+		return self.ballPos
+
+	def getScale(self):
+		return self.scale_px_per_mm
+
+	def getFrameNumber(self)->int:
+		return self.frameNumber
+
+	def getCaptureTime(self)->float:
+		"""
+		capture time of the current detection on this host's monotonic clock
+		"""
+		return self.captureTime
+
+	def getFrame(self):
+		return self.frames.latest()
+
+	def leaseFrame(self):
+		return self.frames.lease()
+
+	def stop(self)->None:
+		self.running=False
+		self.sock.close()
@@ -0,0 +1,131 @@
+# EdgeNode.py
+#
+# the edge half of a split deployment: capture and detection only, the
+# detections go to the game logic host (ArenaManager with REMOTE_DETECTOR)
+# over EdgeLink. No display, Flask or MQTT so the pi's CPU goes to vision
+#
+# python EdgeNode.py [--synthetic]
+# python EdgeNode.py --loopback [--seconds N] [--loss 0.1]
+#
+# --loopback runs both halves in one process over 127.0.0.1 and compares what
+# the host receives with what the edge detected
+
+import Startup
+from Startup import timeline
+import os
+import config
+from config import settings
+
+# file overrides must be applied before the other modules read their defaults
+CONFIG_FILE=os.environ.get("ARENA_CONFIG","arena.json")
+if os.path.exists(CONFIG_FILE):
+	config.loadSettings(CONFIG_FILE)
+	config.watchSettings(CONFIG_FILE) # tuning values are hot reloaded
+timeline.mark("config loaded")
+
+import argparse
+import threading
+import time
+
+from VideoDetectorLib import arucoDetector
+import EdgeLink
+import Metrics
+import Log
+import SyntheticArena
+
+
+def makeDetector(synthetic:bool):
+	width,height=settings.VIDEO_WIDTH,settings.VIDEO_HEIGHT
+	if synthetic:
+		# INITIAL_SCALE_FACTOR was measured at 1920 wide
+		camera=SyntheticArena.syntheticCamera(width,height,settings.INITIAL_SCALE_FACTOR*width/1920)
+		return arucoDetector(width,height,camera=camera)
+	return arucoDetector(width,height,cameraNum=settings.CAMERA_NUM)
+
+
+def runEdge(detector,sender,stop:threading.Event)->None:
+	"""
+	detect and send till stop is set, the host picks the workload
+	"""
+	while not stop.is_set():
+		detector.setWorkload(sender.stage)
+		detector.update()
+		sender.send(detector)
+
+
+def loopback(seconds:float,loss:float)->None:
+	"""
+	edge in a thread, host in this one
+	"""
+	host=EdgeLink.remoteDetector(settings.LINK_PORT)
+	detector=makeDetector(True)
+	sender=EdgeLink.edgeSender("127.0.0.1",settings.LINK_PORT,dropRate=loss)
+	stop=threading.Event()
+
+	sent={} # frame number->(bots,ball) as detected on the edge
+	sendOne=sender.send
+	def _sendAndKeep(detector):
+		sent[detector.getFrameNumber()]=(dict(detector.getPixelbots()),detector.getBall())
+		sendOne(detector)
+	sender.send=_sendAndKeep
+
+	edge=threading.Thread(target=runEdge,args=(detector,sender,stop),name="edge",daemon=True)
+	edge.start()
+
+	frames=mismatched=0
+	start=time.monotonic()
+	while time.monotonic()-start<seconds:
+		host.setWorkload("PLAYING_GAME")
+		host.update()
+		if not host.linked:
+			continue
+		frames+=1
+		bots,ball=sent.pop(host.getFrameNumber(),(None,None))
+		received=host.getPixelbots()
+		if bots is None or ball!=host.getBall() or bots.keys()!=received.keys():
+			mismatched+=1
+			continue
+		for botId,(cx,cy,heading) in bots.items():
+			rx,ry,rh=received[botId]
+			if (rx,ry)!=(int(cx),int(cy)) or abs((rh-heading+180)%360-180)>0.05:
+				mismatched+=1
+				break
+	stop.set()
+	edge.join()
+	Log.flush() # before the report
+
+	lost=Metrics.edgeLost.get()
+	latency=Metrics.edgeLatency.values.get(())
+	print(f"Loopback {seconds:.0f}s edge frames {sender.seq} host frames {frames} lost {lost:.0f} (dropped {sender.dropped}) mismatched {mismatched}",flush=True)
+	print(f"  {sender.bytesSent/max(sender.seq-sender.dropped,1):.0f} bytes per detection, edge stage {sender.stage}",flush=True)
+	if host.clock.offset is not None:
+		print(f"  clock offset {host.clock.offset*1e6:.0f}us rtt {host.clock.rtt*1e6:.0f}us",flush=True)
+	if latency:
+		count,total=latency
+		print(f"  capture to host {total/count*1000:.2f}ms average",flush=True)
+	sender.stop()
+	host.stop()
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="capture and detect, send the detections to the game logic host")
+	parser.add_argument("--synthetic",action="store_true",help="use a synthetic camera")
+	parser.add_argument("--loopback",action="store_true",help="run the edge and the host in this process")
+	parser.add_argument("--seconds",type=float,default=10,help="loopback run time")
+	parser.add_argument("--loss",type=float,default=0,help="fraction of detections to throw away")
+	args=parser.parse_args()
+	Log.dumpOnCrash()
+
+	if args.loopback:
+		loopback(args.seconds,args.loss)
+	else:
+		detector=makeDetector(args.synthetic)
+		sender=EdgeLink.edgeSender(dropRate=args.loss)
+		print(f"Sending detections to {sender.addr[0]}:{sender.addr[1]}",flush=True)
+		try:
+			runEdge(detector,sender,threading.Event())
+		except KeyboardInterrupt:
+			pass
+		sender.stop()
+	Log.stop()
@@ -0,0 +1,564 @@
+# FakeFleet.py
+#
+# command throughput and ack latency of pixelbotClass messaging with a fake
+# fleet, no real broker or bots needed
+#
+# python FakeFleet.py --bots 30 100 300 --mode own preconnect shared
+# python FakeFleet.py --bots 100 --delay 0.2 --jitter 0.1 --loss 0.05 --out fleet.json
+#
+# fakeBroker is a minimal MQTT 3.1.1 broker on 127.0.0.1 run by one thread
+# with selectors: CONNECT, PUBLISH at qos 0-2, SUBSCRIBE (exact topics only)
+# and PING, no sessions or retained messages. It hosts the fake bots itself,
+# each one listens on MQTT_COMMAND_TOPIC+addr, parses the HullOS "***" (VS,
+# RH, RS, RM, RX ...) and pythonish "**" commands and answers a move (the
+# VSdist which ends updateVariables()) with '1' on MQTT_DATA_TOPIC+addr after
+# delay plus up to jitter seconds. A loss fraction of the answers never come
+#
+# the fleet is real pixelbotClass.pixelbots pointed at the broker with
+# pixelbotClass.setBroker() and connected in one of three modes
+#   own         a paho client and network thread per bot, connected in turn
+#               (about 1s each, paho's loop thread waits before its first try)
+#   preconnect  the same but connected together by connectFleet()
+#   shared      one pixelbotClass.sharedClient for the whole fleet
+#
+# for each fleet size and mode
+#   connect     seconds to connect and subscribe every bot, then the threads
+#               and memory (RSS and Python heap from tracemalloc) they added
+#   throughput  every bot is sent --moves moves back to back, publishes per
+#               second reaching the broker and the caller's cost per publish
+#   latency     every bot makes --moves moves one at a time as the game does,
+#               move sent to '1' received percentiles. Moves with no answer
+#               after --timeout are counted as lost
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from config import lookups
+import pixelbotClass
+import FleetState
+from mqttSecrets import MQTT_COMMAND_TOPIC,MQTT_DATA_TOPIC
+
+FAKE_BASE_ID=1000 # fake bot ids start here, clear of the real markers
+# paho 1.6 waits on its sockets with select(), which can't take fds past
+# 1023. A client of its own is 3 fds (socket and wakeup pair) and the broker
+# end of the connection another here
+SELECT_FD_LIMIT=1024
+FDS_PER_CLIENT=4
+MOVE={"angle":45,"dist":100}
+
+# MQTT control packet types
+CONNECT,PUBLISH,PUBREL,SUBSCRIBE,UNSUBSCRIBE,PINGREQ,DISCONNECT=1,3,6,8,10,12,14
+
+
+def _encodeLength(length:int)->bytes:
+	"""
+	MQTT remaining length, 7 bits a byte
+	"""
+	out=bytearray()
+	while True:
+		byte=length%128
+		length//=128
+		out.append(byte|128 if length else byte)
+		if not length:
+			return bytes(out)
+
+
+def _decodeLength(buf:bytearray)->tuple:
+	"""
+	returns remaining length,fixed header size or None,None if buf
+	doesn't hold the whole fixed header yet
+	"""
+	length=0
+	for i in range(1,min(len(buf),5)):
+		length+=(buf[i]&127)<<(7*(i-1))
+		if not buf[i]&128:
+			return length,i+1
+	return None,None
+
+
+def _publishPacket(topic:str,payload:bytes)->bytes:
+	"""
+	qos 0 PUBLISH
+	"""
+	topic=topic.encode()
+	body=struct.pack("!H",len(topic))+topic+payload
+	return bytes([PUBLISH<<4])+_encodeLength(len(body))+body
+
+
+class fakeBot:
+	"""
+	a bot's program as far as the broker can tell
+	"""
+	def __init__(self,addr:str):
+		self.addr=addr
+		self.variables={}
+		self.programs={} # filename->text
+		self.uploading=None # filename between RM and RX
+		self.running=False
+		self.commands=collections.Counter()
+
+	def handle(self,payload:str)->bool:
+		"""
+		returns True when the command completes a move, which is answered with '1'
+		"""
+		if payload.startswith("***"):
+			cmd=payload[3:]
+			op=cmd[:2]
+			self.commands[op]+=1
+			if op=="VS":
+				name,_,value=cmd[2:].partition("=")
+				self.variables[name]=value
+				return name=="dist" # updateVariables() sends angle then dist
+			if op=="RH":
+				self.running=False
+			elif op=="RS":
+				self.running=True
+			elif op=="RM":
+				self.uploading=cmd[2:] or "active.txt"
+				self.programs[self.uploading]=""
+			elif op=="RX":
+				self.uploading=None
+			return False
+		if payload.startswith("**"):
+			text=payload[2:]
+			self.commands["**"]+=1
+			if self.uploading is not None:
+				self.programs[self.uploading]+=text
+			elif text.startswith("load "):
+				self.running=True
+			return False
+		self.commands["?"]+=1
+		return False
+
+
+class _connection:
+
+	def __init__(self,sock):
+		self.sock=sock
+		self.inbuf=bytearray()
+		self.outbuf=bytearray()
+		self.topics=set()
+
+
+class fakeBroker:
+
+	def __init__(self,port:int=0,delay:float=0.0,jitter:float=0.0,loss:float=0.0,seed:int=0,namespace:str=""):
+		"""
+		port 0 picks a free one, see self.port
+		"""
+		self.delay=delay
+		self.jitter=jitter
+		self.loss=loss
+		self.namespace=namespace
+		self.rng=random.Random(seed)
+
+		self.server=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+		self.server.bind(("127.0.0.1",port))
+		self.server.listen(1024)
+		self.server.setblocking(False)
+		self.port=self.server.getsockname()[1]
+
+		self.selector=selectors.DefaultSelector()
+		self.selector.register(self.server,selectors.EVENT_READ,None)
+		self.connections=set()
+		self.subscriptions=collections.defaultdict(set) # topic->connections
+		self.bots={} # command topic->fakeBot,data topic
+		self.answers=[] # heap of due time,seq,data topic
+		self.seq=itertools.count()
+		self.stats=collections.Counter() # published, delivered, moves, answered, lost
+
+		self.running=False
+		self.thread=None
+
+	def addBot(self,addr:str)->fakeBot:
+		bot=fakeBot(addr)
+		self.bots[f"{self.namespace}{MQTT_COMMAND_TOPIC}{addr}"]=(bot,f"{self.namespace}{MQTT_DATA_TOPIC}{addr}")
+		return bot
+
+	def subscribed(self,topics)->bool:
+		return all(self.subscriptions.get(topic) for topic in topics)
+
+	def start(self)->None:
+		self.running=True
+		self.thread=threading.Thread(target=self._run,name="fake broker",daemon=True)
+		self.thread.start()
+
+	def stop(self)->None:
+		self.running=False
+		if self.thread is not None:
+			self.thread.join()
+		for conn in list(self.connections):
+			self._close(conn)
+		self.selector.close()
+		self.server.close()
+
+	def _run(self)->None:
+		while self.running:
+			timeout=0.05
+			if self.answers:
+				timeout=min(timeout,max(0.0,self.answers[0][0]-time.monotonic()))
+			for key,events in self.selector.select(timeout):
+				if key.data is None:
+					self._accept()
+					continue
+				conn=key.data
+				if events&selectors.EVENT_READ:
+					self._read(conn)
+				if events&selectors.EVENT_WRITE and conn in self.connections:
+					self._flush(conn)
+			self._answer()
+
+	def _accept(self)->None:
+		try:
+			sock,_=self.server.accept()
+		except BlockingIOError:
+			return
+		sock.setblocking(False)
+		sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+		conn=_connection(sock)
+		self.connections.add(conn)
+		self.selector.register(sock,selectors.EVENT_READ,conn)
+
+	def _close(self,conn)->None:
+		if conn not in self.connections:
+			return
+		self.connections.discard(conn)
+		for topic in conn.topics:
+			self.subscriptions[topic].discard(conn)
+			if not self.subscriptions[topic]:
+				del self.subscriptions[topic]
+		self.selector.unregister(conn.sock)
+		conn.sock.close()
+
+	def _read(self,conn)->None:
+		try:
+			data=conn.sock.recv(65536)
+		except (BlockingIOError,InterruptedError):
+			return
+		except OSError:
+			data=b""
+		if not data:
+			self._close(conn)
+			return
+		buf=conn.inbuf
+		buf+=data
+		while len(buf)>=2:
+			length,start=_decodeLength(buf)
+			if length is None or len(buf)<start+length:
+				return
+			header=buf[0]
+			packet=bytes(buf[start:start+length])
+			del buf[:start+length]
+			self._packet(conn,header,packet)
+			if conn not in self.connections:
+				return
+
+	def _send(self,conn,data:bytes)->None:
+		conn.outbuf+=data
+		self._flush(conn)
+
+	def _flush(self,conn)->None:
+		try:
+			sent=conn.sock.send(conn.outbuf)
+		except (BlockingIOError,InterruptedError):
+			sent=0
+		except OSError:
+			self._close(conn)
+			return
+		del conn.outbuf[:sent]
+		# only ask to hear about writability while something is waiting
+		events=selectors.EVENT_READ|(selectors.EVENT_WRITE if conn.outbuf else 0)
+		if self.selector.get_key(conn.sock).events!=events:
+			self.selector.modify(conn.sock,events,conn)
+
+	def _packet(self,conn,header:int,packet:bytes)->None:
+		kind=header>>4
+		if kind==CONNECT:
+			self._send(conn,b"\x20\x02\x00\x00") # CONNACK accepted
+		elif kind==PUBLISH:
+			qos=(header>>1)&3
+			topicLen=struct.unpack_from("!H",packet)[0]
+			topic=packet[2:2+topicLen].decode()
+			pos=2+topicLen
+			if qos:
+				packetId=packet[pos:pos+2]
+				pos+=2
+				# PUBACK for qos 1, PUBREC for qos 2 (the client then sends PUBREL)
+				self._send(conn,(b"\x40\x02" if qos==1 else b"\x50\x02")+packetId)
+			self._route(topic,packet[pos:])
+		elif kind==PUBREL:
+			self._send(conn,b"\x70\x02"+packet[:2]) # PUBCOMP
+		elif kind==SUBSCRIBE:
+			packetId,pos,granted=packet[:2],2,bytearray()
+			while pos<len(packet):
+				topicLen=struct.unpack_from("!H",packet,pos)[0]
+				topic=packet[pos+2:pos+2+topicLen].decode()
+				pos+=2+topicLen+1 # and the requested qos
+				self.subscriptions[topic].add(conn)
+				conn.topics.add(topic)
+				granted.append(0) # everything is delivered at qos 0
+			self._send(conn,b"\x90"+_encodeLength(2+len(granted))+packetId+bytes(granted))
+		elif kind==UNSUBSCRIBE:
+			packetId,pos=packet[:2],2
+			while pos<len(packet):
+				topicLen=struct.unpack_from("!H",packet,pos)[0]
+				topic=packet[pos+2:pos+2+topicLen].decode()
+				pos+=2+topicLen
+				self.subscriptions[topic].discard(conn)
+				conn.topics.discard(topic)
+			self._send(conn,b"\xb0\x02"+packetId)
+		elif kind==PINGREQ:
+			self._send(conn,b"\xd0\x00")
+		elif kind==DISCONNECT:
+			self._close(conn)
+
+	def _route(self,topic:str,payload:bytes)->None:
+		self.stats["published"]+=1
+		subscribers=self.subscriptions.get(topic)
+		if subscribers:
+			message=_publishPacket(topic,payload)
+			for conn in list(subscribers):
+				self.stats["delivered"]+=1
+				self._send(conn,message)
+		target=self.bots.get(topic)
+		if target is None:
+			return
+		bot,dataTopic=target
+		if not bot.handle(payload.decode(errors="replace")):
+			return
+		self.stats["moves"]+=1
+		if self.rng.random()<self.loss:
+			self.stats["lost"]+=1
+			return
+		due=time.monotonic()+self.delay+self.rng.uniform(0,self.jitter)
+		heapq.heappush(self.answers,(due,next(self.seq),dataTopic))
+
+	def _answer(self)->None:
+		now=time.monotonic()
+		while self.answers and self.answers[0][0]<=now:
+			_,_,dataTopic=heapq.heappop(self.answers)
+			self.stats["answered"]+=1
+			self._route(dataTopic,b"1")
+
+
+class timedBot(pixelbotClass.pixelbot):
+	"""
+	pixelbot which keeps the time from each move being sent to its answer
+	"""
+	def __init__(self,*args,**kwargs):
+		self.latencies=[]
+		super().__init__(*args,**kwargs)
+
+	def _on_message(self,client,userdata,message):
+		moveSent=self.moveSent
+		if message.payload==b"1" and moveSent is not None:
+			self.latencies.append(time.monotonic()-moveSent)
+		super()._on_message(client,userdata,message)
+
+
+def _rssBytes()->int:
+	"""
+	resident set size, 0 where /proc isn't available
+	"""
+	try:
+		with open("/proc/self/statm","r") as f:
+			return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+	except (OSError,ValueError):
+		return 0
+
+
+def _openFds()->int:
+	try:
+		return len(os.listdir("/proc/self/fd"))
+	except OSError:
+		return 0
+
+
+def _waitFor(predicate,timeout:float)->bool:
+	end=time.monotonic()+timeout
+	while not predicate():
+		if time.monotonic()>end:
+			return False
+		time.sleep(0.001)
+	return True
+
+
+def _percentiles(seconds:list)->dict:
+	if not seconds:
+		return {"p50_ms":None,"p90_ms":None,"p99_ms":None,"max_ms":None}
+	p50,p90,p99=np.percentile(np.array(seconds)*1000,[50,90,99])
+	return {"p50_ms":round(p50,3),"p90_ms":round(p90,3),"p99_ms":round(p99,3),"max_ms":round(max(seconds)*1000,3)}
+
+
+def _makeFleet(broker,count:int,mode:str)->tuple:
+	"""
+	returns botId->timedBot,the shared client or None
+	"""
+	ids=range(FAKE_BASE_ID,FAKE_BASE_ID+count)
+	for botId in ids:
+		addr=f"FAKE-{botId}"
+		lookups.addrByBot[botId]=(f"Fake {botId}",addr)
+		broker.addBot(addr)
+	fleet=FleetState.fleetState(capacity=count)
+	shared=pixelbotClass.sharedClient() if mode=="shared" else None
+	if mode=="preconnect":
+		pixelbotClass.connectFleet([lookups.addrByBot[botId][1] for botId in ids])
+	bots={botId:timedBot(botId,0,0,0,fleet=fleet,broker=shared) for botId in ids}
+	return bots,shared
+
+
+def _dropFleet(bots:dict,shared)->None:
+	for botId,bot in bots.items():
+		if shared is None:
+			bot.mqttc.disconnect()
+			bot.mqttc.loop_stop()
+		lookups.addrByBot.pop(botId,None)
+	if shared is not None:
+		shared.stop()
+
+
+def runFleet(count:int,mode:str,moves:int,delay:float,jitter:float,loss:float,timeout:float)->dict:
+	"""
+	connect count fake bots in mode then measure throughput and latency
+	"""
+	if mode!="shared" and _openFds()+count*FDS_PER_CLIENT>=SELECT_FD_LIMIT:
+		return {"bots":count,"mode":mode,"skipped":f"needs fds past {SELECT_FD_LIMIT}, beyond paho's select()"}
+
+	broker=fakeBroker(delay=delay,jitter=jitter,loss=loss)
+	broker.start()
+	pixelbotClass.setBroker("127.0.0.1",broker.port)
+
+	threadsBefore=threading.active_count()
+	rssBefore=_rssBytes()
+	tracemalloc.start()
+	start=time.perf_counter()
+	bots,shared=_makeFleet(broker,count,mode)
+	dataTopics=[bot.dataTopic for bot in bots.values()]
+	subscribed=_waitFor(lambda: broker.subscribed(dataTopics),timeout)
+	connectSeconds=time.perf_counter()-start
+	heap,_=tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	result={
+		"bots":count,
+		"mode":mode,
+		"connect_s":round(connectSeconds,3),
+		"connected":subscribed,
+		"threads":threading.active_count()-threadsBefore,
+		"rss_mb":round((_rssBytes()-rssBefore)/1e6,2),
+		"heap_kb_per_bot":round(heap/count/1e3,2)
+	}
+
+	# throughput, moves back to back ignoring busy
+	published=broker.stats["published"]
+	expected=published+len(MOVE)*moves*count
+	start=time.perf_counter()
+	for _ in range(moves):
+		for bot in bots.values():
+			bot.updateVariables(MOVE)
+	callSeconds=time.perf_counter()-start
+	arrived=_waitFor(lambda: broker.stats["published"]>=expected,timeout+moves*count*0.01)
+	seconds=time.perf_counter()-start
+	result["publish_per_s"]=round((broker.stats["published"]-published)/seconds)
+	result["publish_call_us"]=round(callSeconds/(len(MOVE)*moves*count)*1e6,2)
+	result["all_published"]=arrived
+
+	# let the burst's answers drain before timing single moves
+	time.sleep(delay+jitter+0.2)
+	for bot in bots.values():
+		bot.busy=False
+		bot.moveSent=None
+		bot.latencies.clear()
+
+	# latency, one move at a time per bot as the game loop does it
+	remaining={botId:moves for botId in bots}
+	lost=0
+	start=time.monotonic()
+	while remaining:
+		now=time.monotonic()
+		for botId in list(remaining):
+			bot=bots[botId]
+			if bot.busy:
+				if now-bot.moveSent<timeout:
+					continue
+				lost+=1 # no answer, give up on it as BUSY_TIMEOUT_S does
+				bot.busy=False
+				bot.moveSent=None
+			if remaining[botId]==0:
+				del remaining[botId]
+				continue
+			remaining[botId]-=1
+			bot.busy=True
+			bot.updateVariables(MOVE)
+		time.sleep(0.0005)
+	seconds=time.monotonic()-start
+	latencies=[latency for bot in bots.values() for latency in bot.latencies]
+	result["acked"]=len(latencies)
+	result["lost"]=lost
+	result["moves_per_s"]=round(len(latencies)/seconds,1)
+	result.update(_percentiles(latencies))
+	result["commands"]=dict(sum((bot.commands for bot,_ in broker.bots.values()),collections.Counter()))
+
+	_dropFleet(bots,shared)
+	broker.stop()
+	return result
+
+
+def _report(result:dict)->None:
+	if "skipped" in result:
+		print(f"{result['bots']:4d} bots {result['mode']:10s} skipped, {result['skipped']}",flush=True)
+		return
+	print(f"{result['bots']:4d} bots {result['mode']:10s} connect {result['connect_s']:6.2f}s threads {result['threads']:4d} "
+		f"rss {result['rss_mb']:7.2f}MB heap {result['heap_kb_per_bot']:6.1f}kB/bot | "
+		f"{result['publish_per_s']:6d} publishes/s {result['publish_call_us']:6.1f}us/call | "
+		f"ack p50 {result['p50_ms']}ms p90 {result['p90_ms']}ms p99 {result['p99_ms']}ms max {result['max_ms']}ms "
+		f"{result['moves_per_s']} moves/s lost {result['lost']}",flush=True)
+
+
+if __name__=="__main__":
+
+	parser=argparse.ArgumentParser(description="pixelbot messaging against a fake broker and fleet")
+	parser.add_argument("--bots",type=int,nargs="+",default=[30,100,300],help="fleet sizes")
+	parser.add_argument("--mode",nargs="+",default=["preconnect","shared"],choices=["own","preconnect","shared"],help="how the bots connect")
+	parser.add_argument("--moves",type=int,default=10,help="moves per bot in each measurement")
+	parser.add_argument("--delay",type=float,default=0.0,help="seconds a fake bot takes to answer a move")
+	parser.add_argument("--jitter",type=float,default=0.0,help="up to this many seconds more")
+	parser.add_argument("--loss",type=float,default=0.0,help="fraction of answers never sent")
+	parser.add_argument("--timeout",type=float,default=5.0,help="seconds to wait for an answer or a connection")
+	parser.add_argument("--out",help="save the results here as JSON")
+	args=parser.parse_args()
+
+	results=[]
+	for count in args.bots:
+		for mode in args.mode:
+			result=runFleet(count,mode,args.moves,args.delay,args.jitter,args.loss,args.timeout)
+			_report(result)
+			results.append(result)
+
+	if args.out:
+		report={
+			"meta":{
+				"time":time.strftime("%Y-%m-%d %H:%M:%S"),
+				"moves":args.moves,
+				"delay":args.delay,
+				"jitter":args.jitter,
+				"loss":args.loss
+			},
+			"results":results
+		}
+		with open(args.out,"w") as f:
+			json.dump(report,f,indent=1)
+		print(f"Results saved to {args.out}",flush=True)
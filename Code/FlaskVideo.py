@@ -1,23 +1,33 @@
-import os
-
-from Code.ArenaManager import aruco_detector
-
-print(os.path)
-
 # import the necessary packages
 import json
-from imutils.video import VideoStream
+import hmac
+from typing import Any
 from flask import Response
 from flask import Flask
 from flask import render_template
+from flask import request
+from flask import abort
 import threading
 import VideoDetectorLib
 import cv2
 import time
+import itertools
+import Metrics
+from config import settings
 
 lock=threading.Lock()
 
 videoDetector=None # set from ArenaManager
+profiler=None # set from ArenaManager if settings.PROFILING_ENABLED
+
+# latest detection snapshot for the /state feed, set by publishState()
+stateCondition=threading.Condition()
+stateSnapshot=None
+stateJson=None # encoded once per snapshot, shared by all viewers
+stateFrame=-1
+stateListeners=0 # ArenaManager skips building snapshots when nobody is watching
+
+videoClients=itertools.count(1) # numbers the /video_feed viewers for the metrics
 
 FRAME_WIDTH=640
 FRAME_HEIGHT=480
@@ -38,20 +48,36 @@ def _getVideoFrame() -> Any:
     """
 	_getVideoFrame()
 	
-    grab the current frame and resize to 640x480
+    lease the last complete frame and resize to 640x480
 
+    returns frameNumber,frame - frame is None till the first frame is published
     """
-    # imshow doesn't like this as a memoryview
-	# haven't tried imageview with video streaming
-    videoFrame,_=aruco_detector.getFrame() # ignore ArUco markers
+    # the resize is the copy, the detector's buffer is only leased while it runs
+    with videoDetector.leaseFrame() as (frameNumber,frame):
+        if frame is None:
+            return frameNumber,None
+        return frameNumber,_resizeFrame(frame)
 
-    # scale down maintaining aspect ratio
-    # just making a 640 pixel wide image for streaming
+def _resizeFrame(videoFrame) -> Any:
+    """
+    scale down maintaining aspect ratio
+    just making a 640 pixel wide image for streaming
+    """
     h,w=videoFrame.shape[:2]
-    aspect=640/w
+    aspect=FRAME_WIDTH/w
     newHeight=int(aspect*h)
 
-    return cv2.resize(videoFrame, (640,newHeight), interpolation=cv2.INTER_LINEAR)
+    return cv2.resize(videoFrame, (FRAME_WIDTH,newHeight), interpolation=cv2.INTER_LINEAR)
+
+def _encodeFrame(videoFrame) -> bytes:
+    """
+    JPEG encode a frame as one part of the multipart stream
+    returns None if encoding fails
+    """
+    (flag, encodedImage) = cv2.imencode(".jpg", videoFrame)
+    if not flag:
+        return None
+    return b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedImage) + b'\r\n'
 
 
 def _generate() -> Any:
@@ -64,23 +90,121 @@ def _generate() -> Any:
 
     :return: Nothing
     """
+    client=str(next(videoClients))
+    lastFrame=None
+    with lock:
+        Metrics.streamClients.set((Metrics.streamClients.get("video") or 0)+1,"video")
+    try:
+        while True:
+            frameNumber,videoFrame=_getVideoFrame()
+
+            if videoFrame is not None:
+                cv2.imshow("FlaskVideo.py",videoFrame) # comment out later
+                # encode the frame in JPEG format
+                part=_encodeFrame(videoFrame)
+         
+                # ensure the frame was successfully encoded
+                if part is not None:
+                    if lastFrame is not None and frameNumber>lastFrame+1:
+                        Metrics.streamDropped.add(frameNumber-lastFrame-1,client)
+                    lastFrame=frameNumber
+                    Metrics.streamFrames.inc(client)
+                    # yield the output frame in the byte format
+                    yield part
+            
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                cv2.destroyAllWindows()
+                break
+    finally:
+        with lock:
+            Metrics.streamClients.set(Metrics.streamClients.get("video")-1,"video")
+        Metrics.streamFrames.remove(client)
+        Metrics.streamDropped.remove(client)
+
+def publishState(frameNumber:int,state:dict)->None:
+    """
+    publishState()
+
+    called by ArenaManager with the latest detection snapshot.
+    Cheap, the JSON is only built when a viewer asks for it
+    """
+    global stateSnapshot,stateJson,stateFrame
+
+    with stateCondition:
+        stateSnapshot=state
+        stateJson=None
+        stateFrame=frameNumber
+        stateCondition.notify_all()
+
+def _stateEvents() -> Any:
+    """
+    server-sent events generator for /state
+
+    sends at most settings.STATE_MAX_HZ snapshots per second and
+    skips frames which haven't changed
+
+    :return: Nothing
+    """
+    global stateJson,stateListeners
+
+    interval=1.0/settings.STATE_MAX_HZ
+    lastFrame=None
 
-    while True:
-        videoFrame=_getVideoFrame()
-        cv2.imshow("FlaskVideo.py",videoFrame) # comment out later
-
-        if videoFrame is not None:
-            # encode the frame in JPEG format
-            (flag, encodedImage) = cv2.imencode(".jpg", videoFrame)
-     
-            # ensure the frame was successfully encoded
-            if flag:
-                # yield the output frame in the byte format
-                yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedImage) + b'\r\n')
-        
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            cv2.destroyAllWindows()
-            break
+    with stateCondition:
+        stateListeners+=1
+    try:
+        while True:
+            with stateCondition:
+                fresh=stateCondition.wait_for(lambda: stateSnapshot is not None and stateFrame!=lastFrame,timeout=15)
+                frame=stateFrame
+                if fresh:
+                    if stateJson is None:
+                        stateJson=json.dumps(stateSnapshot,separators=(",",":"))
+                    text=stateJson
+                else:
+                    text=None
+
+            if text is None:
+                # keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+
+            lastFrame=frame
+            yield f"id: {frame}\ndata: {text}\n\n"
+            time.sleep(interval)
+    finally:
+        with stateCondition:
+            stateListeners-=1
+
+@app.route("/state")
+def state():
+    # detection snapshots for client side overlays
+    return Response(_stateEvents(),mimetype="text/event-stream",headers={"Cache-Control":"no-cache"})
+
+def _collectStateClients()->None:
+    Metrics.streamClients.set(stateListeners,"state")
+
+Metrics.addCollector(_collectStateClients)
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape target
+    return Response(Metrics.render(),mimetype="text/plain; version=0.0.4")
+
+@app.route("/profile",methods=["POST"])
+def profile():
+    # on demand profiling of the game loop
+    # POST /profile?seconds=N or ?iterations=N with an X-Profile-Token header
+    if profiler is None or not settings.PROFILE_TOKEN:
+        abort(404)
+    token=request.headers.get("X-Profile-Token","")
+    if not hmac.compare_digest(token.encode(),settings.PROFILE_TOKEN.encode()):
+        abort(403)
+    seconds=request.args.get("seconds",type=float)
+    iterations=request.args.get("iterations",type=int)
+    if not profiler.request(seconds,iterations):
+        return ("profile already running\n",409)
+    return (f"profiling, report will be written to {settings.PROFILE_DIR}\n",202)
 
 @app.route("/video_feed")
 def video_feed():
@@ -88,6 +212,16 @@ def video_feed():
     # type (mime type)
     return Response(_generate(),mimetype = "multipart/x-mixed-replace; boundary=frame")
 
+def serve():
+    """
+    run the Flask server on a daemon thread so the game loop keeps the
+    main thread, returns the thread
+    """
+    server=threading.Thread(target=app.run,name="flask",daemon=True,
+        kwargs={"host":settings.FLASK_HOST,"port":settings.FLASK_PORT,"threaded":True,"use_reloader":False})
+    server.start()
+    return server
+
 # check to see if this is the main thread of execution
 if __name__ == '__main__':
 
@@ -0,0 +1,171 @@
+# FleetState.py
+#
+# the fleet's positions and status held as numpy arrays (structure of arrays)
+#
+# every bot gets a dense slot, pixelbot instances are thin views onto their
+# slot for messaging. Positions from a detection frame are written in one
+# bulk update and whole fleet questions (who is home, who is idle, whose busy
+# flag has timed out, who is in team 0) are answered with array masks so the
+# per tick cost stays flat as the fleet grows
+#
+# positions are frame pixels, NaN when a bot has never been seen. Velocities
+# (px/s, degrees/s) are estimated from successive frames' capture times for
+# latency compensation (see MotionPredictor.py)
+
+import numpy as np
+
+from config import settings,lookups
+import MotionPredictor
+
+
+# array name->(dtype,empty slot value)
+COLUMNS={
+	"botId":(np.int32,-1),
+	"team":(np.int8,-1),
+	"cx":(np.float64,np.nan),
+	"cy":(np.float64,np.nan),
+	"heading":(np.float64,np.nan),
+	"homeX":(np.float64,np.nan),
+	"homeY":(np.float64,np.nan),
+	"present":(bool,False), # seen in the last detection frame
+	"busy":(bool,False),
+	"lastCmd":(np.float64,0), # time.time() of the last move
+	"vx":(np.float64,0),
+	"vy":(np.float64,0),
+	"turnRate":(np.float64,0),
+	"poseTime":(np.float64,np.nan) # capture time (monotonic) of the frame the pose came from
+}
+
+
+class fleetState:
+
+	def __init__(self,capacity:int=None,idTables=lookups):
+		self.lookups=idTables # the arena's bots and teams
+		capacity=capacity or max(8,len(idTables.allBots))
+		self.slotOf={} # botId->slot
+		self.count=0 # slots in use
+		for name,(dtype,empty) in COLUMNS.items():
+			setattr(self,name,np.full(capacity,empty,dtype=dtype))
+
+	def _grow(self)->None:
+		capacity=len(self.botId)*2
+		for name,(dtype,empty) in COLUMNS.items():
+			old=getattr(self,name)
+			new=np.full(capacity,empty,dtype=dtype)
+			new[:len(old)]=old
+			setattr(self,name,new)
+
+	def add(self,botId:int)->int:
+		"""
+		returns the bot's slot, adding it if it's new
+		"""
+		slot=self.slotOf.get(botId)
+		if slot is not None:
+			return slot
+		if self.count==len(self.botId):
+			self._grow()
+		slot=self.count
+		self.count+=1
+		self.slotOf[botId]=slot
+		self.botId[slot]=botId
+		self.team[slot]=self.lookups.teamByBot.get(botId,-1)
+		return slot
+
+	def __len__(self)->int:
+		return self.count
+
+	def updateFromDetections(self,bots:dict,captureTime:float=None)->None:
+		"""
+		bots: botId->(cx,cy,heading) as returned by arucoDetector.getPixelbots()
+		captureTime: when the frame was taken, for the velocities
+
+		one bulk write, bots in the fleet but not in bots are marked not present
+		and keep their last position
+		"""
+		self.present[:self.count]=False
+		known=[(self.slotOf[botId],pose) for botId,pose in bots.items() if botId in self.slotOf]
+		if not known:
+			return
+		slots,poses=zip(*known)
+		slots=np.fromiter(slots,dtype=np.intp,count=len(slots))
+		poses=np.array(poses,dtype=float)
+		if captureTime is not None:
+			self._updateVelocities(slots,poses,captureTime)
+		self.cx[slots]=poses[:,0]
+		self.cy[slots]=poses[:,1]
+		self.heading[slots]=poses[:,2]
+		self.present[slots]=True
+
+	def _updateVelocities(self,slots:np.ndarray,poses:np.ndarray,captureTime:float)->None:
+		dt=captureTime-self.poseTime[slots]
+		# a repeat of the same frame changes nothing, NaN (never seen) is new
+		new=~(dt<=0)
+		slots,poses,dt=slots[new],poses[new],dt[new]
+		# never seen or missing too long starts from rest
+		fresh=~(dt<=settings.MOTION_MAX_GAP_S)
+		vx=np.where(fresh,0,(poses[:,0]-self.cx[slots])/dt)
+		vy=np.where(fresh,0,(poses[:,1]-self.cy[slots])/dt)
+		turn=np.where(fresh,0,MotionPredictor.wrapDegrees(poses[:,2]-self.heading[slots])/dt)
+		self.vx[slots]=MotionPredictor.smooth(self.vx[slots],vx,fresh)
+		self.vy[slots]=MotionPredictor.smooth(self.vy[slots],vy,fresh)
+		self.turnRate[slots]=MotionPredictor.smooth(self.turnRate[slots],turn,fresh)
+		self.poseTime[slots]=captureTime
+
+	def predictPoses(self,slots:np.ndarray,lead:float)->tuple:
+		"""
+		cx,cy,heading of the slots extrapolated lead seconds past their poses
+		"""
+		cx=self.cx[slots]+self.vx[slots]*lead
+		cy=self.cy[slots]+self.vy[slots]*lead
+		heading=(self.heading[slots]+self.turnRate[slots]*lead)%360
+		return cx,cy,heading
+
+	# masks over the slots in use
+
+	def activeMask(self)->np.ndarray:
+		mask=np.zeros(len(self.botId),dtype=bool)
+		mask[:self.count]=True
+		return mask
+
+	def homeMask(self,baseSideLenPX:float)->np.ndarray:
+		"""
+		bots within half a base side of their home base
+		"""
+		tolerance=round(baseSideLenPX/2)
+		with np.errstate(invalid="ignore"):
+			dist=np.rint(np.hypot(self.cx-self.homeX,self.cy-self.homeY))
+			return self.activeMask()&(dist<=tolerance)
+
+	def idleMask(self)->np.ndarray:
+		return self.activeMask()&~self.busy
+
+	def teamMask(self,team:int)->np.ndarray:
+		return self.activeMask()&(self.team==team)
+
+	def expireBusy(self,now:float,timeout:float)->list:
+		"""
+		clears busy flags older than timeout (the bot's reply was lost)
+		returns the botIds cleared
+		"""
+		expired=self.busy&(now-self.lastCmd>timeout)
+		if not expired.any():
+			return []
+		self.busy[expired]=False
+		return self.ids(expired)
+
+	def setBusy(self,botId:int,now:float)->None:
+		slot=self.slotOf[botId]
+		self.busy[slot]=True
+		self.lastCmd[slot]=now
+
+	def ids(self,mask:np.ndarray)->list:
+		"""
+		botIds where mask is True
+		"""
+		return self.botId[mask].tolist()
+
+	def slots(self,mask:np.ndarray)->np.ndarray:
+		return np.flatnonzero(mask)
+
+
+fleet=fleetState() # for pixelbots created outside an arena, each Arena.arena has its own
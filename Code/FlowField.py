@@ -0,0 +1,331 @@
+# FlowField.py
+#
+# shared flow field navigation
+#
+# the arena rect is rasterised into a grid of cells. Bots and the ball are
+# obstacles. One flow field is kept per target (the ball or a home base), each
+# cell holding its cost to the target and the next cell to move to.
+#
+# fields are repaired incrementally when obstacles move so planning cost
+# doesn't grow with the number of bots reading them.
+
+import heapq
+import math
+
+from config import settings
+
+INF=float("inf")
+SQRT2=math.sqrt(2)
+
+# 8 connected neighbours dx,dy,step cost
+NEIGHBOURS=[(1,0,1),(-1,0,1),(0,1,1),(0,-1,1),(1,1,SQRT2),(1,-1,SQRT2),(-1,1,SQRT2),(-1,-1,SQRT2)]
+
+
+class _field:
+	"""
+	cost to target and next cell for every grid cell
+	"""
+	def __init__(self,targetCell:int,targetPos:tuple,blocked:bytearray):
+		self.targetCell=targetCell
+		self.targetPos=targetPos
+		self.blocked=blocked
+		self.cost=None
+		self.parent=None
+
+
+class flowFieldNavigator:
+	"""
+	coordinates are in pixels, the same as the detector
+	"""
+	def __init__(self,cellSizeMM:float=None):
+		self.cellSizeMM=cellSizeMM # None follows settings.FLOW_CELL_MM
+		self.cellPx=None
+		self.scale_px_per_mm=settings.INITIAL_SCALE_FACTOR
+		self.rect=None
+		self.cols=0
+		self.rows=0
+		self.obstacles={} # key->list of covered cells
+		self.coverCount=None
+		self.fields={} # target key->_field
+		self.repairs=0
+		self.rebuilds=0
+
+	def _setGrid(self,rect:tuple,scale_px_per_mm:float)->None:
+		"""
+		rebuild the grid if the arena rect or scale changes
+		"""
+		TLX,TLY,BRX,BRY=rect
+		rect=(min(TLX,BRX),min(TLY,BRY),max(TLX,BRX),max(TLY,BRY))
+		cellSizeMM=self.cellSizeMM if self.cellSizeMM is not None else settings.FLOW_CELL_MM
+		cellPx=max(1.0,cellSizeMM*scale_px_per_mm)
+
+		if rect==self.rect and cellPx==self.cellPx:
+			return
+
+		self.rect=rect
+		self.cellPx=cellPx
+		self.cols=max(1,math.ceil((rect[2]-rect[0])/cellPx))
+		self.rows=max(1,math.ceil((rect[3]-rect[1])/cellPx))
+		self.obstacles={}
+		self.coverCount=[0]*(self.cols*self.rows)
+		self.fields={}
+
+	def _cellOf(self,x:float,y:float)->int:
+		col=min(self.cols-1,max(0,int((x-self.rect[0])/self.cellPx)))
+		row=min(self.rows-1,max(0,int((y-self.rect[1])/self.cellPx)))
+		return row*self.cols+col
+
+	def _cellCentre(self,cell:int)->tuple:
+		row,col=divmod(cell,self.cols)
+		return (round(self.rect[0]+(col+0.5)*self.cellPx),round(self.rect[1]+(row+0.5)*self.cellPx))
+
+	def _cover(self,x:float,y:float,radiusPx:float)->list:
+		"""
+		cells whose centre is within radiusPx of x,y
+		"""
+		cells=[]
+		reach=int(radiusPx/self.cellPx)+1
+		centre=self._cellOf(x,y)
+		row0,col0=divmod(centre,self.cols)
+		for row in range(max(0,row0-reach),min(self.rows,row0+reach+1)):
+			cy=self.rect[1]+(row+0.5)*self.cellPx
+			for col in range(max(0,col0-reach),min(self.cols,col0+reach+1)):
+				cx=self.rect[0]+(col+0.5)*self.cellPx
+				if (cx-x)**2+(cy-y)**2<=radiusPx**2:
+					cells.append(row*self.cols+col)
+		if not cells:
+			cells.append(centre)
+		return cells
+
+	def update(self,rect:tuple,scale_px_per_mm:float,obstacles:dict)->None:
+		"""
+		called once per control tick
+
+		rect: TLX,TLY,BRX,BRY arena bounds in pixels
+		obstacles: key->(x,y,radiusMM) - the radius is grown by FLOW_CLEARANCE_MM
+		"""
+		self._setGrid(rect,scale_px_per_mm)
+		self.scale_px_per_mm=scale_px_per_mm
+
+		newObstacles={}
+		for key,(x,y,radiusMM) in obstacles.items():
+			if x is None:
+				continue
+			radiusPx=(radiusMM+settings.FLOW_CLEARANCE_MM)*scale_px_per_mm
+			newObstacles[key]=self._cover(x,y,radiusPx)
+
+		# only touch the cover counts of obstacles which moved
+		for key in set(self.obstacles)|set(newObstacles):
+			old=self.obstacles.get(key)
+			new=newObstacles.get(key)
+			if old==new:
+				continue
+			for cell in old or ():
+				self.coverCount[cell]-=1
+			for cell in new or ():
+				self.coverCount[cell]+=1
+		self.obstacles=newObstacles
+
+	def _blockedFor(self,targetKey,targetCell:int)->bytearray:
+		"""
+		a field never treats its own target (or the obstacle it is) as blocked
+		"""
+		blocked=bytearray(1 if c>0 else 0 for c in self.coverCount)
+		for cell in self.obstacles.get(targetKey,()):
+			if self.coverCount[cell]==1:
+				blocked[cell]=0
+		blocked[targetCell]=0
+		return blocked
+
+	def _neighbours(self,cell:int,blocked:bytearray):
+		row,col=divmod(cell,self.cols)
+		for dx,dy,step in NEIGHBOURS:
+			c=col+dx
+			r=row+dy
+			if c<0 or r<0 or c>=self.cols or r>=self.rows:
+				continue
+			n=r*self.cols+c
+			if blocked[n]:
+				continue
+			# don't cut the corner of a blocked cell
+			if dx and dy and (blocked[row*self.cols+c] or blocked[r*self.cols+col]):
+				continue
+			yield n,step
+
+	def _stepAllowed(self,cell:int,to:int,blocked:bytearray)->bool:
+		row,col=divmod(cell,self.cols)
+		r,c=divmod(to,self.cols)
+		if blocked[to]:
+			return False
+		if r!=row and c!=col:
+			return not (blocked[row*self.cols+c] or blocked[r*self.cols+col])
+		return True
+
+	def _propagate(self,field:_field,heap:list)->None:
+		"""
+		dijkstra from the cells already on the heap
+		"""
+		cost=field.cost
+		parent=field.parent
+		blocked=field.blocked
+		while heap:
+			c,cell=heapq.heappop(heap)
+			if c>cost[cell]:
+				continue
+			for n,step in self._neighbours(cell,blocked):
+				nc=c+step
+				if nc<cost[n]:
+					cost[n]=nc
+					parent[n]=cell
+					heapq.heappush(heap,(nc,n))
+
+	def _build(self,field:_field)->None:
+		size=self.cols*self.rows
+		field.cost=[INF]*size
+		field.parent=[-1]*size
+		field.cost[field.targetCell]=0
+		self._propagate(field,[(0,field.targetCell)])
+		self.rebuilds+=1
+
+	def _repair(self,field:_field,blocked:bytearray)->None:
+		"""
+		incremental update after obstacles moved
+
+		cells whose route passed through a newly blocked cell are invalidated
+		then re-seeded from their valid neighbours along with any freed cells
+		"""
+		old=field.blocked
+		size=len(blocked)
+		newlyBlocked=[i for i in range(size) if blocked[i] and not old[i]]
+		freed=[i for i in range(size) if old[i] and not blocked[i]]
+		field.blocked=blocked
+		if not newlyBlocked and not freed:
+			return
+
+		cost=field.cost
+		parent=field.parent
+
+		# 0 unknown, 1 route still valid, 2 route broken
+		state=bytearray(size)
+		for cell in newlyBlocked:
+			state[cell]=2
+			# a diagonal step past a newly blocked cell is no longer allowed
+			row,col=divmod(cell,self.cols)
+			for dx,dy,_ in NEIGHBOURS:
+				r=row+dy
+				c=col+dx
+				if 0<=r<self.rows and 0<=c<self.cols:
+					n=r*self.cols+c
+					p=parent[n]
+					if p>=0 and not blocked[n] and not self._stepAllowed(n,p,blocked):
+						state[n]=2
+		state[field.targetCell]=1
+		for cell in range(size):
+			if state[cell] or cost[cell]==INF:
+				continue
+			chain=[]
+			walk=cell
+			while state[walk]==0 and parent[walk]>=0:
+				chain.append(walk)
+				walk=parent[walk]
+			verdict=state[walk] if state[walk] else 2
+			for c in chain:
+				state[c]=verdict
+
+		invalid=[i for i in range(size) if state[i]==2]
+		for cell in invalid:
+			cost[cell]=INF
+			parent[cell]=-1
+
+		heap=[]
+		for cell in invalid+freed:
+			if blocked[cell]:
+				continue
+			for n,step in self._neighbours(cell,blocked):
+				if cost[n]+step<cost[cell]:
+					cost[cell]=cost[n]+step
+					parent[cell]=n
+			if cost[cell]<INF:
+				heap.append((cost[cell],cell))
+		# freed cells also reopen diagonal steps between their neighbours
+		for cell in freed:
+			for n,_ in self._neighbours(cell,blocked):
+				if cost[n]<INF:
+					heap.append((cost[n],n))
+		heapq.heapify(heap)
+		self._propagate(field,heap)
+		self.repairs+=1
+
+	def refresh(self,targets:dict)->None:
+		"""
+		targets: key->(x,y) one field is kept per key
+
+		fields for targets which moved cell are rebuilt, the rest are repaired
+		"""
+		if self.rect is None:
+			return
+		for key in list(self.fields):
+			if key not in targets:
+				del self.fields[key]
+
+		for key,(x,y) in targets.items():
+			if x is None:
+				continue
+			targetCell=self._cellOf(x,y)
+			blocked=self._blockedFor(key,targetCell)
+			field=self.fields.get(key)
+			if field is None or field.targetCell!=targetCell:
+				field=_field(targetCell,(x,y),blocked)
+				self._build(field)
+				self.fields[key]=field
+			else:
+				field.targetPos=(x,y)
+				self._repair(field,blocked)
+
+	def nextWaypoint(self,targetKey,x:float,y:float,lookahead:int=None):
+		"""
+		next point to steer to from x,y towards targetKey
+
+		the bot's own footprint is blocked in the shared field so step out
+		of it onto the cheapest free cell first. Follows the flow for up to
+		lookahead cells while the direction doesn't change.
+
+		returns x,y (the target itself on the final leg) or None if there is no route
+		"""
+		field=self.fields.get(targetKey)
+		if field is None:
+			return None
+		if lookahead is None:
+			lookahead=settings.FLOW_LOOKAHEAD
+
+		cost=field.cost
+		start=self._cellOf(x,y)
+		best=start
+		if field.blocked[start] or cost[start]==INF:
+			best=None
+			reach=int(math.ceil((settings.BOT_RADIUS_MM+settings.FLOW_CLEARANCE_MM)*self.scale_px_per_mm/self.cellPx))+1
+			row0,col0=divmod(start,self.cols)
+			for row in range(max(0,row0-reach),min(self.rows,row0+reach+1)):
+				for col in range(max(0,col0-reach),min(self.cols,col0+reach+1)):
+					cell=row*self.cols+col
+					if not field.blocked[cell] and (best is None or cost[cell]<cost[best]):
+						best=cell
+			if best is None or cost[best]==INF:
+				return None
+
+		cell=best
+		direction=None
+		for _ in range(lookahead):
+			nxt=field.parent[cell]
+			if nxt<0:
+				break
+			step=nxt-cell
+			if direction is not None and step!=direction:
+				break
+			direction=step
+			cell=nxt
+
+		if cell==field.targetCell:
+			# final leg goes to the exact target not the cell centre
+			return field.targetPos
+		return self._cellCentre(cell)
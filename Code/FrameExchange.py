@@ -0,0 +1,105 @@
+# FrameExchange.py
+#
+# triple buffered hand-off of annotated frames from the detector to readers
+# (Flask, imshow) without copying and without readers blocking capture
+#
+# the producer acquire()s a free buffer from the pool, captures and draws on
+# it, then publish()es it - a swap of the published index under a short lock.
+# Readers lease() the published buffer as a read-only view. A leased buffer
+# is never handed back to the producer till the lease ends, so a reader
+# never sees a half annotated frame.
+#
+# three buffers cover the usual case (one being drawn on, one published,
+# one still leased by a slow reader). The pool only grows if readers hold
+# more leases than that, so in steady state nothing is allocated.
+
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class frameExchange:
+
+	def __init__(self,shape:tuple,dtype=np.uint8,buffers:int=3):
+		self.shape=tuple(shape)
+		self.dtype=dtype
+		self.lock=threading.Lock()
+
+		self.pool=[np.empty(self.shape,dtype) for _ in range(buffers)]
+		self.leases=[0]*buffers # readers holding each buffer
+		self.working=None # index the producer is drawing on
+		self.published=None # index readers get
+		self.tags=[None]*buffers # e.g. frame number of each buffer's frame
+		self.grown=0 # buffers added because every buffer was leased
+
+	def acquire(self)->np.ndarray:
+		"""
+		producer side: a writeable buffer nobody is reading
+
+		re-acquiring before publish() returns the same buffer
+		"""
+		with self.lock:
+			if self.working is not None:
+				return self.pool[self.working]
+			for index in range(len(self.pool)):
+				if index!=self.published and self.leases[index]==0:
+					self.working=index
+					return self.pool[index]
+			# every other buffer is leased by a slow reader
+			self.pool.append(np.empty(self.shape,self.dtype))
+			self.leases.append(0)
+			self.tags.append(None)
+			self.grown+=1
+			self.working=len(self.pool)-1
+			return self.pool[self.working]
+
+	def publish(self,tag=None)->None:
+		"""
+		producer side: the acquired buffer becomes the published frame,
+		the producer must not touch it again
+		"""
+		with self.lock:
+			if self.working is None:
+				return
+			self.tags[self.working]=tag
+			self.published=self.working
+			self.working=None
+
+	@contextmanager
+	def lease(self):
+		"""
+		reader side, yields tag,frame - frame is a read-only view of the
+		published buffer which stays valid till the with block ends
+
+		yields None,None if nothing has been published yet
+		"""
+		with self.lock:
+			index=self.published
+			if index is not None:
+				self.leases[index]+=1
+		if index is None:
+			yield None,None
+			return
+		try:
+			yield self.tags[index],_readOnly(self.pool[index])
+		finally:
+			with self.lock:
+				self.leases[index]-=1
+
+	def latest(self)->np.ndarray:
+		"""
+		read-only view of the published frame without a lease, only safe for
+		the producer's own thread (e.g. imshow in the game loop) as the
+		buffer is reused after the next publish()
+		"""
+		index=self.published
+		if index is None:
+			return None
+		return _readOnly(self.pool[index])
+
+
+def _readOnly(buf:np.ndarray)->np.ndarray:
+	view=buf.view()
+	view.flags.writeable=False
+	return view
@@ -0,0 +1,268 @@
+# Log.py
+#
+# non-blocking logging for the game loop
+#
+#   Log.info("Busy timeout",bot=botId)
+#
+# the message is a fixed string and the values go in fields, so the message
+# doubles as the rate limiting key and records can be read by a program
+# (LOG_FORMAT "json"). Formatting and writing happen in a background thread,
+# the caller only appends a tuple to a ring buffer
+#
+# ring buffer  LOG_RING slots indexed by a sequence number from
+#              itertools.count(), whose next() is atomic under the GIL, so
+#              several threads append without a lock. If the writer falls a
+#              whole ring behind the records it missed are counted as dropped
+# rate limit   each message gets LOG_BURST records then LOG_RATE_HZ, the
+#              number held back is added to the next one let through.
+#              every=N keeps only 1 in N calls (sampling)
+# context      bind(arena=..,stage=..,frame=..) sets fields added to every
+#              record from this thread, Arena.tick() binds them each tick
+# dumps        an error record writes the last LOG_DUMP_S seconds of records,
+#              debug included, to LOG_DUMP_FILE. dumpOnCrash() does the same
+#              for uncaught exceptions
+#
+# records below LOG_LEVEL are kept in the ring for dumps but not written
+
+import atexit
+import itertools
+import json
+import sys
+import threading
+import time
+import traceback
+
+from config import settings
+import Metrics
+
+LEVELS={"debug":10,"info":20,"warning":30,"error":40}
+LEVEL_NAMES={number:name.upper() for name,number in LEVELS.items()}
+DEBUG,INFO,WARNING,ERROR=(LEVELS[name] for name in ("debug","info","warning","error"))
+
+
+class ringLog:
+
+	def __init__(self,size:int=None):
+		self.size=size or settings.LOG_RING
+		self.slots=[None]*self.size # (seq,time,level,msg,fields,context,exc)
+		self.seq=itertools.count()
+		self.cursor=0 # next seq the writer wants
+		self.limits={} # msg->[tokens,last time,held back,calls]
+		self.local=threading.local()
+
+		self.wake=threading.Event()
+		self.dumpAfter=None # seq of an error record to dump after
+		self.lastDump=0
+		self.writeLock=threading.Lock() # writer thread vs flush() from another thread
+		self.out=None # open LOG_FILE
+		self.outPath=None
+		self.writer=None
+		self.stopping=False
+
+	def bind(self,**fields)->None:
+		"""
+		fields added to every record from this thread till the next bind()
+		"""
+		self.local.context=fields
+
+	def log(self,level:int,msg:str,fields:dict,every:int=1,exc:str=None)->None:
+		now=time.time()
+		limit=self.limits.get(msg)
+		if limit is None:
+			limit=self.limits[msg]=[settings.LOG_BURST,now,0,0]
+		if every>1:
+			limit[3]+=1
+			if (limit[3]-1)%every:
+				return
+		# token bucket, races between threads only blur the rate a little
+		tokens=limit[0]+(now-limit[1])*settings.LOG_RATE_HZ
+		limit[1]=now
+		if tokens<1 and level<ERROR:
+			limit[0]=tokens
+			limit[2]+=1
+			Metrics.logSuppressed.inc()
+			return
+		limit[0]=min(settings.LOG_BURST,tokens)-1
+		if limit[2]:
+			fields["suppressed"]=limit[2]
+			limit[2]=0
+
+		seq=next(self.seq)
+		self.slots[seq%self.size]=(seq,now,level,msg,fields,getattr(self.local,"context",None),exc)
+		if level>=ERROR:
+			self.dumpAfter=seq
+			self.wake.set()
+		if self.stopping:
+			self.flush() # the writer has gone, e.g. logged from atexit
+		elif self.writer is None:
+			self.start()
+
+	def start(self)->None:
+		with self.writeLock:
+			if self.writer is not None:
+				return
+			self.writer=threading.Thread(target=self._run,name="log writer",daemon=True)
+			self.writer.start()
+		atexit.register(self.stop)
+
+	def _run(self)->None:
+		while not self.stopping:
+			self.wake.wait(settings.LOG_FLUSH_S)
+			self.wake.clear()
+			self.flush()
+
+	def flush(self)->None:
+		"""
+		write everything logged so far, blocks till it is written
+		"""
+		with self.writeLock:
+			records=self._drain()
+			minLevel=LEVELS.get(settings.LOG_LEVEL,INFO)
+			lines=[_format(record) for record in records if record[2]>=minLevel]
+			if lines:
+				out=self._output()
+				out.write("".join(lines))
+				out.flush()
+			dumpAfter=self.dumpAfter
+			if dumpAfter is not None and dumpAfter<self.cursor:
+				self.dumpAfter=None
+				self._dump(dumpAfter)
+
+	def _drain(self)->list:
+		"""
+		records from the cursor up to the first slot not written yet
+		"""
+		records=[]
+		while True:
+			record=self.slots[self.cursor%self.size]
+			if record is None or record[0]<self.cursor:
+				return records # not appended yet
+			if record[0]>self.cursor:
+				# lapped by the producers
+				Metrics.logDropped.add(record[0]-self.cursor)
+				self.cursor=record[0]
+			records.append(record)
+			Metrics.logRecords.inc(LEVEL_NAMES[record[2]].lower())
+			self.cursor+=1
+
+	def _output(self):
+		path=settings.LOG_FILE
+		if path is None:
+			return sys.stdout
+		if path!=self.outPath:
+			if self.out is not None:
+				self.out.close()
+			self.out=open(path,"a")
+			self.outPath=path
+		return self.out
+
+	def _dump(self,errorSeq:int)->None:
+		"""
+		records of the last LOG_DUMP_S seconds before the error, at most one
+		dump per LOG_DUMP_S so an error storm doesn't rewrite it constantly
+		"""
+		now=time.time()
+		if now-self.lastDump<settings.LOG_DUMP_S:
+			return
+		self.lastDump=now
+		since=now-settings.LOG_DUMP_S
+		records=sorted((record for record in list(self.slots) if record is not None and record[1]>=since and record[0]<=errorSeq),key=lambda record: record[0])
+		with open(settings.LOG_DUMP_FILE,"a") as f:
+			f.write(f"==== {len(records)} records before the error at {_clock(now)} ====\n")
+			f.write("".join(_format(record) for record in records))
+		out=self._output()
+		out.write(_format((None,now,INFO,"Log dumped",{"records":len(records),"file":settings.LOG_DUMP_FILE},None,None)))
+		out.flush()
+
+	def stop(self)->None:
+		"""
+		write what's left and stop the writer
+		"""
+		self.stopping=True
+		self.wake.set()
+		if self.writer is not None and self.writer is not threading.current_thread():
+			self.writer.join(timeout=2)
+		self.flush()
+
+	def dumpOnCrash(self)->None:
+		"""
+		log uncaught exceptions, in any thread, as errors and dump straight away
+		"""
+		previous=sys.excepthook
+		def _hook(excType,value,tb):
+			self.log(ERROR,"Uncaught exception",{},exc="".join(traceback.format_exception(excType,value,tb)))
+			self.flush()
+			previous(excType,value,tb)
+		sys.excepthook=_hook
+
+		previousThread=threading.excepthook
+		def _threadHook(args):
+			self.log(ERROR,"Uncaught exception",{"thread":args.thread.name if args.thread else None},
+				exc="".join(traceback.format_exception(args.exc_type,args.exc_value,args.exc_traceback)))
+			self.flush()
+			previousThread(args)
+		threading.excepthook=_threadHook
+
+
+def _clock(t:float)->str:
+	return time.strftime("%H:%M:%S",time.localtime(t))+f".{int(t%1*1000):03d}"
+
+
+def _value(value)->str:
+	if isinstance(value,float):
+		return f"{value:.4g}"
+	return str(value)
+
+
+def _format(record:tuple)->str:
+	_,t,level,msg,fields,context,exc=record
+	if settings.LOG_FORMAT=="json":
+		line={"time":round(t,3),"level":LEVEL_NAMES[level].lower(),"msg":msg}
+		if context:
+			line.update((name,value) for name,value in context.items() if value not in (None,""))
+		line.update(fields)
+		if exc:
+			line["exc"]=exc
+		return json.dumps(line,default=str)+"\n"
+	text=f"{_clock(t)} {LEVEL_NAMES[level]:7s} {msg}"
+	if fields:
+		text+=" "+" ".join(f"{name}={_value(value)}" for name,value in fields.items())
+	if context:
+		text+=" | "+" ".join(f"{name}={_value(value)}" for name,value in context.items() if value not in (None,""))
+	text+="\n"
+	if exc:
+		text+=exc if exc.endswith("\n") else exc+"\n"
+	return text
+
+
+_log=ringLog()
+bind=_log.bind
+flush=_log.flush
+stop=_log.stop
+dumpOnCrash=_log.dumpOnCrash
+
+
+def debug(msg:str,every:int=1,**fields)->None:
+	_log.log(DEBUG,msg,fields,every)
+
+
+def info(msg:str,every:int=1,**fields)->None:
+	_log.log(INFO,msg,fields,every)
+
+
+def warning(msg:str,every:int=1,**fields)->None:
+	_log.log(WARNING,msg,fields,every)
+
+
+def error(msg:str,**fields)->None:
+	"""
+	never rate limited, dumps the recent records (see LOG_DUMP_S)
+	"""
+	_log.log(ERROR,msg,fields)
+
+
+def exception(msg:str,**fields)->None:
+	"""
+	error() with the traceback of the exception being handled
+	"""
+	_log.log(ERROR,msg,fields,exc=traceback.format_exc())
@@ -0,0 +1,253 @@
+# Metrics.py
+#
+# arena health and throughput figures for the Flask /metrics endpoint
+# in the Prometheus text exposition format
+#
+# updates are plain dict writes from the hot path, no locks. Each metric is
+# normally written by a single thread and only read by the scraper, a rare
+# lost increment when two threads race is acceptable for monitoring.
+#
+# values which are cheaper to read than to track (game stage, scale, bot busy)
+# are filled in by collectors, called only when /metrics is scraped
+
+import time
+
+_metrics=[]
+_collectors=[]
+
+
+def _escape(value)->str:
+	return str(value).replace("\\","\\\\").replace("\n","\\n").replace('"','\\"')
+
+
+def _labelText(names:tuple,values:tuple)->str:
+	if not names:
+		return ""
+	return "{"+",".join(f'{name}="{_escape(value)}"' for name,value in zip(names,values))+"}"
+
+
+class _metric:
+	kind="untyped"
+
+	def __init__(self,name:str,help:str,labelNames:tuple=()):
+		self.name=name
+		self.help=help
+		self.labelNames=tuple(labelNames)
+		self.values={} # label values tuple->value
+		_metrics.append(self)
+
+	def remove(self,*labels)->None:
+		self.values.pop(labels,None)
+
+	def clear(self)->None:
+		self.values.clear()
+
+	def samples(self):
+		"""
+		yields (suffix,label values,value)
+		"""
+		for labels,value in list(self.values.items()):
+			yield "",labels,value
+
+
+class counter(_metric):
+	kind="counter"
+
+	def __init__(self,name:str,help:str,labelNames:tuple=()):
+		super().__init__(name,help,labelNames)
+		if not labelNames:
+			self.values[()]=0
+
+	def inc(self,*labels)->None:
+		self.values[labels]=self.values.get(labels,0)+1
+
+	def add(self,amount:float,*labels)->None:
+		self.values[labels]=self.values.get(labels,0)+amount
+
+	def get(self,*labels)->float:
+		return self.values.get(labels,0)
+
+
+class gauge(_metric):
+	kind="gauge"
+
+	def set(self,value:float,*labels)->None:
+		self.values[labels]=value
+
+	def get(self,*labels)->float:
+		return self.values.get(labels)
+
+
+class summary(_metric):
+	"""
+	count and sum of observations e.g. seconds per stage
+	"""
+	kind="summary"
+
+	def observe(self,value:float,*labels)->None:
+		stats=self.values.get(labels)
+		if stats is None:
+			self.values[labels]=[1,value]
+		else:
+			stats[0]+=1
+			stats[1]+=value
+
+	def samples(self):
+		for labels,(count,total) in list(self.values.items()):
+			yield "_count",labels,count
+			yield "_sum",labels,total
+
+
+class rate(_metric):
+	"""
+	events per second, exponentially smoothed, for FPS figures
+
+	reads 0 when tick() hasn't been called for STALE_S
+	"""
+	kind="gauge"
+	SMOOTHING=0.1
+	STALE_S=2.0
+
+	def tick(self,*labels)->None:
+		now=time.monotonic()
+		state=self.values.get(labels)
+		if state is None:
+			self.values[labels]=[now,None]
+			return
+		interval=now-state[0]
+		state[0]=now
+		state[1]=interval if state[1] is None else state[1]+(interval-state[1])*self.SMOOTHING
+
+	def get(self,*labels)->float:
+		state=self.values.get(labels)
+		if state is None or not state[1] or time.monotonic()-state[0]>self.STALE_S:
+			return 0.0
+		return 1.0/state[1]
+
+	def samples(self):
+		for labels in list(self.values.keys()):
+			yield "",labels,self.get(*labels)
+
+
+class stopwatch:
+	"""
+	with stopwatch(stageSeconds,arenaName,"detect"):
+	"""
+	__slots__=("metric","labels","start")
+
+	def __init__(self,metric:summary,*labels):
+		self.metric=metric
+		self.labels=labels
+
+	def __enter__(self):
+		self.start=time.perf_counter()
+		return self
+
+	def __exit__(self,*exc):
+		self.metric.observe(time.perf_counter()-self.start,*self.labels)
+		return False
+
+
+def addCollector(collector)->None:
+	"""
+	collector() is called before every scrape to refresh gauges
+	"""
+	_collectors.append(collector)
+
+
+def render()->str:
+	"""
+	all metrics in the Prometheus text format
+	"""
+	for collector in list(_collectors):
+		try:
+			collector()
+		except Exception as e:
+			print(f"Metrics collector {collector.__name__} exception {e}",flush=True)
+
+	lines=[]
+	for metric in _metrics:
+		lines.append(f"# HELP {metric.name} {metric.help}")
+		lines.append(f"# TYPE {metric.name} {metric.kind}")
+		for suffix,labels,value in metric.samples():
+			lines.append(f"{metric.name}{suffix}{_labelText(metric.labelNames,labels)} {value}")
+	return "\n".join(lines)+"\n"
+
+
+##########################################
+#
+# the arena's metrics
+#
+##########################################
+
+# detection pipeline (VideoDetectorLib)
+framesCaptured=counter("arena_frames_captured_total","frames captured from the camera",("arena",))
+framesDetected=counter("arena_frames_detected_total","frames searched for markers",("arena",))
+captureFps=rate("arena_capture_fps","camera frames per second",("arena",))
+detectFps=rate("arena_detect_fps","frames searched for markers per second",("arena",))
+stageSeconds=summary("arena_stage_seconds","time spent in each detection stage",("arena","stage"))
+markersPerFrame=gauge("arena_markers_detected","markers found in the last frame",("arena",))
+markersDetected=counter("arena_markers_detected_total","markers found in all frames",("arena",))
+ballSearches=counter("arena_ball_searches_total","frames searched for the ball",("arena",))
+ballFrames=counter("arena_ball_found_frames_total","frames in which the ball was found",("arena",))
+ballFoundRatio=gauge("arena_ball_found_ratio","fraction of ball searches which found the ball",("arena",))
+frameBuffers=gauge("arena_frame_buffers","pooled frame buffers, more than 3 means readers hold frames too long",("arena",))
+detectBackoff=gauge("arena_detect_backoff","times the detector rates have been halved to stay in the frame budget",("arena",))
+
+# game (ArenaManager)
+loopSeconds=summary("arena_loop_seconds","game loop iteration time by game stage",("arena","stage"))
+gameStage=gauge("arena_game_stage","1 for the current game stage",("arena","stage"))
+scale=gauge("arena_scale_px_per_mm","current pixels per mm",("arena",))
+controlLead=summary("arena_control_lead_seconds","how far ahead of the frame poses are extrapolated when moves are made",("arena",))
+ballContactSeconds=summary("arena_ball_contact_seconds","time from the ball appearing to the first bot reaching it",("arena",))
+
+# several arenas in one process (ArenaHost)
+arenaTicks=counter("arena_host_ticks_total","game loop iterations of each arena",("arena",))
+arenaCpuSeconds=counter("arena_host_cpu_seconds_total","CPU time used by each arena's game loop",("arena",))
+arenaWaitSeconds=summary("arena_host_wait_seconds","time each arena was ready to run but waiting for a worker",("arena",))
+
+# fleet (pixelbotClass)
+botBusy=gauge("arena_bot_busy","1 while the bot is carrying out a move",("bot",))
+botCommands=counter("arena_bot_moves_total","moves sent to each bot",("bot",))
+botRtt=summary("arena_bot_rtt_seconds","time from sending a move to the bot reporting it done",("bot",))
+commands=counter("arena_commands_total","moves submitted by the game logic by outcome (CommandScheduler)",("result",))
+mqttPublished=counter("arena_mqtt_published_total","messages published to each bot",("bot",))
+mqttAcked=counter("arena_mqtt_acked_total","publishes acknowledged by the broker",("bot",))
+mqttQueueDepth=gauge("arena_mqtt_queue_depth","publishes waiting for a broker acknowledgement",("bot",))
+mqttReconnects=counter("arena_mqtt_reconnects_total","broker reconnections",("bot",))
+mqttDisconnects=counter("arena_mqtt_disconnects_total","broker disconnections",("bot",))
+
+# split deployment, game logic host side (EdgeLink)
+edgeFrames=counter("arena_edge_frames_total","detections received from the edge node")
+edgeLost=counter("arena_edge_lost_total","detections lost on the way from the edge node")
+edgeStale=counter("arena_edge_stale_total","detections dropped as duplicates or out of order")
+edgeRtt=gauge("arena_edge_rtt_seconds","round trip time to the edge node")
+edgeClockOffset=gauge("arena_edge_clock_offset_seconds","edge node clock minus host clock")
+edgeLatency=summary("arena_edge_latency_seconds","time from capture on the edge to arrival at the host")
+
+# logging (Log)
+logRecords=counter("arena_log_records_total","records taken by the log writer by level",("level",))
+logSuppressed=counter("arena_log_suppressed_total","records held back by the per message rate limit")
+logDropped=counter("arena_log_dropped_total","records overwritten before the log writer got to them")
+
+# streaming (FlaskVideo)
+streamClients=gauge("arena_stream_clients","connected viewers",("feed",))
+streamFrames=counter("arena_stream_frames_total","frames sent to each video viewer",("client",))
+streamDropped=counter("arena_stream_dropped_frames_total","captured frames each video viewer never saw",("client",))
+
+
+def _collectDetection()->None:
+	# the ball detector runs at its own rate (WORKLOADS) so not every
+	# frame searched for markers is searched for the ball
+	for labels,searched in list(ballSearches.values.items()):
+		if searched:
+			ballFoundRatio.set(ballFrames.get(*labels)/searched,*labels)
+
+
+def _collectQueues()->None:
+	for labels,published in list(mqttPublished.values.items()):
+		mqttQueueDepth.set(published-mqttAcked.get(*labels),*labels)
+
+
+addCollector(_collectDetection)
+addCollector(_collectQueues)
@@ -3,6 +3,7 @@
 # miscellaneous methods
 import logging
 import math
+import numpy as np
 
 def min_max(val:any,tolerance:float=.1)->tuple:
 	"""
@@ -97,6 +98,84 @@ def expandRect(TLX,TLY,BRX,BRY,Margin):
 		BRY-=Margin
 	
 	return TLX,TLY,BRX,BRY
+
+
+# whole fleet versions of the above
+#
+# these take arrays (or lists) of positions, headings and targets with one
+# entry per bot and answer for the whole fleet in one call
+
+
+def getHypotenuses(x0,y0,x1,y1):
+	"""
+	array version of getHypotenuse
+	"""
+	return np.hypot(np.subtract(x1,x0),np.subtract(y1,y0))
+
+
+def getHeadingsAndRanges(cx,cy,X0,Y0)->tuple:
+	"""
+	array version of getHeadingAndRange
+	
+	headings are clockwise from North (0) with y increasing down the screen.
+	arctan2 covers all quadrants so there is no branching and coincident
+	points give heading 0 range 0 rather than an exception
+	
+	returns headings,ranges as int arrays
+	"""
+	dx=np.subtract(X0,cx,dtype=float)
+	north=np.subtract(cy,Y0,dtype=float) # screen y is down, +0.0 when equal
+	headings=np.rint(np.degrees(np.arctan2(dx,north))).astype(int)%360
+	ranges=np.rint(np.hypot(dx,north)).astype(int)
+	return headings,ranges
+
+
+def getCourseChanges(course,heading):
+	"""
+	array version of getCourseChange
+	
+	returns the signed turn from heading to course in the range -179..180
+	(positive is clockwise)
+	"""
+	return 180-np.mod(180-np.subtract(course,heading),360)
+
+
+def expandRects(rects,Margin):
+	"""
+	array version of expandRect, rects is an Nx4 array of TLX,TLY,BRX,BRY
+	"""
+	rects=np.asarray(rects)
+	sign=np.where(rects[:,0:1]<rects[:,2:3],1,-1)
+	return rects+sign*np.array([-Margin,-Margin,Margin,Margin])
+
+
+if __name__=="__main__":
 	
+	# micro benchmark of the scalar and array versions
+	import timeit
 	
+	rng=np.random.default_rng(0)
 	
+	for bots in (8,64,512):
+		cx=rng.integers(0,1920,bots)
+		cy=rng.integers(0,1080,bots)
+		tx=rng.integers(0,1920,bots)
+		ty=rng.integers(0,1080,bots)
+		heading=rng.integers(0,360,bots)
+		
+		# the scalar code works on python ints
+		points=list(zip(cx.tolist(),cy.tolist(),tx.tolist(),ty.tolist(),heading.tolist()))
+		
+		def scalar():
+			for x,y,X,Y,h in points:
+				course,dist=getHeadingAndRange(x,y,X,Y)
+				getCourseChange(course,h)
+		
+		def vectorised():
+			courses,dists=getHeadingsAndRanges(cx,cy,tx,ty)
+			getCourseChanges(courses,heading)
+		
+		loops=200
+		scalarUs=min(timeit.repeat(scalar,number=loops,repeat=5))/loops*1e6
+		vectorUs=min(timeit.repeat(vectorised,number=loops,repeat=5))/loops*1e6
+		print(f"{bots:4d} bots  scalar {scalarUs:9.1f} us  vectorised {vectorUs:7.1f} us  speedup {scalarUs/vectorUs:5.1f}x",flush=True)
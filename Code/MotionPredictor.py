@@ -0,0 +1,89 @@
+# MotionPredictor.py
+#
+# latency compensation for the game logic
+#
+# poses come from a frame taken some time ago (capture, detection and the
+# game loop) and a move takes a while longer to reach the bot over MQTT. The
+# bots and the ball are extrapolated forward by that lead time so moves aim
+# where things will be rather than where they were
+#
+# velocities come from successive detections using the frames' capture times,
+# smoothed with MOTION_SMOOTHING. A marker missing for longer than
+# MOTION_MAX_GAP_S starts again from rest and the lead is capped at
+# MOTION_MAX_LEAD_S so a bad estimate can't send a bot far off
+
+import time
+
+import numpy as np
+
+from config import settings
+
+
+def leadTime(captureTime:float,now:float=None)->float:
+	"""
+	seconds from the frame being captured to a move sent now taking effect
+	"""
+	if not settings.PREDICT_MOTION or captureTime is None:
+		return 0.0
+	now=time.monotonic() if now is None else now
+	return min(max(now-captureTime,0.0)+settings.MQTT_DELIVERY_S,settings.MOTION_MAX_LEAD_S)
+
+
+def wrapDegrees(delta):
+	"""
+	signed angle difference in -180..180
+	"""
+	return (np.asarray(delta)+180)%360-180
+
+
+def smooth(old,new,fresh):
+	"""
+	exponential smoothing of velocity estimates, fresh (bool array) marks
+	estimates with no usable history, they take the new value as it is
+	"""
+	blended=old+(new-old)*settings.MOTION_SMOOTHING
+	return np.where(fresh,new,blended)
+
+
+class pointTrack:
+	"""
+	position and velocity of a single point, e.g. the ball, in frame pixels
+	"""
+	def __init__(self):
+		self.pos=None
+		self.time=None
+		self.velocity=(0.0,0.0) # px/s
+
+	def update(self,pos,captureTime:float)->None:
+		"""
+		pos (x,y) or (None,None) when not seen
+		"""
+		if pos is None or pos[0] is None:
+			return
+		if self.pos is not None and captureTime is not None and self.time is not None:
+			dt=captureTime-self.time
+			if dt<=0:
+				return # same frame again
+			if dt<=settings.MOTION_MAX_GAP_S:
+				vx=(pos[0]-self.pos[0])/dt
+				vy=(pos[1]-self.pos[1])/dt
+				oldX,oldY=self.velocity
+				self.velocity=(float(smooth(oldX,vx,False)),float(smooth(oldY,vy,False)))
+			else:
+				self.velocity=(0.0,0.0)
+		self.pos=(pos[0],pos[1])
+		self.time=captureTime
+
+	def predict(self,lead:float)->tuple:
+		"""
+		position lead seconds after the last capture
+		"""
+		if self.pos is None:
+			return None,None
+		vx,vy=self.velocity
+		return self.pos[0]+vx*lead,self.pos[1]+vy*lead
+
+	def clear(self)->None:
+		self.pos=None
+		self.time=None
+		self.velocity=(0.0,0.0)
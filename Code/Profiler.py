@@ -0,0 +1,148 @@
+# Profiler.py
+#
+# on demand profiling of the running arena loop
+#
+# disabled unless settings.PROFILING_ENABLED. When enabled a capture can be
+# requested with SIGUSR1 (kill -USR1 <pid>) or the Flask /profile endpoint. The
+# next N seconds or N loop iterations are profiled with cProfile while a
+# sampler thread records the loop's call stacks.
+#
+# written to settings.PROFILE_DIR
+#   <stamp>.txt        hot functions sorted by cumulative and own time
+#   <stamp>.prof       raw cProfile stats (snakeviz etc)
+#   <stamp>.collapsed  folded stacks for flamegraph.pl / speedscope
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+from config import settings
+import Log
+
+
+class loopProfiler:
+
+	def __init__(self,outDir:str=None):
+		self.outDir=outDir # None follows settings.PROFILE_DIR
+		self.lock=threading.Lock()
+
+		# the game loop only checks these, so there's no cost when idle
+		self.armed=False
+		self.signalled=False # set by the SIGUSR1 handler, tick() arms the capture
+
+		self.running=False
+		self.seconds=None
+		self.iterations=None
+		self.started=0
+		self.count=0
+		self.profile=None
+		self.sampler=None
+		self.samples=collections.Counter()
+		self.loopThread=None
+		self.lastReport=None
+
+	def install(self)->None:
+		"""
+		SIGUSR1 requests a PROFILE_SECONDS capture
+
+		the handler runs on the main thread between bytecodes, possibly while
+		tick() holds the lock, so it only sets a flag
+		"""
+		if hasattr(signal,"SIGUSR1"):
+			signal.signal(signal.SIGUSR1,self._onSignal)
+
+	def _onSignal(self,signum,frame)->None:
+		self.signalled=True
+
+	def request(self,seconds:float=None,iterations:int=None)->bool:
+		"""
+		arm a capture, the game loop starts it on its next tick()
+		returns False if a capture is already pending or running
+		"""
+		if seconds is None and iterations is None:
+			seconds=settings.PROFILE_SECONDS
+		with self.lock:
+			if self.armed:
+				return False
+			self.seconds=min(seconds,settings.PROFILE_MAX_SECONDS) if seconds is not None else None
+			self.iterations=iterations
+			self.armed=True
+		Log.info("Profiler armed",seconds=self.seconds,iterations=iterations)
+		return True
+
+	def _sample(self)->None:
+		"""
+		record the loop thread's stack every PROFILE_SAMPLE_MS
+		"""
+		interval=settings.PROFILE_SAMPLE_MS/1000
+		while self.running:
+			frame=sys._current_frames().get(self.loopThread)
+			stack=[]
+			while frame is not None:
+				code=frame.f_code
+				stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+				frame=frame.f_back
+			if stack:
+				self.samples[";".join(reversed(stack))]+=1
+			time.sleep(interval)
+
+	def tick(self)->None:
+		"""
+		call once per loop iteration while armed or signalled, in the loop's thread
+		"""
+		if self.signalled:
+			self.signalled=False
+			self.request(seconds=settings.PROFILE_SECONDS) # ignored if one is already pending
+		if not self.running:
+			self.running=True
+			self.count=0
+			self.samples=collections.Counter()
+			self.loopThread=threading.get_ident()
+			self.sampler=threading.Thread(target=self._sample,name="profileSampler",daemon=True)
+			self.sampler.start()
+			self.started=time.monotonic()
+			self.profile=cProfile.Profile()
+			self.profile.enable()
+			return
+
+		self.count+=1
+		elapsed=time.monotonic()-self.started
+		if self.iterations is not None and self.count<self.iterations and elapsed<settings.PROFILE_MAX_SECONDS:
+			return
+		if self.iterations is None and elapsed<self.seconds:
+			return
+
+		self.profile.disable()
+		self.running=False
+		self.sampler.join()
+		self._write(elapsed)
+		with self.lock:
+			self.armed=False
+
+	def _write(self,elapsed:float)->None:
+		outDir=self.outDir or settings.PROFILE_DIR
+		os.makedirs(outDir,exist_ok=True)
+		base=os.path.join(outDir,time.strftime("profile-%Y%m%d-%H%M%S"))
+
+		text=io.StringIO()
+		text.write(f"{self.count} loop iterations in {elapsed:.2f}s\n\n")
+		stats=pstats.Stats(self.profile,stream=text)
+		stats.sort_stats("cumulative").print_stats(settings.PROFILE_TOP)
+		stats.sort_stats("tottime").print_stats(settings.PROFILE_TOP)
+		with open(base+".txt","w") as f:
+			f.write(text.getvalue())
+
+		stats.dump_stats(base+".prof")
+
+		with open(base+".collapsed","w") as f:
+			for stack,count in self.samples.most_common():
+				f.write(f"{stack} {count}\n")
+
+		self.lastReport=base
+		Log.info("Profile written",files=f"{base}.txt/.prof/.collapsed")
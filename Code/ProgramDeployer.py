@@ -0,0 +1,133 @@
+# ProgramDeployer.py
+#
+# uploads pythonish programs to the whole fleet at once
+#
+# each program file is read and hashed once (re-read only if it changes on disk).
+# Bots are uploaded to concurrently, up to settings.DEPLOY_CONCURRENCY at a time,
+# and a bot is skipped if its last upload of a file had the same hash.
+#
+# the broker acknowledging every publish (QoS 2) only shows the upload reached
+# the broker, not the bot. With settings.DEPLOY_BOT_ACK set the bot's own
+# acknowledgement is also waited for and only then is the hash saved to
+# DEPLOY_STATE_FILE. Without it the hash is remembered for this run only, so
+# a bot which was off or missed the upload is tried again next time
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import settings
+from pixelbotClass import DEFAULT_PROGRAM_LIST
+import Log
+
+
+class programDeployer:
+
+	def __init__(self,folder:str="programs",maxConcurrent:int=None,stateFile:str=None):
+		self.folder=folder
+		self.maxConcurrent=maxConcurrent # None follows settings.DEPLOY_CONCURRENCY
+		stateFile=stateFile or settings.DEPLOY_STATE_FILE
+		self.stateFile=stateFile
+		self.lock=threading.Lock()
+
+		self.programs={} # filename->(mtime,text,hash)
+		self.confirmed={} # bot addr->{filename:hash} acknowledged by the bot, saved
+		self.delivered={} # bot addr->{filename:hash} acknowledged by the broker only, not saved
+
+		if stateFile is not None and os.path.exists(stateFile):
+			try:
+				with open(stateFile,"r") as f:
+					self.confirmed=json.load(f)
+			except Exception as e:
+				Log.warning("ProgramDeployer cannot read state",file=stateFile,error=repr(e))
+
+	def _program(self,filename:str)->tuple:
+		"""
+		returns text,hash of a program, cached till the file changes
+		"""
+		path=os.path.join(self.folder,filename)
+		mtime=os.path.getmtime(path)
+		cached=self.programs.get(filename)
+		if cached is None or cached[0]!=mtime:
+			with open(path,"r") as f:
+				text=f.read()
+			digest=hashlib.sha1(text.encode("utf-8")).hexdigest()
+			cached=(mtime,text,digest)
+			self.programs[filename]=cached
+		return cached[1],cached[2]
+
+	def _save(self)->None:
+		if self.stateFile is None:
+			return
+		with self.lock:
+			with open(self.stateFile,"w") as f:
+				json.dump(self.confirmed,f,indent=1)
+
+	def _deployOne(self,bot,programs:list,force:bool)->dict:
+		"""
+		upload the programs which have changed to one bot
+		"""
+		start=time.time()
+		result={"ok":True,"uploaded":[],"skipped":[],"seconds":0,"error":None}
+		with self.lock:
+			known=dict(self.confirmed.get(bot.addr,{}))
+			known.update(self.delivered.get(bot.addr,{}))
+
+		try:
+			for filename,text,digest in programs:
+				if not force and known.get(filename)==digest:
+					result["skipped"].append(filename)
+					continue
+
+				sent=bot._uploadPythonishProgram(text,filename)
+				deadline=start+settings.DEPLOY_CONFIRM_TIMEOUT
+				for info in sent:
+					info.wait_for_publish(max(0,deadline-time.time()))
+				if not all(info.is_published() for info in sent):
+					raise TimeoutError(f"{filename} not acknowledged by the broker within {settings.DEPLOY_CONFIRM_TIMEOUT}s")
+
+				if settings.DEPLOY_BOT_ACK is None:
+					record=self.delivered
+				elif bot.uploadAcked.wait(max(0,deadline-time.time())):
+					record=self.confirmed
+				else:
+					raise TimeoutError(f"{filename} not acknowledged by the bot within {settings.DEPLOY_CONFIRM_TIMEOUT}s")
+
+				result["uploaded"].append(filename)
+				with self.lock:
+					record.setdefault(bot.addr,{})[filename]=digest
+
+		except Exception as e:
+			result["ok"]=False
+			result["error"]=str(e)
+
+		result["seconds"]=time.time()-start
+		return result
+
+	def deploy(self,bots:dict,filenames:list=DEFAULT_PROGRAM_LIST,force:bool=False)->dict:
+		"""
+		bots: botId->pixelbot instance
+		force: upload even if the bot already has the same program
+
+		returns botId->{"ok","uploaded","skipped","seconds","error"}
+		"""
+		programs=[(filename,)+self._program(filename) for filename in filenames]
+
+		start=time.time()
+		with ThreadPoolExecutor(max_workers=self.maxConcurrent or settings.DEPLOY_CONCURRENCY) as pool:
+			futures={botId:pool.submit(self._deployOne,bot,programs,force) for botId,bot in bots.items()}
+			results={botId:future.result() for botId,future in futures.items()}
+		self._save()
+
+		for botId,res in results.items():
+			if res["ok"]:
+				Log.info("Deployed",bot=botId,uploaded=res["uploaded"],skipped=res["skipped"],seconds=res["seconds"])
+			else:
+				Log.warning("Deploy FAILED",bot=botId,error=res["error"],seconds=res["seconds"])
+		failed=sum(1 for res in results.values() if not res["ok"])
+		Log.info("Deployed to fleet",bots=len(results),failed=failed,seconds=time.time()-start)
+
+		return results
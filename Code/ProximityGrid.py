@@ -0,0 +1,215 @@
+# ProximityGrid.py
+#
+# uniform grid spatial hash over the arena (mm) for collision prediction
+#
+# bots (and the ball) are bucketed by cell. Each detection frame only the
+# entries whose cell changed are moved, so an update is O(n). A query only
+# looks at the cells around a point or a swept move so the per move cost
+# doesn't grow with the size of the fleet
+#
+# checkMove() is used to hold or shorten a bot move (turn angle, dist) which
+# would run into another bot or the destination another bot has been sent to.
+# Two bots can hold each other forever (head on, each in the other's way) so
+# a bot held AVOID_DETOUR_AFTER times in a row is given a short detour instead
+
+import math
+
+import numpy as np
+
+from config import settings
+
+
+def moveEnd(x:float,y:float,heading:float,angle:float,dist:float)->tuple:
+	"""
+	end point of a move, headings clockwise from North with y down the screen
+	"""
+	course=math.radians(heading+angle)
+	return x+dist*math.sin(course),y-dist*math.cos(course)
+
+
+def sweptEntry(x0:float,y0:float,x1:float,y1:float,px:float,py:float,clearance:float):
+	"""
+	fraction 0..1 along x0,y0->x1,y1 at which the mover first comes within
+	clearance of px,py or None if it never does. Moving away from a point
+	which is already too close is allowed
+	"""
+	dx,dy=x1-x0,y1-y0
+	fx,fy=x0-px,y0-py
+	a=dx*dx+dy*dy
+	b=2*(fx*dx+fy*dy)
+	c=fx*fx+fy*fy-clearance*clearance
+	if c<=0:
+		# already too close, only a problem if the move closes the gap
+		return 0.0 if b<0 else None
+	if a==0:
+		return None
+	disc=b*b-4*a*c
+	if disc<0:
+		return None
+	t=(-b-math.sqrt(disc))/(2*a)
+	return t if 0<=t<=1 else None
+
+
+class spatialHash:
+
+	def __init__(self,cellMM:float=None):
+		self.cellMM=cellMM or settings.AVOID_CELL_MM
+		self.cells={} # (i,j)->set of keys
+		self.cellOf={} # key->(i,j)
+		self.pos={} # key->(x,y) mm
+
+	def _cell(self,x:float,y:float)->tuple:
+		return (int(x//self.cellMM),int(y//self.cellMM))
+
+	def _bucket(self,key,cell:tuple)->None:
+		old=self.cellOf.get(key)
+		if old==cell:
+			return
+		if old is not None:
+			self.cells[old].discard(key)
+			if not self.cells[old]:
+				del self.cells[old]
+		self.cells.setdefault(cell,set()).add(key)
+		self.cellOf[key]=cell
+
+	def move(self,key,x:float,y:float)->None:
+		"""
+		add or move one entry
+		"""
+		self.pos[key]=(x,y)
+		self._bucket(key,self._cell(x,y))
+
+	def remove(self,key)->None:
+		cell=self.cellOf.pop(key,None)
+		if cell is None:
+			return
+		self.pos.pop(key,None)
+		self.cells[cell].discard(key)
+		if not self.cells[cell]:
+			del self.cells[cell]
+
+	def update(self,keys:list,xs,ys)->None:
+		"""
+		bulk update from a detection frame (positions in mm)
+		only entries which changed cell are re-bucketed
+		"""
+		cellsX=np.floor_divide(xs,self.cellMM).astype(int).tolist()
+		cellsY=np.floor_divide(ys,self.cellMM).astype(int).tolist()
+		for key,x,y,i,j in zip(keys,np.asarray(xs).tolist(),np.asarray(ys).tolist(),cellsX,cellsY):
+			self.pos[key]=(x,y)
+			self._bucket(key,(i,j))
+
+	def _candidates(self,minX:float,minY:float,maxX:float,maxY:float):
+		i0,j0=self._cell(minX,minY)
+		i1,j1=self._cell(maxX,maxY)
+		for i in range(i0,i1+1):
+			for j in range(j0,j1+1):
+				keys=self.cells.get((i,j))
+				if keys:
+					yield from keys
+
+	def near(self,x:float,y:float,radius:float,exclude=())->list:
+		"""
+		keys within radius of x,y
+		"""
+		found=[]
+		r2=radius*radius
+		for key in self._candidates(x-radius,y-radius,x+radius,y+radius):
+			if key in exclude:
+				continue
+			px,py=self.pos[key]
+			if (px-x)**2+(py-y)**2<=r2:
+				found.append(key)
+		return found
+
+	def firstHit(self,x0:float,y0:float,x1:float,y1:float,clearance:float,exclude=())->tuple:
+		"""
+		earliest entry along the swept move x0,y0->x1,y1
+		returns (fraction,key) or (None,None) if the path is clear
+		"""
+		best=(None,None)
+		minX,maxX=min(x0,x1)-clearance,max(x0,x1)+clearance
+		minY,maxY=min(y0,y1)-clearance,max(y0,y1)+clearance
+		for key in self._candidates(minX,minY,maxX,maxY):
+			if key in exclude:
+				continue
+			px,py=self.pos[key]
+			t=sweptEntry(x0,y0,x1,y1,px,py,clearance)
+			if t is not None and (best[0] is None or t<best[0]):
+				best=(t,key)
+		return best
+
+
+class proximityEngine:
+	"""
+	the bots, the ball and the destinations of moves already sent
+	"""
+	def __init__(self,cellMM:float=None):
+		self.grid=spatialHash(cellMM)
+		self.held={} # botId->moves held in a row
+
+	def update(self,botIds:list,xs,ys,ball=None)->None:
+		"""
+		bot positions and the ball in mm, ball None if it isn't in play
+		"""
+		self.grid.update(botIds,xs,ys)
+		if ball is None:
+			self.grid.remove("ball")
+		else:
+			self.grid.move("ball",ball[0],ball[1])
+
+	def reserve(self,botId,x:float,y:float)->None:
+		"""
+		other bots keep clear of where this bot has been sent
+		"""
+		self.grid.move(("dest",botId),x,y)
+
+	def release(self,botId)->None:
+		self.grid.remove(("dest",botId))
+
+	def _allowed(self,botId,x:float,y:float,heading:float,angle:float,dist:float,avoidBall:bool):
+		"""
+		dist shortened to stop short of the first bot or reserved
+		destination on the path, None if too little is left
+		"""
+		x1,y1=moveEnd(x,y,heading,angle,dist)
+		exclude={botId,("dest",botId)}
+		if not avoidBall:
+			exclude.add("ball")
+		clearance=2*settings.BOT_RADIUS_MM+settings.AVOID_MARGIN_MM
+		t,_=self.grid.firstHit(x,y,x1,y1,clearance,exclude)
+		if t is None:
+			return dist
+		allowed=int(t*dist)
+		if allowed<settings.AVOID_MIN_MOVE_MM:
+			return None
+		return allowed
+
+	def checkMove(self,botId,x:float,y:float,heading:float,angle:float,dist:float,avoidBall:bool=False):
+		"""
+		returns the angle,dist to move or None to hold the move
+
+		dist is shortened to stop short of the first bot or reserved
+		destination on the path. Once a bot's moves have been held
+		AVOID_DETOUR_AFTER times in a row the turns in AVOID_DETOUR_DEG are
+		tried, a bot length at most, clockwise first so two bots meeting head
+		on both step to their right and pass
+		"""
+		if dist<=0:
+			return angle,dist
+		allowed=self._allowed(botId,x,y,heading,angle,dist,avoidBall)
+		if allowed is not None:
+			self.held.pop(botId,None)
+			return angle,allowed
+		held=self.held.get(botId,0)+1
+		self.held[botId]=held
+		if held<settings.AVOID_DETOUR_AFTER:
+			return None
+		step=min(dist,2*settings.BOT_RADIUS_MM+settings.AVOID_MARGIN_MM)
+		for turn in settings.AVOID_DETOUR_DEG:
+			detour=(angle+turn+180)%360-180
+			allowed=self._allowed(botId,x,y,heading,detour,step,avoidBall)
+			if allowed is not None:
+				self.held.pop(botId,None)
+				return detour,allowed
+		return None
@@ -0,0 +1,84 @@
+# Startup.py
+#
+# startup timeline and parallel startup tasks for ArenaManager
+#
+# slow startup steps (camera warm up, MQTT connections, Flask import) run in
+# their own threads. Every step is recorded on the timeline so time to first
+# detection and time to FINDING_BOTS can be tracked.
+
+import json
+import threading
+import time
+
+PROCESS_START=time.monotonic() # as near to process start as we can get
+
+
+class startupTimeline:
+
+	def __init__(self,start:float=PROCESS_START):
+		self.start=start
+		self.events=[] # (seconds since start,name,thread name)
+		self.lock=threading.Lock()
+		self.marked=set()
+
+	def mark(self,name:str)->float:
+		"""
+		record an event, returns seconds since start
+		"""
+		t=time.monotonic()-self.start
+		with self.lock:
+			self.events.append((t,name,threading.current_thread().name))
+			self.marked.add(name)
+		return t
+
+	def markOnce(self,name:str)->None:
+		"""
+		for events spotted in the game loop e.g. first detection
+		"""
+		if name not in self.marked:
+			self.mark(name)
+
+	def report(self)->None:
+		print("Startup timeline",flush=True)
+		with self.lock:
+			for t,name,thread in sorted(self.events):
+				print(f"  {t:7.3f}s  {name:30s} [{thread}]",flush=True)
+
+	def save(self,path:str)->None:
+		with self.lock:
+			events=[{"t":round(t,4),"event":name,"thread":thread} for t,name,thread in sorted(self.events)]
+		with open(path,"w") as f:
+			json.dump(events,f,indent=1)
+
+
+timeline=startupTimeline()
+
+
+def runParallel(tasks:dict)->dict:
+	"""
+	tasks: name->callable, each is run in its own thread
+
+	returns name->result. An exception in a task is re-raised here
+	once all the tasks have finished
+	"""
+	results={}
+	errors={}
+
+	def _run(name,task):
+		timeline.mark(f"{name} started")
+		try:
+			results[name]=task()
+			timeline.mark(f"{name} ready")
+		except Exception as e:
+			errors[name]=e
+			timeline.mark(f"{name} FAILED")
+
+	threads=[threading.Thread(target=_run,args=(name,task),name=name) for name,task in tasks.items()]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	for name,e in errors.items():
+		raise RuntimeError(f"startup task {name} failed") from e
+	return results
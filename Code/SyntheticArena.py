@@ -0,0 +1,292 @@
+# SyntheticArena.py
+#
+# renders arena frames with known marker corners and ball position
+# so detection can be measured without a camera
+
+import cv2
+import math
+import random
+import numpy as np
+
+from config import settings
+from VideoDetectorLib import MARKER_DICT,displaySize
+
+BACKGROUND=200 # light grey arena floor
+BALL_COLOUR=(0,140,255) # BGR orange
+
+
+def _markerImage(markerId:int,sidePx:int):
+	"""
+	opencv 4.7 renamed drawMarker to generateImageMarker
+	"""
+	if hasattr(cv2.aruco,"generateImageMarker"):
+		return cv2.aruco.generateImageMarker(MARKER_DICT,markerId,sidePx)
+	return cv2.aruco.drawMarker(MARKER_DICT,markerId,sidePx)
+
+
+def markerCorners(cx:float,cy:float,heading:float,sidePx:float):
+	"""
+	returns the 4x2 corners (TL,TR,BR,BL in marker order) of a marker
+	centred on cx,cy rotated clockwise by heading degrees
+	"""
+	half=sidePx/2
+	rad=math.radians(heading)
+	c,s=math.cos(rad),math.sin(rad)
+	pts=[(-half,-half),(half,-half),(half,half),(-half,half)]
+	return np.array([(cx+x*c-y*s,cy+x*s+y*c) for x,y in pts],dtype=np.float32)
+
+
+def renderArena(width:int,height:int,scale_px_per_mm:float,markers:dict,ball=None,noise:float=2.0,seed:int=0,varied:bool=False)->tuple:
+	"""
+	markers: dict id->(cx,cy,rotation,sideMM) cx,cy in pixels
+	ball: (cx,cy) in pixels or None
+	varied: textured floor with clutter, and a ball whose hue, saturation,
+	brightness, shading and blur change with the seed (see variedBall).
+	Otherwise a flat floor and a flat BALL_COLOUR disc
+
+	returns bgrFrame,truth where truth is a dict id->4x2 corners
+	"""
+	rng=np.random.default_rng(seed)
+	gray=texturedFloor(width,height,rng) if varied else np.full((height,width),BACKGROUND,dtype=np.uint8)
+	truth={}
+
+	for markerId,(cx,cy,rotation,sideMM) in markers.items():
+		sidePx=max(8,int(round(sideMM*scale_px_per_mm)))
+		img=_markerImage(markerId,sidePx)
+
+		# white quiet zone so the marker stands out from the floor
+		pad=max(2,sidePx//4)
+		img=cv2.copyMakeBorder(img,pad,pad,pad,pad,cv2.BORDER_CONSTANT,value=255)
+
+		# rotate about the image centre and move to cx,cy
+		centre=((img.shape[1]-1)/2,(img.shape[0]-1)/2)
+		M=cv2.getRotationMatrix2D(centre,-rotation,1.0)
+		M[0,2]+=cx-centre[0]
+		M[1,2]+=cy-centre[1]
+		cv2.warpAffine(img,M,(width,height),dst=gray,flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_TRANSPARENT)
+
+		# outer marker edge sits half a pixel outside the first/last pixel centres
+		truth[markerId]=markerCorners(cx,cy,rotation,sidePx)
+
+	frame=cv2.cvtColor(gray,cv2.COLOR_GRAY2BGR)
+	radius=settings.BALL_DIA_MM*scale_px_per_mm/2
+
+	if varied:
+		addClutter(frame,radius,rng)
+
+	if ball is not None:
+		if varied:
+			variedBall(frame,ball,radius,rng)
+		else:
+			cv2.circle(frame,(int(ball[0]),int(ball[1])),int(radius),BALL_COLOUR,-1)
+
+	if noise>0:
+		frame=cv2.add(frame,rng.normal(0,noise,frame.shape).astype(np.int8),dtype=cv2.CV_8U)
+
+	return frame,truth
+
+
+def texturedFloor(width:int,height:int,rng)->np.ndarray:
+	"""
+	grey floor lit unevenly, mottled, with a few dark tape lines
+	"""
+	# lighting falls off away from a random hot spot
+	y,x=np.mgrid[0:height,0:width].astype(np.float32)
+	hx,hy=rng.uniform(0,width),rng.uniform(0,height)
+	light=1.0-0.35*np.hypot(x-hx,y-hy)/math.hypot(width,height)
+
+	# low frequency mottling
+	coarse=rng.normal(0,1,(max(2,height//32),max(2,width//32))).astype(np.float32)
+	mottle=cv2.resize(coarse,(width,height),interpolation=cv2.INTER_CUBIC)*8
+
+	floor=np.clip(BACKGROUND*light+mottle,0,255).astype(np.uint8)
+	for _ in range(3):
+		p1=(int(rng.uniform(0,width)),int(rng.uniform(0,height)))
+		p2=(int(rng.uniform(0,width)),int(rng.uniform(0,height)))
+		cv2.line(floor,p1,p2,int(rng.uniform(40,120)),int(rng.uniform(2,6)),cv2.LINE_AA)
+	return floor
+
+
+def addClutter(frame,ballRadius:float,rng,count:int=6)->None:
+	"""
+	things which are not the ball: coloured tape, boxes and a few
+	orangey ones, none of them round
+	"""
+	height,width=frame.shape[:2]
+	for _ in range(count):
+		hue=rng.uniform(5,25) if rng.random()<0.4 else rng.uniform(0,180)
+		colour=_hsvToBgr(hue,rng.uniform(120,255),rng.uniform(100,230))
+		cx,cy=rng.uniform(0,width),rng.uniform(0,height)
+		if rng.random()<0.5:
+			# tape strip
+			length=rng.uniform(3,8)*ballRadius
+			angle=rng.uniform(0,math.pi)
+			dx,dy=math.cos(angle)*length/2,math.sin(angle)*length/2
+			cv2.line(frame,(int(cx-dx),int(cy-dy)),(int(cx+dx),int(cy+dy)),colour,max(2,int(ballRadius*rng.uniform(0.2,0.5))),cv2.LINE_AA)
+		else:
+			# box, long and thin so it never passes as a circle
+			w,h=ballRadius*rng.uniform(2.5,4),ballRadius*rng.uniform(0.6,1.2)
+			box=cv2.boxPoints(((cx,cy),(w,h),rng.uniform(0,180)))
+			cv2.fillConvexPoly(frame,box.astype(np.int32),colour,cv2.LINE_AA)
+
+
+def variedBall(frame,ball,radius:float,rng)->None:
+	"""
+	the ball as a camera might see it: hue either side of orange, faded or
+	dark, lit from one side and blurred by focus or motion
+	"""
+	height,width=frame.shape[:2]
+	colour=np.array(_hsvToBgr(rng.uniform(4,28),rng.uniform(110,255),rng.uniform(110,255)),dtype=np.float32)
+
+	pad=int(radius*2)+2
+	x0,y0=max(0,int(ball[0])-pad),max(0,int(ball[1])-pad)
+	x1,y1=min(width,int(ball[0])+pad),min(height,int(ball[1])+pad)
+	roi=frame[y0:y1,x0:x1].astype(np.float32)
+
+	y,x=np.mgrid[y0:y1,x0:x1].astype(np.float32)
+	dx,dy=x-ball[0],y-ball[1]
+	disc=np.clip(radius+0.5-np.hypot(dx,dy),0,1)[...,None]
+
+	# brighter towards the light, darker on the far side
+	angle=rng.uniform(0,2*math.pi)
+	towards=(dx*math.cos(angle)+dy*math.sin(angle))/radius
+	shade=np.clip(1.0+0.25*towards,0.6,1.25)[...,None]
+
+	# the ball and its outline are blurred, the floor behind stays sharp
+	ballLayer=np.clip(colour*shade,0,255)*disc
+	if rng.random()<0.5:
+		sigma=rng.uniform(0,radius*0.12)
+		if sigma>0.3:
+			ballLayer=cv2.GaussianBlur(ballLayer,(0,0),sigma)
+			disc=cv2.GaussianBlur(disc,(0,0),sigma)[...,None]
+	else:
+		length=int(rng.uniform(1,radius*0.5))
+		if length>1:
+			kernel=np.zeros((length,length),dtype=np.float32)
+			cv2.line(kernel,(0,int(rng.uniform(0,length))),(length-1,int(rng.uniform(0,length))),1.0)
+			kernel/=kernel.sum()
+			ballLayer=cv2.filter2D(ballLayer,-1,kernel)
+			disc=cv2.filter2D(disc,-1,kernel)[...,None]
+	roi=roi*(1-disc)+ballLayer
+	frame[y0:y1,x0:x1]=np.clip(roi,0,255).astype(np.uint8)
+
+
+def _hsvToBgr(hue:float,saturation:float,value:float)->tuple:
+	"""
+	OpenCV HSV (hue 0-179) to a BGR tuple
+	"""
+	hsv=np.uint8([[[int(hue)%180,int(saturation),int(value)]]])
+	return tuple(int(c) for c in cv2.cvtColor(hsv,cv2.COLOR_HSV2BGR)[0,0])
+
+
+def randomLayout(width:int,height:int,scale_px_per_mm:float,seed:int=0,withBall:bool=True,cfg=settings)->tuple:
+	"""
+	bases down each side, the calibration marker top centre and the
+	bots scattered at random headings
+
+	cfg is the arena's settings (teams and bases)
+
+	returns markers,ball in the form used by renderArena
+	"""
+	rnd=random.Random(seed)
+	markers={}
+
+	baseSide=settings.HOMEBASE_SIDELEN_MM
+	step=height/(len(cfg.TEAM0_BASES)+1)
+	for i,baseId in enumerate(cfg.TEAM0_BASES):
+		markers[baseId]=(width*0.08,step*(i+1),0,baseSide)
+	for i,baseId in enumerate(cfg.TEAM1_BASES):
+		markers[baseId]=(width*0.92,step*(i+1),0,baseSide)
+
+	calibrationY=height*0.04+settings.CALIBRATION_SIZE_MM*scale_px_per_mm
+	markers[settings.CALIBRATION_MARKER]=(width/2,calibrationY,0,settings.CALIBRATION_SIZE_MM)
+
+	# keep bots apart so their quiet zones don't overlap
+	clearance=settings.SMALLEST_MARKER_MM*scale_px_per_mm*1.6
+	placed=[]
+	for botId in cfg.TEAM0_BOTS+cfg.TEAM1_BOTS:
+		for _ in range(100):
+			cx=rnd.uniform(width*0.2,width*0.8)
+			cy=rnd.uniform(height*0.2,height*0.9)
+			if all(math.hypot(cx-x,cy-y)>clearance for x,y in placed):
+				break
+		placed.append((cx,cy))
+		markers[botId]=(cx,cy,rnd.uniform(0,360),settings.SMALLEST_MARKER_MM)
+
+	ball=None
+	if withBall:
+		ball=(rnd.uniform(width*0.3,width*0.7),height*0.5)
+
+	return markers,ball
+
+
+class syntheticCamera:
+	"""
+	stands in for Picamera2 so arucoDetector can run without a camera
+	
+	cycles through count pre-rendered frames, each with a different layout
+	
+	format is "RGB888" (BGR frames) or "YUV420" (I420 frames, height*3/2 rows
+	with the chroma planes below the Y plane, plus a DISPLAY_WIDTH lores
+	stream) as they come from the pi camera. Default settings.CAPTURE_FORMAT
+	"""
+	def __init__(self,width:int,height:int,scale_px_per_mm:float,count:int=4,cfg=settings,format:str=None):
+		self.size=(width,height)
+		self.format=format or settings.CAPTURE_FORMAT
+		self.lores=None
+		if self.format=="YUV420" and displaySize(width,height)!=self.size:
+			self.lores=displaySize(width,height)
+		frames=[]
+		self.truth=[]
+		for seed in range(count):
+			markers,ball=randomLayout(width,height,scale_px_per_mm,seed=seed,cfg=cfg)
+			frame,truth=renderArena(width,height,scale_px_per_mm,markers,ball,seed=seed)
+			frames.append(frame)
+			self.truth.append((truth,ball))
+		self.setFrames(frames)
+		self.index=0
+		
+	def setFrames(self,frames:list)->None:
+		"""
+		replace the frames with BGR frames of the camera's size
+		"""
+		self.frames=[]
+		self.loresFrames=[]
+		for frame in frames:
+			if self.format=="YUV420":
+				if self.lores is not None:
+					small=cv2.resize(frame,self.lores,interpolation=cv2.INTER_AREA)
+					self.loresFrames.append(_readOnly(cv2.cvtColor(small,cv2.COLOR_BGR2YUV_I420)))
+				frame=cv2.cvtColor(frame,cv2.COLOR_BGR2YUV_I420)
+			self.frames.append(_readOnly(frame))
+		
+	def start(self):
+		pass
+		
+	def stop(self):
+		pass
+		
+	def camera_configuration(self)->dict:
+		"""
+		the parts of Picamera2.camera_configuration() arucoDetector reads
+		"""
+		lores=None if self.lores is None else {"size":self.lores,"format":"YUV420"}
+		return {"main":{"size":self.size,"format":self.format},"lores":lores}
+		
+	def capture_array(self,name:str="main"):
+		"""
+		the detector copies the frame into its own buffer, or only reads
+		it in YUV420 mode, so the pre-rendered frame is returned read-only
+		
+		"lores" is the lores version of the last "main" frame
+		"""
+		if name=="lores":
+			return self.loresFrames[(self.index-1)%len(self.loresFrames)]
+		frame=self.frames[self.index%len(self.frames)]
+		self.index+=1
+		return frame
+
+
+def _readOnly(frame):
+	frame.flags.writeable=False
+	return frame
@@ -1,14 +1,23 @@
 # picamera2 only available on a pi
-from picamera2 import Picamera2,Preview
+try:
+	from picamera2 import Picamera2,Preview,MappedArray
+except ImportError:
+	Picamera2=None # recorded or synthetic frames can still be processed off the pi
+	MappedArray=None
 import cv2
 import threading # for locking
 import numpy as np
 import time
 import traceback
+from contextlib import ExitStack
 import sys
 import imutils
 import itertools # for zipping
 import MiscLib
+import Metrics
+import Log
+import BallDetectors
+from FrameExchange import frameExchange
 import math
 import os
 
@@ -17,60 +26,366 @@ USE_GRAY=True
 # stop most libcamera logging
 os.environ["LIBCAMERA_LOG_LEVELS"]="3" # allow ERROR and FATAL only
 
-from config import settings
+from config import settings,lookups
 
 MARKER_DICT=cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
 
+SUBPIX_CRITERIA=(cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER,30,0.01)
+
+# stage aware workload (settings.WORKLOADS)
+WORKLOAD_DETECTORS=("markers","calibrate","ball")
+BACKOFF_HOLD_FRAMES=30 # frames between backoff changes
+BACKOFF_RECOVER=0.6 # speed up again under this fraction of the budget
+
+
+def pickDownscale(scale_px_per_mm:float,smallestMarkerMM:float=None)->int:
+	"""
+	choose the pyramid downscale factor (1,2,4..) for coarse detection
+	
+	the smallest expected marker must still be MIN_DETECT_MARKER_PX on a
+	side at the downscaled level otherwise detectMarkers will miss it
+	
+	smallestMarkerMM defaults to settings.SMALLEST_MARKER_MM, read on each
+	call so a settings reload takes effect
+	"""
+	if smallestMarkerMM is None:
+		smallestMarkerMM=settings.SMALLEST_MARKER_MM
+	markerPx=smallestMarkerMM*scale_px_per_mm
+	factor=1
+	while factor*2<=settings.MAX_DETECT_DOWNSCALE and markerPx/(factor*2)>=settings.MIN_DETECT_MARKER_PX:
+		factor*=2
+	return factor
+
+
+def detectMarkersFull(gray)->tuple:
+	"""
+	detectMarkers on the full resolution frame
+	
+	returns corners,ids as returned by cv2.aruco.detectMarkers
+	"""
+	corners,ids,_=cv2.aruco.detectMarkers(gray,MARKER_DICT)
+	return corners,ids
+
+
+def detectMarkersCoarseToFine(gray,factor:int)->tuple:
+	"""
+	search for markers on a pyramid level downscaled by factor (a power of 2)
+	then map the corners back to full resolution and refine them with
+	cornerSubPix in small windows on the full resolution frame
+	
+	returns corners,ids in the same form as cv2.aruco.detectMarkers
+	"""
+	if factor<=1:
+		return detectMarkersFull(gray)
+	
+	small=gray
+	level=1
+	while level<factor:
+		small=cv2.pyrDown(small)
+		level*=2
+	
+	corners,ids,_=cv2.aruco.detectMarkers(small,MARKER_DICT)
+	if ids is None:
+		return corners,ids
+		
+	# pyrDown keeps pixel i centred on full res pixel 2i
+	pts=np.concatenate(corners).reshape(-1,1,2).astype(np.float32)*factor
+	
+	# the coarse corner can be up to ~factor pixels out
+	win=max(settings.SUBPIX_WINDOW,factor+1)
+	cv2.cornerSubPix(gray,pts,(win,win),(-1,-1),SUBPIX_CRITERIA)
+	
+	refined=tuple(pts[i*4:i*4+4].reshape(1,4,2) for i in range(len(ids)))
+	return refined,ids
+
+
+def displaySize(width:int,height:int,displayWidth:int=None)->tuple:
+	"""
+	width,height of the colour frame in YUV420 mode, displayWidth (default
+	settings.DISPLAY_WIDTH) wide keeping the aspect ratio, never bigger than
+	the capture. Even so the lores stream's chroma planes line up
+	"""
+	displayWidth=displayWidth or settings.DISPLAY_WIDTH
+	if displayWidth>=width:
+		return width,height
+	return displayWidth,int(round(height*displayWidth/width/2))*2
+
+
+def sensorTime(metadata:dict)->float:
+	"""
+	capture time from picamera2 request metadata
+	
+	SensorTimestamp is the start of exposure in CLOCK_MONOTONIC nanoseconds,
+	the clock time.monotonic() uses on linux. Anything implausible falls
+	back to now
+	"""
+	now=time.monotonic()
+	stamp=metadata.get("SensorTimestamp")
+	if stamp is None:
+		return now
+	captured=stamp/1e9
+	return captured if 0<=now-captured<1 else now
+
 
 class arucoDetector:
 	"""arucoDetector
 	
 	Initialises the camera , aruco dict and grabs the first frame
+	
+	camera is for running without a pi camera, any object with start(),
+	stop() and capture_array() e.g. SyntheticArena.syntheticCamera
+	otherwise picamera2 camera cameraNum is used
+	
+	with settings.CAPTURE_FORMAT "YUV420" (or a camera whose
+	camera_configuration() says so) markers are found on the Y plane of
+	the camera's buffer and frames are only converted to colour, at the
+	display size, while something reads them (luma mode)
+	
+	idTables are the lookups of the arena's bots and bases, default the shared lookups
 	"""
-	def __init__(self,width:int=settings.VIDEO_WIDTH,height:int=settings.VIDEO_HEIGHT,)->None:
+	def __init__(self,width:int=settings.VIDEO_WIDTH,height:int=settings.VIDEO_HEIGHT,camera=None,cameraNum:int=0,idTables=lookups,name:str="")->None:
 
 		# pixel/mm ratio will be updated if marker with settings.CALIBRATION_MARKER is found
 		# it is recommended that the marker is always present in case the camera position changes
 		self.scale_px_per_mm=settings.INITIAL_SCALE_FACTOR 
+		self.lookups=idTables
+		self.name=name # the arena label of its metrics
 		
-		self.cam=Picamera2()
-
-		camera_config=self.cam.create_still_configuration(main={"size": (width,height),'format':"RGB888"})
-		self.cam.configure(camera_config)
+		if camera is None:
+			self.cam=Picamera2(cameraNum)
+
+			if settings.CAPTURE_FORMAT=="YUV420":
+				# the lores stream is the colour frame for viewers, the ISP scales it.
+				# Two buffers so the camera fills one while detection reads the other
+				lores=displaySize(width,height)
+				lores=None if lores==(width,height) else {"size":lores,"format":"YUV420"}
+				camera_config=self.cam.create_still_configuration(main={"size": (width,height),'format':"YUV420"},lores=lores,buffer_count=2)
+			else:
+				camera_config=self.cam.create_still_configuration(main={"size": (width,height),'format':"RGB888"})
+			self.cam.configure(camera_config)
+		else:
+			self.cam=camera
 
+		self.width,self.height=width,height
+		self.luma,self.loresSize=self._cameraFormat()
 		self.cam.start()
 		self.markers={}
 
-		time.sleep(2) # wait for camera to warm up
 		self.lock=threading.Lock()
 		
 		# just to mitigate against start up race conditions
-		self.frame=self.cam.capture_array()
-		self.gray=self.frame.copy()
+		first=self._waitForCamera()
+		
+		# annotated frames are handed to readers through pooled buffers,
+		# self.frame is the one being drawn on (see FrameExchange.py)
+		if self.luma:
+			# display sized colour frames, self.gray is a view of each capture's Y plane
+			displayWidth,displayHeight=self.loresSize or displaySize(width,height)
+			self.frames=frameExchange((displayHeight,displayWidth,3),first.dtype)
+			self.frame=self.frames.acquire()
+			self.frame.fill(0)
+			self.gray=first[:height,:width]
+		else:
+			self.frames=frameExchange(first.shape,first.dtype)
+			self.frame=self.frames.acquire()
+			np.copyto(self.frame,first)
+			self.gray=cv2.cvtColor(first,cv2.COLOR_BGR2GRAY)
+		self.frames.publish(0)
+		
+		self.yuv=None # luma mode: the capture, I420 planes
+		self.request=None # luma mode on the pi: the camera request being read
+		self.held=ExitStack() # luma mode: releases the capture, see _releaseFrame()
+		self.displayReady=False # luma mode: self.frame holds this capture in colour
+		self.lastViewed=None # time.monotonic() of the last getFrame() or leaseFrame()
 		
-		self.threshold=self.frame.copy()
+		self.threshold=None if USE_GRAY else np.empty((height,width),np.uint8)
 		self.edges=None
 		self.blurred=None
 		self.mask=None
 		
-		self.ballPos=(0,0)		
+		self.ballPos=(None,None) # set by _findTheBall
+		self.ballDrawn=None # (x,y),radius found on this frame, drawn by _annotate()
+		
+		self.detectDownscale=1 # updated by _grabFrame in pyramid mode
+		self.frameNumber=0 # counts frames grabbed
+		self.captureTime=time.monotonic() # when the last frame was captured, see getCaptureTime()
+		
+		# stage aware workload, see setWorkload()
+		self.workloadStage="default"
+		self.backoff=0 # detector rates are halved this many times
+		self.backoffChanged=0 # frameNumber of the last backoff change
+		self.processMs=None # smoothed update() time excluding the camera wait
+		self.captureSeconds=0
+		self.lastDetection=(None,None) # corners,ids redrawn on frames which skip the marker search
 			
 		#logging.info("VideoDetectorLib started")
 		
 			
+	def _waitForCamera(self):
+		"""
+		wait for the camera to warm up
+		
+		frames are grabbed until the exposure settles, i.e. the mean brightness
+		changes by less than CAMERA_SETTLE_DELTA between frames, or
+		CAMERA_READY_TIMEOUT expires
+		
+		returns the last frame
+		"""
+		start=time.monotonic()
+		frame=self.cam.capture_array() # blocks till the first frame arrives
+		lastMean=frame[::8,::8].mean()
+		while time.monotonic()-start<settings.CAMERA_READY_TIMEOUT:
+			frame=self.cam.capture_array()
+			mean=frame[::8,::8].mean()
+			if abs(mean-lastMean)<=settings.CAMERA_SETTLE_DELTA*max(lastMean,1):
+				break
+			lastMean=mean
+		return frame
+		
+	def _cameraFormat(self)->tuple:
+		"""
+		returns luma,loresSize from the camera's configuration. luma is True
+		for YUV420 frames, loresSize the (width,height) of a lores stream to
+		make colour frames from or None. Cameras without a
+		camera_configuration() give BGR frames
+		"""
+		try:
+			camera_config=self.cam.camera_configuration()
+		except AttributeError:
+			return False,None
+		luma=camera_config["main"]["format"]=="YUV420"
+		lores=camera_config.get("lores")
+		if not luma or not lores:
+			return luma,None
+		return luma,tuple(lores["size"])
+		
 	def __del__(self):
 		""" terminate the camera feed
 		"""
+		if getattr(self,"held",None) is not None:
+			self._releaseFrame()
 		self.cam.stop()
 		
+	def _capture(self,buf)->float:
+		"""
+		copy the next camera frame into buf
+		
+		on the pi the frame is copied straight out of the camera's
+		buffer, capture_array() would allocate a new array each frame
+		
+		returns the capture time (time.monotonic() clock), from the
+		request metadata on the pi otherwise when the frame arrived
+		"""
+		if MappedArray is not None and isinstance(self.cam,Picamera2):
+			request=self.cam.capture_request()
+			try:
+				with MappedArray(request,"main") as mapped:
+					np.copyto(buf,mapped.array[:buf.shape[0],:buf.shape[1]])
+				return sensorTime(request.get_metadata())
+			finally:
+				request.release()
+		np.copyto(buf,self.cam.capture_array())
+		return time.monotonic()
+		
+	def _captureLuma(self)->float:
+		"""
+		luma mode: self.yuv becomes the next YUV420 frame and self.gray
+		its Y plane, both views, nothing is copied or converted
+		
+		on the pi the request stays mapped, and out of the camera's
+		hands, till _releaseFrame()
+		
+		returns the capture time as _capture()
+		"""
+		self._releaseFrame()
+		if MappedArray is not None and isinstance(self.cam,Picamera2):
+			self.request=self.cam.capture_request()
+			self.held.callback(self.request.release)
+			self.yuv=self.held.enter_context(MappedArray(self.request,"main")).array
+			captured=sensorTime(self.request.get_metadata())
+		else:
+			self.yuv=self.cam.capture_array("main")
+			captured=time.monotonic()
+		# rows past the height are chroma, columns past the width padding
+		self.gray=self.yuv[:self.height,:self.width]
+		self.displayReady=False
+		return captured
+		
+	def _releaseFrame(self)->None:
+		"""
+		luma mode: hand the capture back to the camera, on the pi
+		self.gray and self.yuv are unmapped with it
+		"""
+		if self.request is not None:
+			self.request=None
+			self.yuv=self.gray=None
+		self.held.close()
+		
+	def _displayFrame(self):
+		"""
+		luma mode: this capture in colour at the display size, converted
+		once per frame into the buffer readers get next. From the lores
+		stream if there is one, otherwise from the capture
+		"""
+		if self.displayReady:
+			return self.frame
+		with Metrics.stopwatch(Metrics.stageSeconds,self.name,"display"):
+			self.frame=self.frames.acquire()
+			displayHeight,displayWidth=self.frame.shape[:2]
+			if self.loresSize is None:
+				source,sourceWidth=self.yuv,self.width
+			elif self.request is not None:
+				source=self.held.enter_context(MappedArray(self.request,"lores")).array
+				sourceWidth=self.loresSize[0]
+			else:
+				source=self.cam.capture_array("lores")
+				sourceWidth=self.loresSize[0]
+			if source.shape==(displayHeight*3//2,displayWidth):
+				cv2.cvtColor(source,cv2.COLOR_YUV2BGR_I420,dst=self.frame)
+			else:
+				# padded rows or no lores stream, picamera2's chroma planes use half the row stride
+				colour=cv2.cvtColor(source,cv2.COLOR_YUV2BGR_I420)[:,:sourceWidth]
+				cv2.resize(colour,(displayWidth,displayHeight),dst=self.frame,interpolation=cv2.INTER_AREA)
+		self.displayReady=True
+		return self.frame
+		
+	def _viewed(self)->bool:
+		"""
+		True while frames have been read in the last DISPLAY_IDLE_S
+		"""
+		return self.lastViewed is not None and time.monotonic()-self.lastViewed<settings.DISPLAY_IDLE_S
+		
+	def _annotate(self,frame)->None:
+		"""
+		draw this frame's markers and ball on frame, scaled if frame is
+		the display sized colour frame of luma mode
+		"""
+		ratio=frame.shape[1]/self.width
+		corners,ids=self.lastDetection
+		if ids is not None:
+			if ratio!=1:
+				corners=tuple(corner*ratio for corner in corners)
+			cv2.aruco.drawDetectedMarkers(frame,corners,ids)
+		if self.ballDrawn is not None:
+			(x,y),radius=self.ballDrawn
+			centre=(int(x*ratio),int(y*ratio))
+			# circle center
+			cv2.circle(frame, centre, 1, (0, 100, 100), 3)
+			# circle outline
+			cv2.circle(frame, centre, max(int(radius*ratio),1), (255, 0, 255), 3)
+		
 
-	def _grabFrame(self) ->(any,dict):
+	def _grabFrame(self,profile:dict=None) ->(any,dict):
 		"""grabFrame()
 		
 		must be called frequently from update() method
 
-		Identifies any aruco markers it can then
-		draws the detected markers on the frame
+		Identifies any aruco markers it can, update() draws them
+		on the frame
+		
+		profile is the workload profile, None uses the current one.
+		On frames where the profile skips the marker search the
+		previous markers are kept
 		
 		if marker ID = setting.CALIBRATION_MARKER computes the pixel to mm ratio.
 		for all other markers computes the centre and angle of rotation.
@@ -80,26 +395,65 @@ class arucoDetector:
 		"""
 		with self.lock:
 			# could use a callback - this blocks till a frame is captured
-			self.frame=self.cam.capture_array()
-
-			# convert to grey scale
-			self.gray=cv2.cvtColor(self.frame,cv2.COLOR_BGR2GRAY)
+			start=time.perf_counter()
+			if self.luma:
+				self.captureTime=self._captureLuma()
+			else:
+				self.frame=self.frames.acquire()
+				self.captureTime=self._capture(self.frame)
+			self.frameNumber+=1
+			captured=time.perf_counter()
+			self.captureSeconds=captured-start
+			Metrics.stageSeconds.observe(self.captureSeconds,self.name,"capture")
+			Metrics.framesCaptured.inc(self.name)
+			Metrics.captureFps.tick(self.name)
+
+			# convert to grey scale, reusing the buffer. Luma mode has it already
+			if not self.luma:
+				cv2.cvtColor(self.frame,cv2.COLOR_BGR2GRAY,dst=self.gray)
+			self.ballDrawn=None
+			
+			if profile is None:
+				profile=self._profile()
+			if not self._due(profile,"markers"):
+				# keep the last markers, they are shown on this frame
+				return
 			
 			# enhance black/white for marker detection
 			if not USE_GRAY:
-				_, self.threshold = cv2.threshold(self.gray, settings.BW_THRESHOLD, 255, cv2.THRESH_BINARY)
+				cv2.threshold(self.gray, settings.BW_THRESHOLD, 255, cv2.THRESH_BINARY, dst=self.threshold)
 
-			# scan for any markers and draw them 
+			# scan for any markers
 			self.markers={}
-			if USE_GRAY:
+			downscale=profile.get("downscale")
+			if downscale is not None:
+				# the stage fixes the search resolution
+				self.detectDownscale=downscale
+				if downscale>1:
+					corners, ids = detectMarkersCoarseToFine(self.gray,downscale)
+				else:
+					corners, ids = detectMarkersFull(self.gray)
+			elif settings.DETECTION_MODE=="pyramid":
+				# downscale depends on the scale which follows the camera height
+				self.detectDownscale=pickDownscale(self.scale_px_per_mm)
+				corners, ids = detectMarkersCoarseToFine(self.gray,self.detectDownscale)
+			elif USE_GRAY:
+				self.detectDownscale=1
 				corners, ids, _ = cv2.aruco.detectMarkers(self.gray,MARKER_DICT) 
 			else:
+				self.detectDownscale=1
 				corners, ids, _ = cv2.aruco.detectMarkers(self.threshold,MARKER_DICT)
 				
+			self.lastDetection=(corners,ids)
 			if ids is not None:
-				cv2.aruco.drawDetectedMarkers(self.frame, corners,ids)
 				for aruco_id,corners in zip(ids, corners):
 					self.markers[aruco_id[0]]=corners
+
+			Metrics.stageSeconds.observe(time.perf_counter()-captured,self.name,"detect")
+			Metrics.framesDetected.inc(self.name)
+			Metrics.detectFps.tick(self.name)
+			Metrics.markersPerFrame.set(len(self.markers),self.name)
+			Metrics.markersDetected.add(len(self.markers),self.name)
 					
 	def _doCalibration(self):
 		"""
@@ -126,60 +480,38 @@ class arucoDetector:
 				self.scale_px_per_mm=newScale
 
 	
-	def _checkBall(self,contours,scaledBallRadiusPx,minRadiusPx,maxRadiusPx):
-		for i,contour in enumerate(contours):
-			if i==0:
-				continue
-			
-			# more approx vertices means more likely to be a circle
-			# hexagon has 6
-			approx=cv2.approxPolyDP(contour,0.01*cv2.arcLength(contour,True),True)
-			
-			if len(approx)>10: # bigger than a nonogon
-				(x,y,w,h)=cv2.boundingRect(contour)
-				aspect=w/h
-
-				# the aspect ratio of a circle is 1.0 exactly viewed square on
-				if aspect>=0.9 and aspect<=1.1: 
-					(x,y),radius = cv2.minEnclosingCircle(contour)
-					
-
-					# ball has a certain size - or range thereof
-					if radius>minRadiusPx and radius<maxRadiusPx:
-						logging.info(f"minRadiusPx {minRadiusPx} maxRadiusPx {maxRadiusPx} scaled {scaledBallRadiusPx} scale {self.scale_px_per_mm} FOUND RADIUS {radius}")
-
-						logging.info(f"Possible ball candidate ball radius {radius}")
-						#cv2.drawContours(self.frame, [contour], -1, (0, 255, 0), 3) # -1 means filled
-
-						self.ballPos=(int(x),int(y))
-
-						cv2.circle(self.frame,self.ballPos,int(radius),(0,255,0),2)
-
-
-	def _findTheBall(self,radiusTolerance=settings.BALL_TOLERANCE):
+	def _findTheBall(self,radiusTolerance=None):
 		"""
-		using HoughCircles
+		runs the settings.BALL_ENGINE ball detector (see BallDetectors.py)
+		
+		radiusTolerance defaults to settings.BALL_TOLERANCE, both are read
+		each call so they can be hot reloaded
+		
+		ballPos is (None,None) if the ball wasn't found
+		
+		in luma mode the grey engines get no colour frame and the colour
+		engines run on the display sized frame
 		"""
-		global ballPos
+		if radiusTolerance is None:
+			radiusTolerance=settings.BALL_TOLERANCE
 		
-		blurred=cv2.medianBlur(self.gray,5)
-		scaledBallRadiusPx=settings.BALL_DIA_MM*self.scale_px_per_mm/2	# scale may change if camera moves
-		minRadiusPx,maxRadiusPx=MiscLib.min_max(scaledBallRadiusPx,radiusTolerance)
+		name=settings.BALL_ENGINE
+		frame,gray,ratio=self.frame,self.gray,1.0
+		if self.luma:
+			frame=None
+			if name in BallDetectors.COLOUR_ENGINES:
+				frame,gray=self._displayFrame(),None
+				ratio=frame.shape[1]/self.width
+		Metrics.ballSearches.inc(self.name)
+		found=BallDetectors.getEngine(name)(frame,gray,self.scale_px_per_mm*ratio,radiusTolerance)
+		if found is None:
+			self.ballPos=(None,None)
+			return
 		
-		rows=blurred.shape[0]
-		circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, 1, rows / 8,param1=100, param2=30,minRadius=int(minRadiusPx), maxRadius=int(maxRadiusPx))
-			
-
-		if circles is not None:
-			circles = np.uint16(np.around(circles))
-			for i in circles[0, :]:
-				ballPos = (i[0], i[1])
-				# circle center
-				cv2.circle(self.frame, ballPos, 1, (0, 100, 100), 3)
-				# circle outline
-				radius = i[2]
-				#print(f"radius {radius} min {minRadiusPx} max {maxRadiusPx}")
-				cv2.circle(self.frame, ballPos, radius, (255, 0, 255), 3)
+		Metrics.ballFrames.inc(self.name)
+		x,y,radius=(value/ratio for value in found)
+		self.ballPos=(int(x),int(y))
+		self.ballDrawn=(self.ballPos,radius)
 				
 				
 	def _drawCentreOnFrame(self,cx,cy,dia=5):
@@ -199,7 +531,7 @@ class arucoDetector:
 			if r:
 				return cx,cy,hdg
 			else:
-				print(f"Unable to get info for botId {botId}",flush=True)
+				Log.debug("Unable to get bot info",bot=botId)
 				return None,None,None
 		except:
 			return None,None,None
@@ -235,16 +567,101 @@ class arucoDetector:
 			return True,cx,cy,heading
 			
 		except Exception as e:
-			print(f"getMarkerInfo EXCEPTION {e}")
+			Log.warning("getMarkerInfo exception",marker=markerId,error=repr(e))
 			
 		
 	def update(self):
 		"""
-		simply calls all the methods required to monitor the arena
+		calls the methods required to monitor the arena, each at the
+		rate the workload profile for the current stage asks for
+		"""
+		start=time.perf_counter()
+		profile=self._profile()
+		self._grabFrame(profile)
+		if self._due(profile,"calibrate"):
+			with Metrics.stopwatch(Metrics.stageSeconds,self.name,"calibrate"):
+				self._doCalibration()
+		if self._due(profile,"ball"):
+			with Metrics.stopwatch(Metrics.stageSeconds,self.name,"ball"):
+				self._findTheBall()
+		# readers get this frame now. Luma mode only makes one while they are watching
+		if not self.luma:
+			self._annotate(self.frame)
+			self.frames.publish(self.frameNumber)
+		elif self._viewed():
+			self._annotate(self._displayFrame())
+			self.frames.publish(self.frameNumber)
+		self._releaseFrame()
+		Metrics.frameBuffers.set(len(self.frames.pool),self.name)
+		self._adaptWorkload((time.perf_counter()-start-self.captureSeconds)*1000)
+		
+	def setWorkload(self,stage:str)->None:
+		"""
+		select the settings.WORKLOADS profile for a game stage,
+		stages without a profile use "default"
+		"""
+		if stage!=self.workloadStage:
+			self.workloadStage=stage
+			self._setBackoff(0)
+		
+	def _profile(self)->dict:
+		# read each frame so WORKLOADS can be hot reloaded
+		return settings.WORKLOADS.get(self.workloadStage,settings.WORKLOADS["default"])
+		
+	def _every(self,profile:dict,detector:str)->int:
+		"""
+		run the detector every N frames, 0 never
+		backoff slows everything the profile doesn't "keep"
+		"""
+		every=profile.get(detector,1)
+		if every and detector not in profile.get("keep",()):
+			every<<=self.backoff
+		return every
+		
+	def _due(self,profile:dict,detector:str)->bool:
+		every=self._every(profile,detector)
+		return every>0 and self.frameNumber%every==0
+		
+	def _setBackoff(self,level:int)->None:
+		if level!=self.backoff:
+			Log.info("Detector backoff",level=level,was=self.backoff,stage=self.workloadStage,processMs=self.processMs or 0,budgetMs=settings.FRAME_BUDGET_MS)
+		self.backoff=level
+		self.backoffChanged=self.frameNumber
+		Metrics.detectBackoff.set(level,self.name)
+		
+	def _adaptWorkload(self,processMs:float)->None:
+		"""
+		back off when the smoothed processing time is over budget, recover
+		when it falls well under. Changes are held for BACKOFF_HOLD_FRAMES
+		so the average can settle
 		"""
-		self._grabFrame()
-		self._doCalibration()
-		self._findTheBall()
+		if self.processMs is None:
+			self.processMs=processMs
+		else:
+			self.processMs+=(processMs-self.processMs)*0.1
+		
+		if self.frameNumber-self.backoffChanged<BACKOFF_HOLD_FRAMES:
+			return
+		budget=settings.FRAME_BUDGET_MS
+		if self.processMs>budget and self.backoff<settings.MAX_BACKOFF:
+			self._setBackoff(self.backoff+1)
+		elif self.processMs<budget*BACKOFF_RECOVER and self.backoff>0:
+			self._setBackoff(self.backoff-1)
+		
+	def getWorkload(self)->dict:
+		"""
+		the workload in force: stage, backoff level, smoothed processing
+		time and how often (frames) each detector runs
+		"""
+		profile=self._profile()
+		return {
+			"stage":self.workloadStage,
+			"backoff":self.backoff,
+			"processMs":round(self.processMs or 0,2),
+			"budgetMs":settings.FRAME_BUDGET_MS,
+			"downscale":self.detectDownscale,
+			"every":{detector:self._every(profile,detector) for detector in WORKLOAD_DETECTORS}
+		}
 		
 	def getHomeBases(self)->dict:
 		""" getTeamBases
@@ -255,7 +672,7 @@ class arucoDetector:
 		bases={}
 		
 		
-		for home_id in settings.TEAM0_BASES + settings.TEAM1_BASES:
+		for home_id in self.lookups.allBases:
 			try:
 				# we don't need heading
 				res,cx,cy,_=self._getMarkerInfo(home_id)
@@ -274,7 +691,7 @@ class arucoDetector:
 		heading: degrees (int)
 		"""
 		bots={}
-		for botId in settings.TEAM0_BOTS + settings.TEAM1_BOTS:
+		for botId in self.lookups.allBots:
 			try:
 				res,cx,cy,heading=self._getMarkerInfo(botId)
 				if res:
@@ -301,16 +718,38 @@ class arucoDetector:
 		"""
 		return self.scale_px_per_mm
 	
+	def getFrameNumber(self)->int:
+		"""
+		number of frames grabbed so far
+		"""
+		return self.frameNumber
+		
+	def getCaptureTime(self)->float:
+		"""
+		time.monotonic() when the current frame was captured
+		"""
+		return self.captureTime
+		
 	def getFrame(self):
 		""" getFrame()
 
-		returns the last frame including any annotations
-		grabFrame() takes longer so not suited to fast frame rates.
-		since robots don't move quickly Flask can use the last frame grabbed
-		to achieve higher frame rates
+		returns the last published frame including all its annotations
+		as a read-only view. Only for the thread calling update(), the
+		buffer is reused a couple of frames later. Other threads use
+		leaseFrame()
 		"""
-		with self.lock:
-			return self.frame
+		self.lastViewed=time.monotonic()
+		return self.frames.latest()
+		
+	def leaseFrame(self):
+		"""
+		with detector.leaseFrame() as (frameNumber,frame):
+		
+		the last published frame as a read-only view, kept out of the
+		buffer pool till the with block ends. Doesn't block capture
+		"""
+		self.lastViewed=time.monotonic()
+		return self.frames.lease()
 				
 if __name__ == "__main__":
 	
@@ -0,0 +1,250 @@
+# WorldBroadcast.py
+#
+# publishes the world state (bot positions and the ball) for the pythonish
+# programs running on the bots
+#
+# frames are packed with struct into a fixed binary layout (little endian)
+#
+# header  magic "AW", version, flags, seq, frame number, timestamp,
+#         ball x,y (mm), ball vx,vy (mm/s), entry count
+# entry   bot id, x,y (mm), heading (degrees, 0xFFFF = bot has gone)
+#
+# keyframes carry every bot. Delta frames carry only the bots which moved more
+# than WORLD_DELTA_MM/WORLD_DELTA_DEG since they were last sent, or went away.
+
+import struct
+import time
+
+from config import settings
+from mqttSecrets import MQTT_BROKER,MQTT_USER,MQTT_PASS,MQTT_KEEP_ALIVE,MQTT_WORLD_TOPIC
+
+MAGIC=b"AW"
+VERSION=1
+
+FLAG_KEYFRAME=0x01
+FLAG_BALL=0x02
+
+HEADER=struct.Struct("<2sBBHIdhhhhH")
+ENTRY=struct.Struct("<BhhH")
+
+GONE=0xFFFF # heading value for a bot which has left the arena
+
+INT16_MIN,INT16_MAX=-32768,32767
+
+
+def _int16(v:float)->int:
+	return max(INT16_MIN,min(INT16_MAX,int(round(v))))
+
+
+def encodeFrame(seq:int,frameNumber:int,timestamp:float,ball,ballVelocity,entries:list,keyframe:bool)->bytes:
+	"""
+	ball: (x,y) mm or None
+	ballVelocity: (vx,vy) mm/s
+	entries: list of (botId,x,y,heading) mm - heading GONE for removed bots
+	"""
+	flags=FLAG_KEYFRAME if keyframe else 0
+	ballX=ballY=0
+	if ball is not None:
+		flags|=FLAG_BALL
+		ballX,ballY=ball
+	vx,vy=ballVelocity
+	parts=[HEADER.pack(MAGIC,VERSION,flags,seq&0xFFFF,frameNumber&0xFFFFFFFF,timestamp,
+		_int16(ballX),_int16(ballY),_int16(vx),_int16(vy),len(entries))]
+	for botId,x,y,heading in entries:
+		parts.append(ENTRY.pack(botId,_int16(x),_int16(y),heading))
+	return b"".join(parts)
+
+
+class worldPublisher:
+	"""
+	call publish() every loop, frames are only sent at settings.WORLD_RATE_HZ
+	
+	rateHz and keyframeEvery of None follow settings so they can be hot reloaded
+	
+	mqttc is anything with paho's publish(topic,payload,qos), e.g. a
+	pixelbotClass.sharedClient, None connects a client of its own
+	"""
+	def __init__(self,mqttc=None,topic:str=MQTT_WORLD_TOPIC,rateHz:float=None,keyframeEvery:int=None):
+		self.topic=topic
+		self.rateHz=rateHz
+		self.keyframeEvery=keyframeEvery
+		self.mqttc=mqttc if mqttc is not None else self._connect()
+
+		self.seq=0
+		self.lastPublish=0
+		self.sent={} # botId->(x,y,heading) as last sent
+		self.lastBall=None # (x,y,time)
+		self.ballVelocity=(0,0)
+		self.bytesSent=0
+		self.framesSent=0
+
+	def _connect(self):
+		import paho.mqtt.client as paho
+		mqttc=paho.Client()
+		if MQTT_USER is not None:
+			mqttc.username_pw_set(username=MQTT_USER,password=MQTT_PASS)
+		mqttc.loop_start()
+		mqttc.connect_async(MQTT_BROKER,keepalive=MQTT_KEEP_ALIVE)
+		return mqttc
+
+	def _ballState(self,ball,now:float):
+		"""
+		ball in mm, also tracks the ball velocity
+		"""
+		if ball is None:
+			self.lastBall=None
+			self.ballVelocity=(0,0)
+			return
+		x,y=ball
+		if self.lastBall is not None:
+			lastX,lastY,lastT=self.lastBall
+			dt=now-lastT
+			if dt>0:
+				self.ballVelocity=((x-lastX)/dt,(y-lastY)/dt)
+		self.lastBall=(x,y,now)
+
+	def build(self,frameNumber:int,bots:dict,ball,scale_px_per_mm:float,now:float)->bytes:
+		"""
+		bots: botId->(cx,cy,heading) in pixels
+		ball: (cx,cy) in pixels or (None,None)
+
+		returns the next frame (keyframe or delta)
+		"""
+		ballMM=None
+		if ball is not None and ball[0] is not None:
+			ballMM=(ball[0]/scale_px_per_mm,ball[1]/scale_px_per_mm)
+		self._ballState(ballMM,now)
+
+		keyframeEvery=self.keyframeEvery or settings.WORLD_KEYFRAME_EVERY
+		keyframe=self.seq%keyframeEvery==0
+		entries=[]
+		current={}
+		for botId,(cx,cy,heading) in bots.items():
+			x=cx/scale_px_per_mm
+			y=cy/scale_px_per_mm
+			heading=int(heading)%360
+			current[botId]=(x,y,heading)
+			last=self.sent.get(botId)
+			if not keyframe and last is not None:
+				turned=abs((heading-last[2]+180)%360-180)
+				if abs(x-last[0])<settings.WORLD_DELTA_MM and abs(y-last[1])<settings.WORLD_DELTA_MM and turned<settings.WORLD_DELTA_DEG:
+					continue
+			self.sent[botId]=(x,y,heading)
+			entries.append((botId,x,y,heading))
+
+		for botId in list(self.sent.keys()):
+			if botId not in current:
+				del self.sent[botId]
+				if not keyframe:
+					entries.append((botId,0,0,GONE))
+
+		payload=encodeFrame(self.seq,frameNumber,time.time(),ballMM,self.ballVelocity,entries,keyframe)
+		self.seq+=1
+		return payload
+
+	def publish(self,frameNumber:int,bots:dict,ball,scale_px_per_mm:float)->bool:
+		"""
+		rate limited, returns True if a frame was sent
+		"""
+		now=time.monotonic()
+		rateHz=self.rateHz or settings.WORLD_RATE_HZ
+		if now-self.lastPublish<1.0/rateHz:
+			return False
+		self.lastPublish=now
+
+		payload=self.build(frameNumber,bots,ball,scale_px_per_mm,now)
+		# telemetry is superseded by the next frame so QoS 0
+		self.mqttc.publish(self.topic,payload,qos=0)
+		self.bytesSent+=len(payload)
+		self.framesSent+=1
+		return True
+
+
+class worldDecoder:
+	"""
+	rebuilds the world state from keyframes and deltas
+
+	deltas are ignored after a lost frame until the next keyframe
+	"""
+	def __init__(self):
+		self.bots={} # botId->(x,y,heading) mm
+		self.ball=None
+		self.ballVelocity=(0,0)
+		self.frameNumber=None
+		self.timestamp=None
+		self.synced=False
+		self.lastSeq=None
+		self.lost=0
+
+	def decode(self,payload:bytes)->bool:
+		"""
+		apply one frame, returns True if the state is now valid
+		"""
+		magic,version,flags,seq,frameNumber,timestamp,ballX,ballY,vx,vy,count=HEADER.unpack_from(payload,0)
+		if magic!=MAGIC or version!=VERSION:
+			raise ValueError(f"not a world frame magic {magic} version {version}")
+
+		if self.lastSeq is not None and seq!=(self.lastSeq+1)&0xFFFF:
+			self.lost+=(seq-self.lastSeq-1)&0xFFFF
+			self.synced=False
+		self.lastSeq=seq
+
+		keyframe=flags&FLAG_KEYFRAME
+		if keyframe:
+			self.bots={}
+			self.synced=True
+		elif not self.synced:
+			return False
+
+		offset=HEADER.size
+		for _ in range(count):
+			botId,x,y,heading=ENTRY.unpack_from(payload,offset)
+			offset+=ENTRY.size
+			if heading==GONE:
+				self.bots.pop(botId,None)
+			else:
+				self.bots[botId]=(x,y,heading)
+
+		self.ball=(ballX,ballY) if flags&FLAG_BALL else None
+		self.ballVelocity=(vx,vy)
+		self.frameNumber=frameNumber
+		self.timestamp=timestamp
+		return True
+
+
+if __name__=="__main__":
+
+	# frame sizes and encode cost for a large fleet, no broker needed
+	import random
+
+	class _nullClient:
+		def publish(self,topic,payload,qos=0):
+			pass
+
+	rnd=random.Random(0)
+	numBots=32
+	scale=settings.INITIAL_SCALE_FACTOR
+	bots={botId:(rnd.uniform(0,1920),rnd.uniform(0,1080),rnd.uniform(0,359)) for botId in range(numBots)}
+
+	P=worldPublisher(_nullClient())
+	D=worldDecoder()
+
+	frames=200
+	sizes=[]
+	start=time.perf_counter()
+	for frameNumber in range(frames):
+		# a few bots move each frame
+		for botId in rnd.sample(list(bots.keys()),4):
+			cx,cy,heading=bots[botId]
+			bots[botId]=(cx+rnd.uniform(-20,20),cy+rnd.uniform(-20,20),(heading+rnd.uniform(-10,10))%360)
+		payload=P.build(frameNumber,bots,(960,540),scale,frameNumber/settings.WORLD_RATE_HZ)
+		sizes.append(len(payload))
+		D.decode(payload)
+	elapsed=time.perf_counter()-start
+
+	for botId,(cx,cy,heading) in bots.items():
+		x,y,h=D.bots[botId]
+		assert abs(x-cx/scale)<=settings.WORLD_DELTA_MM+1 and abs(y-cy/scale)<=settings.WORLD_DELTA_MM+1
+
+	print(f"{numBots} bots keyframe {HEADER.size+numBots*ENTRY.size} bytes, average frame {sum(sizes)/len(sizes):.0f} bytes",flush=True)
+	print(f"encode+decode {elapsed/frames*1e6:.0f} us per frame",flush=True)
@@ -1,6 +1,19 @@
+# config.py
+#
+# settings holds the defaults. A JSON file (see arena.example.json) can override
+# them with loadSettings() and watchSettings() applies edits to the tuning values
+# while ArenaManager is running
+
+import json
+import os
+import threading
+import time
 
 class settings():
     STREAMING=False # set to True to enable Flask streaming
+    STATE_MAX_HZ=5.0 # max rate of the Flask /state feed for each viewer
+    FLASK_HOST="0.0.0.0" # where the Flask server listens when STREAMING
+    FLASK_PORT=8000
 
 
 
@@ -9,6 +22,13 @@ class settings():
 
     VIDEO_WIDTH,VIDEO_HEIGHT=VIDEO_RES[1]
 
+    # camera pixel format. "RGB888" converts every frame to grey for detection,
+    # "YUV420" detects on the camera's luma (Y) plane as it is and only makes a
+    # colour frame, DISPLAY_WIDTH wide, while something is showing it
+    CAPTURE_FORMAT="RGB888"
+    DISPLAY_WIDTH=640           # colour frame width in YUV420 mode (the pi's lores stream)
+    DISPLAY_IDLE_S=2.0          # YUV420 stops making colour frames this long after the last viewer
+
     CALIBRATION_MARKER=49	    # marker to use for calibration
     CALIBRATION_SIZE_MM=54		# mm side size on paper
 
@@ -17,6 +37,32 @@ class settings():
 
     BW_THRESHOLD=190 # not using thresholding now
 
+    # coarse-to-fine marker detection
+    # "full" runs detectMarkers on the full frame, "pyramid" searches a downscaled
+    # copy then refines the corners on the full frame with cornerSubPix
+    DETECTION_MODE="full"
+    SMALLEST_MARKER_MM=40       # smallest marker side expected in the arena (bots)
+    MIN_DETECT_MARKER_PX=24     # marker side detectMarkers needs at the coarse level
+    MAX_DETECT_DOWNSCALE=4      # never search below 1/4 resolution
+    SUBPIX_WINDOW=5             # half size of the cornerSubPix search window (full res pixels)
+
+    # detection workload per game stage (ArenaManager STAGE names)
+    # each detector runs every N frames, 0 never. downscale fixes the marker
+    # search resolution (1 full, 2 half ...), None follows DETECTION_MODE.
+    # If processing takes longer than FRAME_BUDGET_MS the rates of detectors
+    # not in "keep" are halved, up to MAX_BACKOFF times
+    WORKLOADS={
+        "default":{"markers":1,"calibrate":1,"ball":1,"downscale":None},
+        "FINDING_BASES":{"markers":1,"calibrate":1,"ball":0,"downscale":None,"keep":["markers"]},
+        "FINDING_BOTS":{"markers":1,"calibrate":5,"ball":0,"downscale":None,"keep":["markers"]},
+        "HOMING_BOTS":{"markers":1,"calibrate":15,"ball":0,"downscale":None,"keep":["markers"]},
+        "FACE_OPPONENTS":{"markers":1,"calibrate":15,"ball":0,"downscale":None,"keep":["markers"]},
+        "WAITING_FOR_BALL":{"markers":2,"calibrate":15,"ball":1,"downscale":None,"keep":["ball"]},
+        "PLAYING_GAME":{"markers":1,"calibrate":15,"ball":1,"downscale":None,"keep":["markers","ball"]}
+    }
+    FRAME_BUDGET_MS=50.0        # detector time per frame, excluding waiting for the camera
+    MAX_BACKOFF=3
+
     baseId=0
     allKnownBots={
     baseId:("Agent Orange","CLB-da3371"), 
@@ -36,10 +82,40 @@ class settings():
 
     BOUNDARY_MARGIN=100 # used to define arena rect
 
+    # flow field navigation around other bots and the ball (see FlowField.py)
+    USE_FLOW_FIELD=False
+    FLOW_CELL_MM=40             # grid cell size
+    FLOW_CLEARANCE_MM=30        # added to obstacle radii
+    FLOW_LOOKAHEAD=6            # max cells to look ahead along a straight run
+    BOT_RADIUS_MM=50            # pixelbot footprint
+
+    # collision avoidance (see ProximityGrid.py), moves are shortened to stop
+    # short of other bots or held if less than AVOID_MIN_MOVE_MM is left. A bot
+    # held AVOID_DETOUR_AFTER times in a row is sent on a detour instead
+    AVOID_COLLISIONS=True
+    AVOID_CELL_MM=150           # spatial hash cell size
+    AVOID_MARGIN_MM=20          # gap kept between bots
+    AVOID_MIN_MOVE_MM=20        # shorter moves are held
+    AVOID_DETOUR_AFTER=3        # moves held in a row before a bot tries a detour
+    AVOID_DETOUR_DEG=[45,90,135,-45,-90,-135] # detour turns, tried in order (clockwise first)
+
     INITIAL_SCALE_FACTOR=1.2 # empirically determined - works best with the ball 
 
+    # world state broadcast for the bots (see WorldBroadcast.py)
+    WORLD_BROADCAST=False
+    WORLD_RATE_HZ=10.0
+    WORLD_KEYFRAME_EVERY=20     # every Nth frame carries all bots
+    WORLD_DELTA_MM=2            # smaller moves are left out of delta frames
+    WORLD_DELTA_DEG=2
+
     BALL_DIA_MM=120
     BALL_TOLERANCE=0.04 # %
+    BALL_ENGINE="hough"         # "hough", "contour" or "hsv", see BallDetectors.py
+    BALL_HSV_LOW=(5,120,120)    # hsv engine colour range (OpenCV hue 0-179)
+    BALL_HSV_HIGH=(25,255,255)
+    BALL_MIN_PX=8               # hsv engine downscales while the ball radius stays this big
+    BALL_MAX_DOWNSCALE=4
+    BALL_MIN_FILL=0.6           # blob area/bounding box area, a circle is 0.785
 
     # setup for pixelbot teams
     # assuming equal sized teams and bases
@@ -52,7 +128,335 @@ class settings():
     TEAM0_BASES=[40,41,42,43]
     TEAM1_BASES=[44,45,46,47]
     PAIRINGS={0:40,1:41,2:42,20:43,7:44,8:45,9:46,21:47}
+
+    # "static" uses PAIRINGS, "optimal" assigns each bot the base of its team
+    # that minimises the total homing time (see BaseAssignment.py)
+    ASSIGNMENT_MODE="static"
+    BOT_SPEED_MM_S=100.0        # used to estimate homing times
+    BOT_TURN_DEG_S=90.0
+    # command scheduler (see CommandScheduler.py)
+    CMD_RATE_HZ=2.0             # sustained moves per second per bot
+    CMD_BURST=2
+    CMD_MAX_PER_TICK=8          # moves sent per game loop across the fleet
+    CMD_DEADBAND_MM=10          # smaller moves are not sent
+    CMD_DEADBAND_DEG=5
+    CMD_REPEAT_S=2.0            # don't resend the same target within this time
+    BUSY_TIMEOUT_S=10.0         # a bot is assumed idle if it hasn't replied to a move by then
+
+    # latency compensation (see MotionPredictor.py)
+    PREDICT_MOTION=True         # aim moves at where the bots and ball will be
+    MOTION_SMOOTHING=0.5        # weight of the newest velocity measurement
+    MOTION_MAX_LEAD_S=0.5       # never extrapolate further ahead than this
+    MOTION_MAX_GAP_S=0.5        # velocity starts again from rest after a marker was missing this long
+    MQTT_DELIVERY_S=0.05        # expected time from publishing a move to the bot acting on it
     
     
+    # uploading programs to the fleet (see ProgramDeployer.py)
+    DEPLOY_ON_START=False       # upload DEFAULT_PROGRAM_LIST once all bots are found
+    DEPLOY_CONCURRENCY=8        # bots uploaded to at the same time
+    DEPLOY_CONFIRM_TIMEOUT=10.0 # seconds for the broker, then the bot, to acknowledge an upload
+    DEPLOY_BOT_ACK=None         # payload a bot sends on its data topic once it has loaded an upload, None if it sends none
+    DEPLOY_STATE_FILE="programs/deployed.json" # hashes of uploads the bots acknowledged, None to not remember
+
     TEAM0_COLOUR="R"
     TEAM1_COLOUR="B"
+
+    CONFIG_POLL_S=0.25 # how often watchSettings() checks the file for edits
+
+    # startup (see Startup.py)
+    CAMERA_READY_TIMEOUT=3.0    # max seconds to wait for the exposure to settle
+    CAMERA_SETTLE_DELTA=0.02    # brightness change between frames treated as settled
+    PRECONNECT_FLEET=True       # connect every team bot to the broker while the camera warms up
+    STARTUP_REPORT_FILE=None    # also save the startup timeline here as JSON
+
+    # on demand profiling of the game loop (see Profiler.py)
+    PROFILING_ENABLED=False     # SIGUSR1 and Flask /profile only work when True
+    PROFILE_TOKEN=None          # X-Profile-Token needed by /profile, None disables the endpoint
+    PROFILE_SECONDS=10.0        # default capture length
+    PROFILE_MAX_SECONDS=60.0
+    PROFILE_SAMPLE_MS=5.0       # stack sampling interval
+    PROFILE_TOP=40              # functions listed in the report
+    PROFILE_DIR="profiles"
+
+    # logging (see Log.py), written by a background thread
+    LOG_LEVEL="info"            # lowest level written: "debug", "info", "warning" or "error"
+    LOG_FILE=None               # None writes to the console
+    LOG_FORMAT="text"           # "text" or "json" (one object per line)
+    LOG_BURST=20                # records a message may log at once
+    LOG_RATE_HZ=5.0             # then records per second per message
+    LOG_RING=8192               # records kept in memory
+    LOG_FLUSH_S=0.2             # the writer wakes this often
+    LOG_DUMP_S=10.0             # an error dumps this many seconds of records, debug included
+    LOG_DUMP_FILE="arena_dump.log"
+
+    # split deployment, detection on an edge node (see EdgeLink.py, EdgeNode.py)
+    REMOTE_DETECTOR=False       # ArenaManager takes detections from EdgeNode instead of a camera
+    LOGIC_HOST="127.0.0.1"      # where EdgeNode sends its detections
+    LINK_PORT=5005
+    LINK_TIMEOUT_S=0.5          # with nothing from the edge for this long the bots and ball are gone
+    LINK_PING_S=1.0             # clock offset measurement interval
+    LINK_OFFSET_SAMPLES=16      # the fastest round trip of these gives the clock offset
+
+    # several arenas in one process (see ArenaHost.py)
+    ARENA_WORKERS=0             # threads shared by the arenas, 0 for one per CPU core
+    CAMERA_NUM=0                # picamera2 camera number of the arena
+    TOPIC_NAMESPACE=""          # prefixed to the arena's MQTT topics e.g. "pitch1/"
+
+
+# changing these needs a restart, everything else is applied on the fly
+STRUCTURAL={
+    "STREAMING","FLASK_HOST","FLASK_PORT","VIDEO_RES","VIDEO_WIDTH","VIDEO_HEIGHT","CALIBRATION_MARKER",
+    "CAPTURE_FORMAT","DISPLAY_WIDTH",
+    "allKnownBots","TEAM0_BOTS","TEAM1_BOTS","TEAM0_BASES","TEAM1_BASES","PAIRINGS","NUM_BOTS",
+    "TEAM0_COLOUR","TEAM1_COLOUR","ASSIGNMENT_MODE","WORLD_BROADCAST","DEPLOY_STATE_FILE",
+    "REMOTE_DETECTOR","LOGIC_HOST","LINK_PORT","LOG_RING"
+}
+
+
+# the settings an arena file (ArenaHost.py) may set, every other setting is
+# shared by all the arenas in the process
+ARENA_SCOPED={
+    "TEAM0_BOTS","TEAM1_BOTS","TEAM0_BASES","TEAM1_BASES","PAIRINGS","NUM_BOTS",
+    "ASSIGNMENT_MODE","TEAM0_COLOUR","TEAM1_COLOUR","DEPLOY_ON_START","CAMERA_NUM","TOPIC_NAMESPACE"
+}
+
+
+class arenaSettings():
+    """
+    one arena's view of settings, its own values for the ARENA_SCOPED names
+    and the shared (hot reloadable) settings for everything else
+    """
+    def __init__(self,overrides:dict):
+        self.__dict__.update(overrides)
+
+    def __getattr__(self,name):
+        return getattr(settings,name)
+
+
+class lookups():
+    """
+    tables compiled from settings by compileLookups()
+    """
+    allBots=()          # every team bot id
+    allBases=()         # every team base id
+    roleById={}         # marker id->"bot","base" or "calibration"
+    teamByBot={}        # bot id->0 or 1
+    baseByBot={}        # bot id->paired base id
+    botByAddr={}        # MQTT address->bot id
+    addrByBot={}        # bot id->(name,MQTT address)
+
+
+def compileLookups(source=settings,tables=lookups):
+    """
+    precompute the id tables used in the detection and control loops
+
+    source and tables default to the shared settings and lookups, an arena
+    passes its arenaSettings and a lookups() instance of its own
+    """
+    tables.allBots=tuple(source.TEAM0_BOTS+source.TEAM1_BOTS)
+    tables.allBases=tuple(source.TEAM0_BASES+source.TEAM1_BASES)
+
+    roles={source.CALIBRATION_MARKER:"calibration"}
+    roles.update({baseId:"base" for baseId in tables.allBases})
+    roles.update({botId:"bot" for botId in tables.allBots})
+    tables.roleById=roles
+
+    teams={botId:0 for botId in source.TEAM0_BOTS}
+    teams.update({botId:1 for botId in source.TEAM1_BOTS})
+    tables.teamByBot=teams
+
+    tables.baseByBot=dict(source.PAIRINGS)
+    tables.addrByBot=dict(source.allKnownBots)
+    tables.botByAddr={addr:botId for botId,(name,addr) in source.allKnownBots.items()}
+    return tables
+
+
+def _convert(name:str,current,value):
+    """
+    check value has the same shape as the default and convert
+    JSON types back (lists to tuples, string dict keys to ints)
+    """
+    if isinstance(current,bool) or isinstance(value,bool):
+        if not (isinstance(current,bool) and isinstance(value,bool)):
+            raise ValueError(f"{name} must be true or false")
+        return value
+    if isinstance(current,(int,float)):
+        if not isinstance(value,(int,float)):
+            raise ValueError(f"{name} must be a number")
+        if isinstance(current,float):
+            return float(value)
+        if value!=int(value):
+            raise ValueError(f"{name} must be a whole number")
+        return int(value)
+    if isinstance(current,str) or current is None:
+        if value is not None and not isinstance(value,str):
+            raise ValueError(f"{name} must be a string")
+        return value
+    if isinstance(current,(list,tuple)):
+        if not isinstance(value,list):
+            raise ValueError(f"{name} must be a list")
+        if name=="VIDEO_RES":
+            return [tuple(v) for v in value]
+        if isinstance(current,tuple):
+            return tuple(value)
+        return value
+    if isinstance(current,dict):
+        if not isinstance(value,dict):
+            raise ValueError(f"{name} must be an object")
+        converted={}
+        for k,v in value.items():
+            # JSON keys are strings, bot/base ids go back to ints
+            k=int(k) if k.lstrip("-").isdigit() else k
+            converted[k]=tuple(v) if isinstance(v,list) else v
+        return converted
+    raise ValueError(f"{name} cannot be set from a file")
+
+
+def _validate(values:dict)->None:
+    """
+    cross checks between settings, values holds every setting
+    """
+    bots=values["TEAM0_BOTS"]+values["TEAM1_BOTS"]
+    bases=values["TEAM0_BASES"]+values["TEAM1_BASES"]
+    if len(set(bots))!=len(bots):
+        raise ValueError("a bot is in both teams")
+    for botId in bots:
+        if botId not in values["allKnownBots"]:
+            raise ValueError(f"bot {botId} is not in allKnownBots")
+    for botId,baseId in values["PAIRINGS"].items():
+        team0=botId in values["TEAM0_BOTS"]
+        if baseId not in (values["TEAM0_BASES"] if team0 else values["TEAM1_BASES"]):
+            raise ValueError(f"bot {botId} is paired with base {baseId} of the other team")
+    if values["CALIBRATION_MARKER"] in bots+bases:
+        raise ValueError("the calibration marker is also a bot or base")
+    if (values["VIDEO_WIDTH"],values["VIDEO_HEIGHT"]) not in [tuple(r) for r in values["VIDEO_RES"]]:
+        raise ValueError("VIDEO_WIDTH,VIDEO_HEIGHT is not one of VIDEO_RES")
+    if values["LOG_LEVEL"] not in ("debug","info","warning","error"):
+        raise ValueError("LOG_LEVEL must be debug, info, warning or error")
+    if values["LOG_FORMAT"] not in ("text","json"):
+        raise ValueError("LOG_FORMAT must be text or json")
+    if values["CAPTURE_FORMAT"] not in ("RGB888","YUV420"):
+        raise ValueError("CAPTURE_FORMAT must be RGB888 or YUV420")
+    if not 0<values["BALL_TOLERANCE"]<1:
+        raise ValueError("BALL_TOLERANCE must be between 0 and 1")
+    if values["BALL_ENGINE"] not in ("hough","contour","hsv"):
+        raise ValueError("BALL_ENGINE must be hough, contour or hsv")
+    if "default" not in values["WORKLOADS"]:
+        raise ValueError("WORKLOADS needs a default profile")
+    for stage,profile in values["WORKLOADS"].items():
+        unknown=set(profile)-{"markers","calibrate","ball","downscale","keep"}
+        if unknown:
+            raise ValueError(f"WORKLOADS {stage} has unknown keys {sorted(unknown)}")
+
+
+def _readSettings(path:str)->dict:
+    """
+    returns name->value for every setting in the file, validated
+    """
+    with open(path,"r") as f:
+        overrides=json.load(f)
+    return _checkOverrides(overrides)
+
+
+def _checkOverrides(overrides:dict)->dict:
+    """
+    converted overrides, validated along with the current settings
+    """
+    values={name:getattr(settings,name) for name in dir(settings) if not name.startswith("_")}
+    changed={}
+    for name,value in overrides.items():
+        if name not in values:
+            raise ValueError(f"unknown setting {name}")
+        changed[name]=_convert(name,values[name],value)
+    values.update(changed)
+    _validate(values)
+    return changed
+
+
+_reloadCallbacks=[]
+
+def onReload(callback)->None:
+    """
+    callback(changedNames:set) is called after a hot reload
+    """
+    _reloadCallbacks.append(callback)
+
+
+def loadSettings(path:str)->None:
+    """
+    apply every setting in the file then rebuild the lookup tables
+    raises ValueError if the file is invalid, settings are left untouched
+    """
+    for name,value in _readSettings(path).items():
+        setattr(settings,name,value)
+    compileLookups()
+
+
+def reloadSettings(path:str)->set:
+    """
+    apply the non structural settings which have changed
+
+    returns the names which changed
+    """
+    import Log # Log imports config
+    changed=set()
+    for name,value in _readSettings(path).items():
+        if getattr(settings,name)==value:
+            continue
+        if name in STRUCTURAL:
+            Log.warning("Setting changed, restart to apply it",setting=name)
+            continue
+        setattr(settings,name,value)
+        changed.add(name)
+
+    if changed:
+        Log.info("Settings reloaded",settings=sorted(changed))
+        for callback in _reloadCallbacks:
+            callback(changed)
+    return changed
+
+
+def loadArenaSettings(path:str)->tuple:
+    """
+    read one arena file (ArenaHost.py)
+
+    returns arenaSettings,lookups for the arena
+    raises ValueError if the file is invalid or sets a shared setting
+    """
+    with open(path,"r") as f:
+        overrides=json.load(f)
+    shared=set(overrides)-ARENA_SCOPED
+    if shared:
+        raise ValueError(f"{path} sets shared settings {sorted(shared)}")
+    cfg=arenaSettings(_checkOverrides(overrides))
+    return cfg,compileLookups(cfg,lookups())
+
+
+def watchSettings(path:str)->threading.Thread:
+    """
+    poll the file every CONFIG_POLL_S and hot reload it when it changes
+    a bad edit is reported and ignored
+    """
+    def _watch():
+        lastMtime=os.path.getmtime(path) if os.path.exists(path) else None
+        while True:
+            time.sleep(settings.CONFIG_POLL_S)
+            try:
+                mtime=os.path.getmtime(path)
+            except OSError:
+                continue
+            if mtime==lastMtime:
+                continue
+            lastMtime=mtime
+            try:
+                reloadSettings(path)
+            except Exception as e:
+                import Log # Log imports config
+                Log.warning("Settings not reloaded",path=path,error=str(e))
+
+    watcher=threading.Thread(target=_watch,name="settingsWatcher",daemon=True)
+    watcher.start()
+    return watcher
+
+
+compileLookups()
@@ -3,6 +3,7 @@ MQTT_KEEP_ALIVE=60
 
 MQTT_COMMAND_TOPIC="lb/command/" # bot listens here
 MQTT_DATA_TOPIC="lb/data/"		 # we listen for messages from the bot here
+MQTT_WORLD_TOPIC="lb/world"		 # world state broadcast (see WorldBroadcast.py)
 
 MQTT_BROKER="mqtt.connectedhumber.org"
 MQTT_USER="littleboxes"
@@ -3,9 +3,14 @@
 
 import paho.mqtt.client as paho
 
-from config import settings
+from config import settings,lookups
 import math
 import MiscLib
+import Metrics
+import Log
+import FleetState
+import numpy as np
+import threading
 import time
 
 DEBUG=False
@@ -14,22 +19,219 @@ DEFAULT_PROGRAM_LIST=["active.txt"]
 
 from mqttSecrets import MQTT_BROKER,MQTT_USER,MQTT_PASS, MQTT_CONNECT_TIMEOUT,MQTT_KEEP_ALIVE,MQTT_COMMAND_TOPIC, MQTT_DATA_TOPIC
 
+MQTT_PORT=1883
+EARLY_ACK_S=5.0 # unmatched acknowledgements are forgotten after this
+
+preconnected={} # addr->connected paho client, filled by connectFleet()
+
+
+def setBroker(host:str,port:int=1883,user:str=None,password:str=None)->None:
+	"""
+	connections made from now on go to host:port instead of the
+	mqttSecrets broker, e.g. the FakeFleet.py broker
+	"""
+	global MQTT_BROKER,MQTT_PORT,MQTT_USER,MQTT_PASS
+	MQTT_BROKER,MQTT_PORT,MQTT_USER,MQTT_PASS=host,port,user,password
+
+
+def _fleetOnConnect(client, obj, flags, rc):
+	if rc==0:
+		client.connected_flag=True
+
+def _fleetOnDisconnect(client, userdata, rc):
+	client.connected_flag=False
+
+def connectFleet(addrs:list,timeout:float=MQTT_CONNECT_TIMEOUT)->int:
+	"""
+	connect a broker client for each bot address at the same time so
+	the connections are ready before the bots are detected.
+	pixelbot instances take their client from here.
+	
+	returns the number connected
+	"""
+	clients={}
+	for addr in addrs:
+		if addr in preconnected:
+			continue
+		client=paho.Client()
+		client.connected_flag=False
+		client.on_connect=_fleetOnConnect
+		client.on_disconnect=_fleetOnDisconnect
+		if MQTT_USER is not None:
+			client.username_pw_set(username=MQTT_USER, password=MQTT_PASS)
+		client.loop_start()
+		client.connect_async(MQTT_BROKER,port=MQTT_PORT,keepalive=MQTT_KEEP_ALIVE)
+		clients[addr]=client
+		
+	start=time.time()
+	while time.time()-start<timeout and not all(c.connected_flag for c in clients.values()):
+		time.sleep(0.01)
+		
+	for addr,client in clients.items():
+		if client.connected_flag:
+			preconnected[addr]=client
+		else:
+			Log.warning("MQTT connect timeout",addr=addr)
+			client.loop_stop()
+	return len(preconnected)
+
+
+class sharedClient:
+	"""
+	one broker connection shared by the bots of every arena in the process
+	(ArenaHost.py) instead of a client and network thread per bot
+	
+	each bot's data topic is routed to the bot with message_callback_add,
+	publish acknowledgements are routed back to the bot by message id
+	"""
+	def __init__(self,timeout:float=MQTT_CONNECT_TIMEOUT):
+		self.mqttc=paho.Client()
+		self.mqttc.connected_flag=False
+		self.lock=threading.RLock()
+		self.routes={} # data topic->pixelbot
+		self.inflight={} # message id->pixelbot or None
+		self.early={} # message id->time acknowledged before publish() returned
+		self.everConnected=False
+		
+		self.mqttc.on_connect=self._on_connect
+		self.mqttc.on_disconnect=self._on_disconnect
+		self.mqttc.on_publish=self._on_publish
+		if MQTT_USER is not None:
+			self.mqttc.username_pw_set(username=MQTT_USER, password=MQTT_PASS)
+		self.mqttc.loop_start()
+		self.mqttc.connect_async(MQTT_BROKER,port=MQTT_PORT,keepalive=MQTT_KEEP_ALIVE)
+		
+		start=time.time()
+		while time.time()-start<timeout and not self.mqttc.connected_flag:
+			time.sleep(0.01)
+		if not self.mqttc.connected_flag:
+			Log.warning("MQTT connect timeout, still trying in the background")
+			
+	@property
+	def connected_flag(self)->bool:
+		return self.mqttc.connected_flag
+		
+	def _on_connect(self,client, obj, flags, rc):
+		if rc!=0:
+			return
+		if self.everConnected:
+			Metrics.mqttReconnects.inc("shared")
+		self.everConnected=True
+		client.connected_flag=True
+		# the session is clean so subscriptions are made again on every connect
+		with self.lock:
+			topics=list(self.routes)
+		for topic in topics:
+			client.subscribe(topic)
+			
+	def _on_disconnect(self,client, userdata, rc):
+		client.connected_flag=False
+		Metrics.mqttDisconnects.inc("shared")
+		
+	def _on_publish(self,client, userdata, mid):
+		with self.lock:
+			if mid not in self.inflight:
+				# acknowledged before publish() recorded it. Forget old ones,
+				# publish() would have claimed them long ago, so a stray id
+				# can't ack a later publish once ids wrap round
+				now=time.monotonic()
+				self.early={m:t for m,t in self.early.items() if now-t<EARLY_ACK_S}
+				self.early[mid]=now
+				return
+			bot=self.inflight.pop(mid)
+		if bot is not None:
+			bot._on_publish(client,userdata,mid)
+			
+	def register(self,topic:str,bot)->None:
+		"""
+		messages on topic go to bot._on_message
+		"""
+		with self.lock:
+			self.routes[topic]=bot
+		self.mqttc.message_callback_add(topic,bot._on_message)
+		if self.mqttc.connected_flag:
+			self.mqttc.subscribe(topic)
+			
+	def unregister(self,topic:str)->None:
+		with self.lock:
+			if self.routes.pop(topic,None) is None:
+				return
+		self.mqttc.message_callback_remove(topic)
+		self.mqttc.unsubscribe(topic)
+		
+	def publish(self,topic:str,payload,qos:int=0,bot=None):
+		"""
+		returns the paho MQTTMessageInfo, bot._on_publish is called when
+		the broker has acknowledged it
+		"""
+		# not held across paho's publish, paho calls _on_publish holding its
+		# own message lock so that would deadlock with the network thread
+		info=self.mqttc.publish(topic,payload,qos=qos)
+		if qos==0 and info.rc!=paho.MQTT_ERR_SUCCESS:
+			return info # never acknowledged
+		with self.lock:
+			acked=self.early.pop(info.mid,None) is not None
+			if not acked:
+				self.inflight[info.mid]=bot
+		if acked and bot is not None:
+			bot._on_publish(self.mqttc,None,info.mid)
+		return info
+		
+	def stop(self)->None:
+		self.mqttc.loop_stop()
+		self.mqttc.disconnect()
+
+
+
+def _slotValue(column:str,kind=int):
+	"""
+	property which reads and writes this bot's slot of a FleetState column
+	NaN reads as None
+	"""
+	def get(self):
+		value=getattr(self.fleet,column)[self.slot]
+		if kind is not bool and np.isnan(value):
+			return None
+		return kind(value)
+	def set(self,value):
+		getattr(self.fleet,column)[self.slot]=np.nan if value is None else value
+	return property(get,set)
 
 
 class pixelbot:
 	
 	"""things shared by all instances"""
+	
+	# position and status live in the fleet table, this is a view for messaging
+	cx=_slotValue("cx")
+	cy=_slotValue("cy")
+	heading=_slotValue("heading")
+	homeX=_slotValue("homeX")
+	homeY=_slotValue("homeY")
+	busy=_slotValue("busy",bool)
+	team=_slotValue("team")
+	lastCmd=_slotValue("lastCmd",float)
 
 	
-	def __init__(self,botId,cx:int,cy:int,heading:int,homeX:int=0,homeY:int=0):
-		"""properties and methods for each detected pixelbot"""
+	def __init__(self,botId,cx:int,cy:int,heading:int,homeX:int=0,homeY:int=0,fleet=None,broker=None,namespace:str=""):
+		"""properties and methods for each detected pixelbot
+		
+		fleet defaults to the shared FleetState.fleet
+		
+		broker is a sharedClient, None gives the bot its own connection
+		namespace is prefixed to the bot's topics (settings.TOPIC_NAMESPACE)
+		"""
 
 		self.myId=botId
 		try:
-			self.myName,self.addr=settings.allKnownBots[self.myId]
+			self.myName,self.addr=lookups.addrByBot[self.myId]
 		except:
 			raise(f"botId {self.myId} not found in settings.allKnownBots")
 		
+		self.fleet=fleet if fleet is not None else FleetState.fleet
+		self.slot=self.fleet.add(botId)
+		self.fleet.present[self.slot]=cx is not None
+		
 		self.cx=cx
 		self.cy=cy
 		self.heading=heading
@@ -37,26 +239,41 @@ class pixelbot:
 		self.homeY=homeY
 		
 		self.teamColour="red" if homeX<(settings.VIDEO_WIDTH/2) else "blue"
-		self.mqttc=paho.Client()
-		self.mqttc.connected_flag=False
 		self.publishCallbackPending=False
 		self.connectedToBroker=False
-		self._connectToBroker("__init__") # debugging where call came from
+		self.commandTopic=f"{namespace}{MQTT_COMMAND_TOPIC}{self.addr}"
+		self.dataTopic=f"{namespace}{MQTT_DATA_TOPIC}{self.addr}"
+		
+		self.shared=broker is not None
+		self.mqttc=broker if self.shared else preconnected.pop(self.addr,None)
+		if self.shared:
+			broker.register(self.dataTopic,self)
+		elif self.mqttc is not None:
+			self._adoptClient()
+		else:
+			self.mqttc=paho.Client()
+			self.mqttc.connected_flag=False
+			self._connectToBroker("__init__") # debugging where call came from
 
 		# set when variables are sent, cleared by bot data 
 		# topic on_message callback
 		self.busy=False
+		self.moveSent=None # monotonic time of the last move, for the round trip time
+		self.uploadAcked=threading.Event() # set when the bot sends settings.DEPLOY_BOT_ACK
+		self.everConnected=self.mqttc.connected_flag
 		
 	def __del__(self):
-		pass
-		if self.mqttc.connected_flag:
+		if not self.shared and self.mqttc.connected_flag:
 			self.mqttc.loop_stop()
 			
 	def _on_connect(self,client, obj, flags, rc):
 		if rc==0:
+			if getattr(self,"everConnected",False):
+				Metrics.mqttReconnects.inc(str(self.myId))
+			self.everConnected=True
 			client.connected_flag=True
-			print(f"subscribing to topic {MQTT_DATA_TOPIC+self.addr}",flush=True)
-			client.subscribe(MQTT_DATA_TOPIC+self.addr)
+			Log.info("Subscribing",topic=self.dataTopic)
+			client.subscribe(self.dataTopic)
 
 	
 	def _on_message(self,client, userdata, message):
@@ -66,15 +283,22 @@ class pixelbot:
 		if message.payload==b'1':
 			#print("Got job done")
 			self.busy=False
+			if self.moveSent is not None:
+				Metrics.botRtt.observe(time.monotonic()-self.moveSent,str(self.myId))
+				self.moveSent=None
+		elif settings.DEPLOY_BOT_ACK is not None and message.payload==settings.DEPLOY_BOT_ACK.encode():
+			self.uploadAcked.set()
 			
 		#print(f"on message for botId {self.myId} topic {message.topic} payload {message.payload}",flush=True)
 		
 		
 	def _on_disconnect(self,client, userdata, rc):
 		client.connected_flag=False
+		Metrics.mqttDisconnects.inc(str(self.myId))
 	
 	def _on_publish(self,client, userdata, mid):
 		self.publishPending=False
+		Metrics.mqttAcked.inc(str(self.myId))
 
 		
 	def _publishPayload(self,topic,payload):
@@ -83,7 +307,7 @@ class pixelbot:
 		
 		:param topic:
 		:param payload:
-		:return:
+		:return: paho MQTTMessageInfo, used to wait for delivery
 		'''
 		
 		if topic is None or payload is None:
@@ -91,13 +315,32 @@ class pixelbot:
 	
 		self.publishPending=True
 				
+		Metrics.mqttPublished.inc(str(self.myId))
+		if self.shared:
+			# the shared client reconnects by itself
+			return self.mqttc.publish(topic,payload,qos=2,bot=self)
 
 		if not self.mqttc.connected_flag:
-			self._connectToBroker()
-		self.mqttc.publish(topic,payload,qos=2)
+			self._connectToBroker("_publishPayload")
+		return self.mqttc.publish(topic,payload,qos=2)
 			
    
 
+	def _setCallbacks(self):
+		# on_message calls may be redirected
+		
+		self.mqttc.on_message = self._on_message
+		self.mqttc.on_connect = self._on_connect
+		self.mqttc.on_publish = self._on_publish
+		self.mqttc.on_disconnect = self._on_disconnect
+		
+	def _adoptClient(self):
+		"""
+		take over a client already connected by connectFleet()
+		"""
+		self._setCallbacks()
+		self.mqttc.subscribe(self.dataTopic)
+		
 	def _connectToBroker(self,info):
 		"""
 		waits till on_connect callback confirms connection
@@ -110,12 +353,7 @@ class pixelbot:
 			# don't try again
 			return
 
-		# on_message calls may be redirected
-		
-		self.mqttc.on_message = self._on_message
-		self.mqttc.on_connect = self._on_connect
-		self.mqttc.on_publish = self._on_publish
-		self.mqttc.on_disconnect = self._on_disconnect
+		self._setCallbacks()
 
 		# use authentication?
 		if MQTT_USER is not None:
@@ -126,42 +364,44 @@ class pixelbot:
 		# on_connect sets a global flag brokerConnected
 		startConnect = time.time()
 		self.mqttc.loop_start()
-		self.mqttc.connect(MQTT_BROKER,keepalive=MQTT_KEEP_ALIVE)
+		self.mqttc.connect(MQTT_BROKER,port=MQTT_PORT,keepalive=MQTT_KEEP_ALIVE)
 		while not self.mqttc.connected_flag:
 			# "connected" callback may take some time
 			if (time.time() - startConnect) > MQTT_CONNECT_TIMEOUT:
-				print(f"MQTT connect timeout",flush=True)
+				Log.warning("MQTT connect timeout",bot=self.myId)
 				return False
+			time.sleep(0.01) # don't starve the other threads
 
-        # pending uploader fix
-		#self.uploadPrograms(DEFAULT_PROGRAM_LIST)
+        # programs are uploaded to the whole fleet by ProgramDeployer
 		return True
 
-	def _sendHullOScmd(self,cmd:str)->None:
-		self._sendToRobot("***"+cmd)
+	def _sendHullOScmd(self,cmd:str):
+		return self._sendToRobot("***"+cmd)
 
 	def _sendHullOScmdList(self,cmdList: list)->None:
 		for cmd in cmdList:
 			self._sendHullOScmd(cmd)
 	
 	def _sendPythonishCmd(self,cmd):
-		self._sendToRobot("**"+cmd)
+		return self._sendToRobot("**"+cmd)
 		
 	def _sendPythonishcmdList(self,cmdList: list)->None:
 		for cmd in cmdList:
 			self._sendPythonishCmd(cmd)		
 		
-	def _sendToRobot(self,cmd:str)->None:
+	def _sendToRobot(self,cmd:str):
 		""" sendToRobot
 	
-		if DEBUG is True just print what would be sent
+		if DEBUG is True just log what would be sent
+		
+		returns the MQTTMessageInfo of the publish (None if DEBUG)
 		"""
 	
-		topic=f"{MQTT_COMMAND_TOPIC}{self.addr}"
+		topic=self.commandTopic
 		if DEBUG:
-			print(f"_sendToRobot: Topic {topic} cmd {cmd}",flush=True)
+			Log.info("_sendToRobot",topic=topic,cmd=cmd)
 		else:
-			self._publishPayload(topic,f"{cmd}")
+			return self._publishPayload(topic,f"{cmd}")
 			
 	def _sendCmdList(self,cmdList):
 		for cmd in cmdList:
@@ -201,20 +441,20 @@ class pixelbot:
 		"""run()
 		Tells the bot to start it's pythonish program
 		"""
-		self._sendHullOScmd("RS")
+		return self._sendHullOScmd("RS")
 
 	def stop(self):
 		"""stop()
 		Tells the pixelbot to stop executing its program
 		"""
-		self._sendHullOScmd("RH")
+		return self._sendHullOScmd("RH")
 
-	def loadAndRun(self,filename:str)->None:
+	def loadAndRun(self,filename:str):
 		"""
 		send a load command
 		"""
 		cmd=f'load "{filename}"'
-		self._sendPythonishCmd(cmd)
+		return self._sendPythonishCmd(cmd)
 			
 				
 				
@@ -239,7 +479,7 @@ class pixelbot:
 			return
 			
 		for filename in progs:
-			print(f"Uploading {filename}")
+			Log.info("Uploading",bot=self.myId,file=filename)
 			with open(f"programs/{filename}","r") as f:
 				progTxt=f.read()
 				# each file must have a begin and an end
@@ -249,30 +489,37 @@ class pixelbot:
 	def _beginUpload(self,filename=None):
 		if filename is None:
 			# prog becomes current
-			self._sendHullOScmd("RM") 
+			return self._sendHullOScmd("RM") 
 		else:
-			self._sendHullOScmd(f'RM{filename}')
+			return self._sendHullOScmd(f'RM{filename}')
 	
 	def _endUpload(self):
-		self._sendHullOScmd("RX")
+		return self._sendHullOScmd("RX")
 		
-	def _uploadPythonishProgram(self,progTxt,filename=None):
+	def _uploadPythonishProgram(self,progTxt,filename=None)->list:
 		"""
 		upload one program or None
+		
+		returns the MQTTMessageInfo of each publish so the caller
+		can wait for delivery
 		"""
+		sent=[]
+		self.uploadAcked.clear()
 		
-		self.stop() # halt the running program
+		sent.append(self.stop()) # halt the running program
 
-		self._beginUpload(filename)
+		sent.append(self._beginUpload(filename))
 			
-		self._sendPythonishCmd(progTxt)
+		sent.append(self._sendPythonishCmd(progTxt))
 		
-		self._endUpload()
+		sent.append(self._endUpload())
 		
 		if filename is None:
-			self.run() # immediately run the program ( default active.txt)
+			sent.append(self.run()) # immediately run the program ( default active.txt)
 		else:
-			self.loadAndRun(filename) # run the program
+			sent.append(self.loadAndRun(filename)) # run the program
+			
+		return [info for info in sent if info is not None]
 			
 	def OFF_uploadPythonishProgram(self,cmdList,filename=None):
 		"""
@@ -306,6 +553,8 @@ class pixelbot:
 		Arena Manager checks if bot has completed previous moves (not busy)
 		
 		"""
+		self.moveSent=time.monotonic()
+		Metrics.botCommands.inc(str(self.myId))
 			
 		for var in list(variables.keys()):
 			HullOs=f"VS{var}={variables[var]}"
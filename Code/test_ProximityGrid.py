@@ -0,0 +1,95 @@
+# test_ProximityGrid.py
+#
+# python -m pytest test_ProximityGrid.py
+#
+# bots are simulated the way Arena homes them: an idle bot asks for a move
+# straight to its target, the move goes through proximityEngine.checkMove()
+# and the bot then drives it at BOT_SPEED_MM_S, busy till it is done
+
+import math
+
+from config import settings
+import ProximityGrid
+
+TICK_S=0.1
+
+
+def _simulate(starts:dict,targets:dict,maxTicks:int=2000)->tuple:
+	"""
+	returns ticks taken for every bot to get home (None if they never did),
+	the closest any two bots came
+	"""
+	engine=ProximityGrid.proximityEngine()
+	pos={botId:list(xy) for botId,xy in starts.items()}
+	heading={botId:0.0 for botId in starts}
+	remaining={botId:0.0 for botId in starts} # mm left of the current move
+	homeMM=settings.HOMEBASE_SIDELEN_MM/2
+	closest=math.inf
+
+	for tick in range(maxTicks):
+		ids=list(pos)
+		engine.update(ids,[pos[b][0] for b in ids],[pos[b][1] for b in ids])
+		for a in ids:
+			for b in ids:
+				if a<b:
+					closest=min(closest,math.dist(pos[a],pos[b]))
+
+		home=[botId for botId in ids if math.dist(pos[botId],targets[botId])<=homeMM]
+		if len(home)==len(ids):
+			return tick,closest
+
+		for botId in ids:
+			if remaining[botId]>0 or botId in home:
+				continue
+			engine.release(botId)
+			x,y=pos[botId]
+			tx,ty=targets[botId]
+			course=math.degrees(math.atan2(tx-x,y-ty)) # clockwise from North, y down
+			angle=(course-heading[botId]+180)%360-180
+			move=engine.checkMove(botId,x,y,heading[botId],angle,int(math.dist((x,y),(tx,ty))))
+			if move is None:
+				continue
+			angle,dist=move
+			heading[botId]=(heading[botId]+angle)%360
+			remaining[botId]=dist
+			engine.reserve(botId,*ProximityGrid.moveEnd(x,y,heading[botId],0,dist))
+
+		for botId in ids:
+			step=min(remaining[botId],settings.BOT_SPEED_MM_S*TICK_S)
+			if step<=0:
+				continue
+			pos[botId]=list(ProximityGrid.moveEnd(*pos[botId],heading[botId],0,step))
+			remaining[botId]-=step
+
+	return None,closest
+
+
+def test_headOnSwapCompletes():
+	# two bots swapping sides meet head on and used to hold each other forever
+	starts={1:(200,500),2:(900,500)}
+	targets={1:(900,500),2:(200,500)}
+	ticks,closest=_simulate(starts,targets)
+	assert ticks is not None, "homing never completed"
+	assert closest>=2*settings.BOT_RADIUS_MM
+
+
+def test_crossingPathsComplete():
+	# only destinations are reserved, not the paths of moves in flight, so
+	# bots crossing at the same time can still touch. This checks no deadlock
+	starts={1:(200,200),2:(800,800),3:(200,800),4:(800,200)}
+	targets={1:(800,800),2:(200,200),3:(800,200),4:(200,800)}
+	ticks,_=_simulate(starts,targets)
+	assert ticks is not None, "homing never completed"
+
+
+def test_clearPathIsNotChanged():
+	engine=ProximityGrid.proximityEngine()
+	engine.update([1,2],[100,100],[100,600])
+	assert engine.checkMove(1,100,100,90,0,300)==(0,300)
+
+
+if __name__=="__main__":
+	for name,test in list(globals().items()):
+		if name.startswith("test_"):
+			test()
+			print(f"{name} ok",flush=True)
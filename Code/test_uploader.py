@@ -0,0 +1,64 @@
+# test_uploader.py
+#
+# python -m pytest test_uploader.py
+#
+# uploads run against uploader.fakeSerialBot pty devices, no hardware needed
+
+import os
+import select
+import tempfile
+
+import pytest
+
+import uploader
+
+PROGRAM=b"pythonish\nprint 1\nexit\n"
+
+
+@pytest.fixture
+def fakes():
+    bots=[uploader.fakeSerialBot() for _ in range(3)]
+    yield bots
+    for bot in bots:
+        bot.close()
+
+
+def test_flashAllProgramsEveryPort(fakes):
+    results=uploader.flashAll([bot.port for bot in fakes],PROGRAM,expect="stored",timeout=2)
+    assert [res["ok"] for res in results]==[True]*len(fakes)
+    assert all(res["response"]=="Program stored" for res in results)
+    assert all(bot.program==PROGRAM for bot in fakes)
+
+
+def test_unexpectedResponseFails(fakes):
+    res=uploader.flashPort(fakes[0].port,PROGRAM,expect="OK",timeout=0.5)
+    assert not res["ok"]
+    assert res["error"]=="expected 'OK'"
+
+
+def test_replyOnlyAfterEachExit(fakes):
+    bot=fakes[0]
+    assert uploader.flashPort(bot.port,PROGRAM,timeout=2)["ok"]
+    # half a program gets no answer, the last 'exit' has been dealt with
+    os.write(bot.slave,b"pythonish\nprint 2\n")
+    readable,_,_=select.select([bot.slave],[],[],0.5)
+    assert not readable
+    os.write(bot.slave,b"exit\n")
+    readable,_,_=select.select([bot.slave],[],[],2)
+    assert readable and os.read(bot.slave,256)==b"Program stored\r\n"
+    assert bot.program==b"pythonish\nprint 2\nexit\n"
+
+
+def test_missingPortFails():
+    res=uploader.flashPort("/dev/no-such-port",PROGRAM,timeout=0.5)
+    assert not res["ok"]
+    assert res["error"]
+
+
+def test_loadProgramAddsMarkers():
+    with tempfile.NamedTemporaryFile("w",suffix=".txt",delete=False) as f:
+        f.write("print 1\n")
+    try:
+        assert uploader.loadProgram(f.name)==PROGRAM
+    finally:
+        os.unlink(f.name)
@@ -1,48 +1,178 @@
+
+# uploader.py
+#
+# writes a pythonish program to pixelbots plugged in over USB, all ports at once
+#
+# python uploader.py                                   every /dev/ttyACM* and /dev/ttyUSB*, programs/active.txt
+# python uploader.py -p /dev/ttyACM0 /dev/ttyACM1 -f programs/main.txt
+# python uploader.py --fake 4                          pty fake bots, no hardware needed
+#
+# each port gets its own thread. A port is verified when the bot sends something
+# back (or the --expect text) after the program has been written
+
+import argparse
+import glob
+import os
+import pty
+import threading
+import time
+import tty
+from concurrent.futures import ThreadPoolExecutor
+
 import serial
 
-ser = serial.Serial(
-    port='/dev/ttyACM0',
-    baudrate=9600,
-    parity=serial.PARITY_ODD,
-    stopbits=serial.STOPBITS_TWO,
-    bytesize=serial.SEVENBITS
-)
-
-
-program="""pythonish
-begin
-println "Active.txt is running"
-dist=0
-angle=0
-forever
-  busy=dist+angle
-  if angle!=0
-    red
-    turn angle
-    angle=0
-  if dist!=0
-    yellow
-    move dist nowait
-    while @moving==1
-      if @distance<100
-        ang=@random-6
-        ang=10*ang
-        turn ang
-        move 100
-    dist=0
-  if busy>0
-    green
-    send 1
-  else
-    magenta
-end
-exit
-"""
-
-def sendPythonish():
-    ser.write(program.encode("utf-8"))
-    print("Restart the bot to load the program")
-
-    
-sendPythonish()
+BAUDRATE=9600
+PARITY=serial.PARITY_ODD
+STOPBITS=serial.STOPBITS_TWO
+BYTESIZE=serial.SEVENBITS
+
+DEFAULT_PROGRAM="programs/active.txt"
+RESPONSE_TIMEOUT=5 # seconds to wait for the bot to answer
+
+
+def discoverPorts() -> list:
+    """
+    USB serial ports which may have a pixelbot on them
+    """
+    try:
+        from serial.tools import list_ports
+        ports=[p.device for p in list_ports.comports() if "ACM" in p.device or "USB" in p.device]
+    except ImportError:
+        ports=[]
+    if not ports:
+        ports=glob.glob("/dev/ttyACM*")+glob.glob("/dev/ttyUSB*")
+    return sorted(ports)
+
+
+def loadProgram(filename: str) -> bytes:
+    """
+    the bot expects the program between 'pythonish' and 'exit'
+    add them if the file doesn't have them
+    """
+    with open(filename,"r") as f:
+        text=f.read()
+    if not text.lstrip().startswith("pythonish"):
+        text="pythonish\n"+text.rstrip("\n")+"\nexit\n"
+    return text.encode("utf-8")
+
+
+def flashPort(port: str,payload: bytes,expect: str=None,timeout: float=RESPONSE_TIMEOUT) -> dict:
+    """
+    write the program to one port then read back the bot's response
+
+    returns {"port","ok","openSeconds","writeSeconds","verifySeconds","seconds","response","error"}
+    """
+    result={"port":port,"ok":False,"openSeconds":0,"writeSeconds":0,"verifySeconds":0,"seconds":0,"response":"","error":None}
+    start=time.time()
+    try:
+        with serial.Serial(port=port,baudrate=BAUDRATE,parity=PARITY,stopbits=STOPBITS,bytesize=BYTESIZE,timeout=0.1) as ser:
+            opened=time.time()
+            result["openSeconds"]=opened-start
+
+            ser.reset_input_buffer()
+            ser.write(payload)
+            ser.flush()
+            written=time.time()
+            result["writeSeconds"]=written-opened
+
+            response=b""
+            while time.time()-written<timeout:
+                response+=ser.read(256)
+                text=response.decode("utf-8","replace")
+                if (expect is None and response) or (expect is not None and expect in text):
+                    # give the rest of the line a moment to arrive
+                    response+=ser.read(256)
+                    result["ok"]=True
+                    break
+            result["response"]=response.decode("utf-8","replace").strip()
+            result["verifySeconds"]=time.time()-written
+            if not result["ok"]:
+                result["error"]="no response" if not response else f"expected {expect!r}"
+
+    except (serial.SerialException,OSError) as e:
+        result["error"]=str(e)
+
+    result["seconds"]=time.time()-start
+    return result
+
+
+def flashAll(ports: list,payload: bytes,expect: str=None,timeout: float=RESPONSE_TIMEOUT) -> list:
+    """
+    one thread per port
+    """
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        return list(pool.map(lambda port: flashPort(port,payload,expect,timeout),ports))
+
+
+class fakeSerialBot:
+    """
+    pty pretending to be a pixelbot on a serial port
+
+    collects the program until 'exit' then replies, the last program
+    received is kept in self.program
+    """
+    def __init__(self,reply: str="Program stored\r\n",delay: float=0.05):
+        self.reply=reply.encode("utf-8")
+        self.delay=delay
+        self.received=b""
+        self.program=None
+        self.master,self.slave=pty.openpty()
+        tty.setraw(self.slave)
+        self.port=os.ttyname(self.slave)
+        self.thread=threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data=os.read(self.master,1024)
+            except OSError:
+                return
+            if not data:
+                return
+            self.received+=data
+            if b"exit\n" in self.received:
+                self.program=self.received
+                self.received=b"" # the next upload starts afresh
+                time.sleep(self.delay)
+                os.write(self.master,self.reply)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def _report(results: list,elapsed: float) -> None:
+    for res in results:
+        status="OK  " if res["ok"] else "FAIL"
+        print(f"{status} {res['port']:14s} open {res['openSeconds']:.2f}s write {res['writeSeconds']:.2f}s verify {res['verifySeconds']:.2f}s total {res['seconds']:.2f}s  {res['error'] or res['response']}",flush=True)
+    ok=sum(1 for res in results if res["ok"])
+    print(f"{ok}/{len(results)} bots programmed in {elapsed:.2f}s",flush=True)
+
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(description="upload a pythonish program to pixelbots over USB serial")
+    parser.add_argument("-p","--ports",nargs="*",help="serial ports, default is every USB serial port found")
+    parser.add_argument("-f","--file",default=DEFAULT_PROGRAM,help="program file to send")
+    parser.add_argument("--expect",help="text the bot must send back, default is any response")
+    parser.add_argument("--timeout",type=float,default=RESPONSE_TIMEOUT,help="seconds to wait for each bot to answer")
+    parser.add_argument("--fake",type=int,default=0,help="use N pty fake bots instead of hardware")
+    args=parser.parse_args()
+
+    fakes=[fakeSerialBot() for _ in range(args.fake)]
+    ports=[bot.port for bot in fakes] if fakes else (args.ports or discoverPorts())
+
+    if not ports:
+        print("No serial ports found",flush=True)
+    else:
+        payload=loadProgram(args.file)
+        print(f"Sending {args.file} ({len(payload)} bytes) to {len(ports)} port(s)",flush=True)
+        start=time.time()
+        results=flashAll(ports,payload,args.expect,args.timeout)
+        _report(results,time.time()-start)
 
+    for bot in fakes:
+        bot.close()